@@ -46,10 +46,11 @@ class SimpleArReader(object):
       group_id: numeric id of the user and group owning the file.
       mode: unix permission mode of the file
       size: size of the file
-      data: the content of the file.
+      offset: position of the content of the file in the archive.
+      data: the content of the file, None if it was not read.
     """
 
-    def __init__(self, f):
+    def __init__(self, f, read_data=True):
       self.filename = f.read(16).decode('utf-8').strip()
       if self.filename.endswith('/'):  # SysV variant
         self.filename = self.filename[:-1]
@@ -61,7 +62,12 @@ class SimpleArReader(object):
       pad = f.read(2)
       if pad != b'\x60\x0a':
         raise SimpleArReader.ArError('Invalid AR file header')
-      self.data = f.read(self.size)
+      self.offset = f.tell()
+      if read_data:
+        self.data = f.read(self.size)
+      else:
+        self.data = None
+        f.seek(self.size, os.SEEK_CUR)
 
   MAGIC_STRING = b'!<arch>\n'
 
@@ -77,8 +83,13 @@ class SimpleArReader(object):
   def __exit__(self, t, v, traceback):
     self.f.close()
 
-  def next(self):
-    """Read the next file. Returns None when reaching the end of file."""
+  def next(self, read_data=True):
+    """Read the next file. Returns None when reaching the end of file.
+
+    Args:
+      read_data: if false, the content of the file is skipped rather than
+        read in memory. It can then be read with open_member().
+    """
     # AR sections are two bit aligned using new lines.
     if self.f.tell() % 2 != 0:
       self.f.read(1)
@@ -86,4 +97,63 @@ class SimpleArReader(object):
     # bytes at the end of the archive, ignore them.
     if self.f.tell() > os.fstat(self.f.fileno()).st_size - 60:
       return None
-    return self.SimpleArFileEntry(self.f)
+    return self.SimpleArFileEntry(self.f, read_data=read_data)
+
+  def open_member(self, entry):
+    """Returns a file object reading the content of an entry in place."""
+    return ArMemberView(self.filename, entry.offset, entry.size)
+
+
+class ArMemberView(io.RawIOBase):
+  """A read-only file object on the content of one member of an AR archive.
+
+  The member is read from the archive file as it is consumed, so it is never
+  held in memory nor copied to disk. Reads stop at the end of the member.
+  """
+
+  def __init__(self, filename, offset, size):
+    """Open the view.
+
+    Args:
+      filename: the AR archive.
+      offset: position of the content of the member in the archive.
+      size: size of the member.
+    """
+    super().__init__()
+    self._f = open(filename, 'rb')
+    self._offset = offset
+    self._size = size
+    self._pos = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def readinto(self, b):
+    count = min(len(b), self._size - self._pos)
+    if count <= 0:
+      return 0
+    self._f.seek(self._offset + self._pos)
+    read = self._f.readinto(memoryview(b)[:count])
+    self._pos += read
+    return read
+
+  def tell(self):
+    return self._pos
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._pos
+    elif whence == os.SEEK_END:
+      offset += self._size
+    if offset < 0:
+      raise ValueError('negative seek position %d' % offset)
+    self._pos = offset
+    return self._pos
+
+  def close(self):
+    if not self.closed:
+      self._f.close()
+    super().close()
@@ -16,7 +16,7 @@
 load("//pkg:providers.bzl", "PackageVariablesInfo")
 load("//pkg/private:util.bzl", "setup_output_files", "substitute_package_variables")
 
-_tar_filetype = [".tar", ".tar.gz", ".tgz", ".tar.bz2", "tar.xz", "tar.zst"]
+_tar_filetype = [".tar", ".tar.gz", ".tgz", ".tar.bz2", "tar.xz", "tar.zst", ".tzst"]
 
 def _pkg_deb_impl(ctx):
     """The implementation for the pkg_deb rule."""
@@ -178,6 +178,15 @@ def _pkg_deb_impl(ctx):
         for d in ctx.attr.provides:
             args.add("--provides", substitute_package_variables(ctx, d))
 
+    action_outputs = [output_file, changes_file]
+    digests_files = []
+    if ctx.attr.digest_algorithms:
+        digests_file = ctx.actions.declare_file(output_file.basename + ".digests.json")
+        args.add("--digests_file", digests_file.path)
+        args.add_joined("--digest_algorithms", ctx.attr.digest_algorithms, join_with = ",")
+        action_outputs.append(digests_file)
+        digests_files.append(digests_file)
+
     args.set_param_file_format("flag_per_line")
     args.use_param_file("@%s", use_always = True)
     ctx.actions.run(
@@ -185,7 +194,7 @@ def _pkg_deb_impl(ctx):
         executable = ctx.executable._make_deb,
         arguments = [args],
         inputs = files,
-        outputs = [output_file, changes_file],
+        outputs = action_outputs,
         env = {
             "LANG": "en_US.UTF-8",
             "LC_CTYPE": "UTF-8",
@@ -198,6 +207,8 @@ def _pkg_deb_impl(ctx):
         "deb": [output_file],
         "changes": [changes_file],
     }
+    if digests_files:
+        output_groups["digests"] = digests_files
     return [
         OutputGroupInfo(**output_groups),
         DefaultInfo(
@@ -220,6 +231,7 @@ pkg_deb_impl = rule(
     - `out` the Debian package or a symlink to the actual package.
     - `deb` the package with any precise file name created with `package_file_name`.
     - `changes` the .changes file.
+    - `digests` the digests of the package, with `digest_algorithms`.
     """,
     attrs = {
         # @unsorted-dict-items
@@ -393,6 +405,10 @@ See https://www.debian.org/doc/debian-policy/ch-files.html#s-config-files.""",
             doc = """See http://www.debian.org/doc/debian-policy/ch-relationships.html#s-binarydeps.""",
             default = [],
         ),
+        "digest_algorithms": attr.string_list(
+            doc = """Digests of the package to compute while it is written, e.g. `["sha512"]`.
+            They are written to `<out>.digests.json`, in the `digests` output group.""",
+        ),
 
         # Common attributes
         "out": attr.output(
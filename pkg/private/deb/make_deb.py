@@ -29,8 +29,12 @@ if sys.version_info < (3, 7):
 else:
   OrderedDict = dict
 
+from pkg.private import hashing_writer
 from pkg.private import helpers
 
+# Digests of the package listed in the changes file.
+CHANGES_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
 Multiline = Enum('Multiline', ['NO', 'YES', 'YES_ADD_NEWLINE'])
 
 # list of debian fields : (name, mandatory, is_multiline[, default])
@@ -204,8 +208,14 @@ def CreateDeb(output,
               md5sums=None,
               conffiles=None,
               changelog=None,
+              digest_algorithms=CHANGES_ALGORITHMS,
               **kwargs):
-  """Create a full debian package."""
+  """Create a full debian package.
+
+  Returns:
+    The digests of the package, computed while it is written, see
+    hashing_writer.HashingWriter.digests().
+  """
   extrafiles = OrderedDict()
   if preinst:
     extrafiles['preinst'] = (preinst, 0o755)
@@ -230,7 +240,8 @@ def CreateDeb(output,
   control = CreateDebControl(extrafiles=extrafiles, **kwargs)
 
   # Write the final AR archive (the deb package)
-  with open(output, 'wb') as f:
+  with open(output, 'wb') as out, hashing_writer.HashingWriter(
+      out, digest_algorithms, closefd=False) as f:
     f.write(b'!<arch>\n')  # Magic AR header
     AddArFileEntry(f, 'debian-binary', b'2.0\n')
     AddArFileEntry(f, 'control.tar.gz', control)
@@ -240,6 +251,8 @@ def CreateDeb(output,
       ext = 'tar'
     elif ext[1] == 'tgz':
       ext = 'tar.gz'
+    elif ext[1] == 'tzst':
+      ext = 'tar.zst'
     elif ext[1] == 'tar.bzip2':
       ext = 'tar.bz2'
     else:
@@ -249,6 +262,7 @@ def CreateDeb(output,
     data_size = os.stat(data).st_size
     with open(data, 'rb') as datafile:
       AddArFileEntry(f, 'data.' + ext, datafile, content_len=data_size)
+  return f.digests()
 
 
 def GetChecksumsFromFile(filename, hash_fns=None):
@@ -288,11 +302,17 @@ def CreateChanges(output,
                   priority,
                   distribution,
                   urgency,
-                  timestamp=0):
-  """Create the changes file."""
-  checksums = GetChecksumsFromFile(deb_file, {'md5': hashlib.md5,
-                                              'sha1': hashlib.sha1,
-                                              'sha256': hashlib.sha256})
+                  timestamp=0,
+                  checksums=None):
+  """Create the changes file.
+
+  `checksums` are the md5, sha1 and sha256 digests of deb_file, if already
+  known, as returned by CreateDeb().
+  """
+  if checksums is None:
+    checksums = GetChecksumsFromFile(deb_file, {'md5': hashlib.md5,
+                                                'sha1': hashlib.sha1,
+                                                'sha256': hashlib.sha256})
   debsize = str(os.path.getsize(deb_file))
   deb_basename = os.path.basename(deb_file)
 
@@ -384,10 +404,24 @@ def main():
   parser.add_argument(
       '--changelog',
       help='The changelog file (prefix item with @ to provide a path).')
+  parser.add_argument(
+      '--digests_file',
+      help='Write the digests of the package, computed while it is written,'
+           ' to this JSON file.')
+  parser.add_argument(
+      '--digest_algorithms', type=hashing_writer.parse_algorithms,
+      default=list(hashing_writer.DEFAULT_ALGORITHMS),
+      help='With --digests_file, comma separated list of the digests to'
+           ' compute, e.g. sha256,sha512.')
   AddControlFlags(parser)
   options = parser.parse_args()
 
-  CreateDeb(
+  # The changes file needs some digests, the digests file others.
+  digest_algorithms = list(CHANGES_ALGORITHMS)
+  if options.digests_file:
+    digest_algorithms.extend(
+        a for a in options.digest_algorithms if a not in digest_algorithms)
+  digests = CreateDeb(
       options.output,
       options.data,
       preinst=helpers.GetFlagValue(options.preinst, False),
@@ -420,8 +454,15 @@ def main():
       conflicts=options.conflicts,
       breaks=options.breaks,
       installedSize=helpers.GetFlagValue(options.installed_size),
-      multiArch=helpers.GetFlagValue(options.multi_arch)
+      multiArch=helpers.GetFlagValue(options.multi_arch),
+      digest_algorithms=digest_algorithms,
   )
+  if options.digests_file:
+    hashing_writer.write_digests(options.digests_file, [(
+        options.output,
+        {k: v for k, v in digests.items()
+         if k == 'size' or k in options.digest_algorithms},
+        None)])
   CreateChanges(
       output=options.changes,
       deb_file=options.output,
@@ -430,7 +471,7 @@ def main():
       maintainer=helpers.GetFlagValue(options.maintainer), package=options.package,
       version=helpers.GetFlagValue(options.version), section=options.section,
       priority=options.priority, distribution=options.distribution,
-      urgency=options.urgency)
+      urgency=options.urgency, checksums=digests)
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,202 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Digests of archives, computed while they are written.
+
+Release pipelines need the digests of the archives we write. Reading an
+archive again to hash it costs as much I/O as writing it. A HashingWriter
+hashes the bytes as they go to the file. The digests are then written to a
+sidecar JSON file:
+
+  {
+    "outputs": {
+      "out.tar.gz": {
+        "size": 1234,
+        "sha256": "...",
+        "uncompressed": {"size": 10240, "sha256": "..."}
+      }
+    }
+  }
+
+`outputs` has the digests of the files written, by base name. For tar
+files, `uncompressed` has those of the tar stream before compression.
+"""
+
+import hashlib
+import json
+import os
+
+DEFAULT_ALGORITHMS = ('sha256',)
+
+# Amount of rewritable data a HashingWriter keeps before hashing it.
+MAX_PENDING_SIZE = 64 * 1024 * 1024
+
+_READ_SIZE = 1024 * 1024
+
+
+def parse_algorithms(value):
+  """Returns the list of algorithms of a comma separated flag value."""
+  algorithms = [a.strip().lower() for a in value.split(',') if a.strip()]
+  for algorithm in algorithms:
+    # Raises ValueError for unknown algorithms.
+    hashlib.new(algorithm)
+  return algorithms
+
+
+def hash_file(path, algorithms=DEFAULT_ALGORITHMS):
+  """Returns the digests of a file, in the format of HashingWriter.digests()."""
+  hashes = [hashlib.new(a) for a in algorithms]
+  size = 0
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(_READ_SIZE)
+      if not data:
+        break
+      size += len(data)
+      for h in hashes:
+        h.update(data)
+  digests = {'size': size}
+  digests.update((a, h.hexdigest()) for a, h in zip(algorithms, hashes))
+  return digests
+
+
+def write_digests(path, outputs):
+  """Writes the sidecar file of the digests of archives.
+
+  Args:
+    path: the sidecar file name.
+    outputs: list of (file name, digests, uncompressed digests or None) of
+        the files written.
+  """
+  content = {'outputs': {}}
+  for name, digests, uncompressed in outputs:
+    digests = dict(digests)
+    if uncompressed is not None:
+      digests['uncompressed'] = uncompressed
+    content['outputs'][os.path.basename(name)] = digests
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(content, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+class HashingWriter(object):
+  """A file object hashing the data written through it.
+
+  Sequential writes are hashed right away. Writers like zipfile seek back to
+  rewrite headers once the data after them is written: after the first seek,
+  data is kept, up to MAX_PENDING_SIZE, until a seek shows that it will not
+  be rewritten anymore, i.e. that it is before the position sought. If data
+  is rewritten after it was hashed, the digests are not valid, and the file
+  must be hashed once it is complete.
+  """
+
+  def __init__(self, fileobj, algorithms=DEFAULT_ALGORITHMS, closefd=True,
+               max_pending_size=MAX_PENDING_SIZE):
+    """Create the writer.
+
+    Args:
+      fileobj: the binary file object to write to.
+      algorithms: names of the hashlib algorithms to compute.
+      closefd: whether close() closes fileobj.
+      max_pending_size: amount of rewritable data kept before hashing it.
+    """
+    self._fileobj = fileobj
+    self._algorithms = list(algorithms)
+    self._hashes = [hashlib.new(a) for a in self._algorithms]
+    self._closefd = closefd
+    self._max_pending_size = max_pending_size
+    # Data from offset self._hashed to self._size, which was not hashed yet.
+    self._pending = bytearray()
+    self._hashed = 0
+    self._size = 0
+    self._position = 0
+    self._seeked = False
+    self.valid = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
+
+  def _hash(self, data):
+    for h in self._hashes:
+      h.update(data)
+
+  def _hash_pending(self, end):
+    """Hashes the pending data before offset `end`."""
+    count = end - self._hashed
+    if count > 0:
+      self._hash(self._pending[:count])
+      del self._pending[:count]
+      self._hashed = end
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    count = len(data)
+    if not self._seeked:
+      self._hash(data)
+      self._fileobj.write(data)
+      self._position += count
+      self._hashed = self._size = self._position
+      return count
+    if self._position < self._hashed:
+      self.valid = False
+    else:
+      start = self._position - self._hashed
+      self._pending[start:start + count] = data
+    self._fileobj.write(data)
+    self._position += count
+    self._size = max(self._size, self._position)
+    if len(self._pending) > self._max_pending_size:
+      self._hash_pending(self._size - self._max_pending_size)
+    return count
+
+  def seekable(self):
+    return self._fileobj.seekable()
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    position = self._fileobj.seek(offset, whence)
+    if position > self._size:
+      # There is no data for the hole that this would leave.
+      self.valid = False
+    self._seeked = True
+    if position < self._size:
+      self._hash_pending(position)
+    self._position = position
+    return position
+
+  def tell(self):
+    return self._position
+
+  def flush(self):
+    self._fileobj.flush()
+
+  def close(self):
+    if self._closefd:
+      self._fileobj.close()
+
+  def digests(self):
+    """Returns {'size': size, algorithm: hex digest...} of the data written.
+
+    Returns None if data was rewritten after it was hashed.
+    """
+    if not self.valid:
+      return None
+    self._hash_pending(self._size)
+    digests = {'size': self._size}
+    digests.update(
+        (a, h.hexdigest()) for a, h in zip(self._algorithms, self._hashes))
+    return digests
@@ -0,0 +1,219 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Metadata of the input files of an archive, looked up once."""
+
+import collections
+import concurrent.futures
+import heapq
+import os
+import stat
+
+# Number of directories listed at the same time by StatCache.walk_tree().
+# Listing is bound by the latency of the file system rather than by the CPU.
+DEFAULT_WALK_THREADS = 8
+
+# An entry of a directory tree walked by StatCache.walk_tree().
+#   rel_path: '/' delimited path relative to the top of the tree.
+#   path: path of the entry on the file system.
+#   is_dir: whether this is a directory, or a symbolic link to one.
+#   is_link: for directories, whether this is a symbolic link, which is not
+#       walked.
+TreeEntry = collections.namedtuple('TreeEntry',
+                                   ['rel_path', 'path', 'is_dir', 'is_link'])
+
+
+class StatCache(object):
+  """Caches the os.stat() results of input files, for one archive creation.
+
+  Archivers need the size, mode, mtime and executable bit of each input, and
+  used to query them with separate os.stat(), os.access() and os.fstat()
+  calls. On the FUSE file systems used by remote execution, each of them is a
+  round trip. The cache answers all of them from a single stat per file, and
+  directory walks fill it in bulk from os.scandir().
+
+  Inputs are not expected to change while the archive is created.
+
+  Attributes:
+    stats: collections.Counter of the 'stat_calls' made, and of the
+        'stat_calls_avoided', the metadata lookups answered from the cache.
+  """
+
+  def __init__(self):
+    self._cwd = os.getcwd()
+    self._stats = {}
+    self.stats = collections.Counter()
+    if hasattr(os, 'getuid'):
+      self._uid = os.getuid()
+      self._groups = frozenset(os.getgroups()) | {os.getgid()}
+    else:
+      self._uid = None
+
+  def _key(self, path):
+    return os.path.normpath(os.path.join(self._cwd, path))
+
+  def stat(self, path):
+    """Returns os.stat(path), following symbolic links."""
+    key = self._key(path)
+    st = self._stats.get(key)
+    if st is None:
+      st = os.stat(path)
+      self.stats['stat_calls'] += 1
+      self._stats[key] = st
+    else:
+      self.stats['stat_calls_avoided'] += 1
+    return st
+
+  def getsize(self, path):
+    """Returns the size of a file, like os.path.getsize()."""
+    return self.stat(path).st_size
+
+  def is_executable(self, path):
+    """Returns whether a file is executable, like os.access(path, os.X_OK).
+
+    The permission bits are checked against the real user and groups, as
+    access() does. ACLs and noexec mounts are not taken into account.
+    """
+    if self._uid is None:
+      # Windows has no execute permission: access() only checks existence.
+      self.stats['stat_calls'] += 1
+      return os.access(path, os.X_OK)
+    try:
+      st = self.stat(path)
+    except OSError:
+      return False
+    # The access() call that this lookup replaces.
+    self.stats['stat_calls_avoided'] += 1
+    mode = st.st_mode
+    if self._uid == 0:
+      return stat.S_ISDIR(mode) or bool(mode & 0o111)
+    if st.st_uid == self._uid:
+      return bool(mode & stat.S_IXUSR)
+    if st.st_gid in self._groups:
+      return bool(mode & stat.S_IXGRP)
+    return bool(mode & stat.S_IXOTH)
+
+  @staticmethod
+  def _list_dir(root):
+    """Lists a directory and reads the metadata of its files.
+
+    Returns:
+      (dirs, files, links, stats): the names of the subdirectories, of the
+      other entries and of the subdirectories which are symbolic links, and
+      the (path, os.stat_result) of the files whose metadata could be read.
+    """
+    try:
+      with os.scandir(root) as it:
+        entries = list(it)
+    except OSError:
+      return None
+    dirs = []
+    files = []
+    links = set()
+    stats = []
+    for entry in entries:
+      try:
+        is_dir = entry.is_dir()
+      except OSError:
+        is_dir = False
+      if is_dir:
+        dirs.append(entry.name)
+        if entry.is_symlink():
+          links.add(entry.name)
+      else:
+        files.append(entry.name)
+        try:
+          stats.append((entry.path, entry.stat()))
+        except OSError:
+          # A dangling symbolic link. Let the caller report it when it opens
+          # it.
+          pass
+    return dirs, files, links, stats
+
+  def _record(self, listing):
+    """Records the metadata of the files of a directory listing."""
+    for path, st in listing[3]:
+      self._stats[self._key(path)] = st
+    self.stats['stat_calls'] += len(listing[3])
+
+  def walk_tree(self, top, dir_suffix='', threads=DEFAULT_WALK_THREADS):
+    """Walks a directory tree, in the sorted order of the paths.
+
+    Directories are listed, and their files stat'ed, by a pool of threads:
+    each listed directory queues its subdirectories, so the tree is listed
+    ahead of the caller, which gets the first entries without waiting for the
+    whole tree. The metadata of the files found is recorded.
+
+    Entries come in the order of their relative path, as if the paths of the
+    whole tree were sorted. Symbolic links to directories are listed but not
+    followed.
+
+    Args:
+      top: the directory to walk.
+      dir_suffix: appended to the relative path of directories when sorting,
+          '/' to sort them as directory names rather than as file names.
+      threads: number of directories listed in parallel.
+
+    Yields:
+      A TreeEntry for each entry, starting with `top` itself, which has an
+      empty relative path.
+    """
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads))
+    # All the futures submitted, to cancel those left if the caller stops
+    # early. ThreadPoolExecutor.shutdown(cancel_futures=True) needs Python 3.9.
+    futures = []
+
+    def submit(root):
+      future = pool.submit(list_tree, root)
+      futures.append(future)
+      return future
+
+    def list_tree(root):
+      # Queue the subdirectories as soon as they are known, rather than when
+      # the caller gets to them.
+      listing = self._list_dir(root)
+      if listing is None:
+        return None, {}
+      dirs, _, links, _ = listing
+      return listing, {
+          name: submit(os.path.join(root, name))
+          for name in dirs if name not in links
+      }
+
+    try:
+      # Sort keys are unique, so the heap never compares the other fields.
+      heap = [('', '', top, True, False, submit(top))]
+      while heap:
+        _, rel_path, path, is_dir, is_link, future = heapq.heappop(heap)
+        yield TreeEntry(rel_path, path, is_dir, is_link)
+        if future is None:
+          continue
+        listing, children = future.result()
+        if listing is None:
+          continue
+        self._record(listing)
+        dirs, files, links, _ = listing
+        # The descendants of a directory sort after it, so they can wait
+        # until it comes out of the heap.
+        prefix = rel_path + '/' if rel_path else ''
+        for name in files:
+          heapq.heappush(heap, (prefix + name, prefix + name,
+                                os.path.join(path, name), False, False, None))
+        for name in dirs:
+          heapq.heappush(heap, (prefix + name + dir_suffix, prefix + name,
+                                os.path.join(path, name), True,
+                                name in links, children.get(name)))
+    finally:
+      for future in futures:
+        future.cancel()
+      pool.shutdown(wait=True)
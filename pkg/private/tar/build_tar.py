@@ -14,17 +14,35 @@
 """This tool build tar files from a list of inputs."""
 
 import argparse
+import collections
+import contextlib
+import filecmp
+import functools
+import hashlib
 import os
 import stat
 import tarfile
-import tempfile
 
 from pkg.private import archive
 from pkg.private import helpers
 from pkg.private import build_info
+from pkg.private import hashing_writer
 from pkg.private import manifest
+from pkg.private import stat_cache
+from pkg.private.tar import prefetch
 from pkg.private.tar import tar_writer
 
+# Size of the chunks read when hashing files for deduplication.
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@contextlib.contextmanager
+def _open_tar_data(tar):
+  """Opens the uncompressed content of a tar file."""
+  with open(tar, 'rb') as f:
+    with prefetch.decompressing_reader(f) as reader:
+      yield reader
+
 
 def normpath(path):
   r"""Normalize a path to the format we need it.
@@ -37,6 +55,35 @@ def normpath(path):
   return os.path.normpath(path).replace(os.path.sep, '/')
 
 
+def _file_digest(path):
+  """Returns the sha256 digest of the content of a file."""
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(_HASH_CHUNK_SIZE)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.digest()
+
+
+class _DedupCandidate(object):
+  """A file of the archive that later files with the same content can link to."""
+
+  __slots__ = ('dest', 'path', '_digest')
+
+  def __init__(self, dest, path):
+    self.dest = dest
+    self.path = path
+    self._digest = None
+
+  def digest(self):
+    # Only hashed once a second file with the same size shows up.
+    if self._digest is None:
+      self._digest = _file_digest(self.path)
+    return self._digest
+
+
 class TarFile(object):
   """A class to generates a TAR file."""
 
@@ -45,7 +92,13 @@ class TarFile(object):
 
   def __init__(self, output, directory, compression, compressor, create_parents,
                allow_dups_from_deps, default_mtime, compression_level, preserve_mode,
-               preserve_mtime):
+               preserve_mtime, compression_threads=1, zstd_long=False,
+               deduplicate=False, seekable_index=None,
+               seekable_frame_size=None, estargz=False,
+               estargz_toc_digest=None, extra_outputs=None, split_size=None,
+               split_dir=None, split_index=None, diff_base=None,
+               digests_file=None,
+               digest_algorithms=hashing_writer.DEFAULT_ALGORITHMS):
     # Directory prefix on all output paths
     d = directory.strip('/')
     self.directory = (d + '/') if d else None
@@ -58,6 +111,25 @@ class TarFile(object):
     self.compression_level = compression_level
     self.preserve_mode = preserve_mode
     self.preserve_mtime = preserve_mtime
+    self.compression_threads = compression_threads
+    self.zstd_long = zstd_long
+    self.deduplicate = deduplicate
+    self.seekable_index = seekable_index
+    self.seekable_frame_size = seekable_frame_size
+    self.estargz = estargz
+    self.estargz_toc_digest = estargz_toc_digest
+    self.extra_outputs = extra_outputs
+    self.split_size = split_size
+    self.split_dir = split_dir
+    self.split_index = split_index
+    self.diff_base = diff_base
+    self.digests_file = digests_file
+    self.digest_algorithms = digest_algorithms
+    # Files added so far, keyed by size and archive metadata. See
+    # _add_file_content.
+    self.dedup_candidates = collections.defaultdict(list)
+    self.stats = collections.Counter()
+    self.stat_cache = stat_cache.StatCache()
 
   def __enter__(self):
     self.tarfile = tar_writer.TarFileWriter(
@@ -67,11 +139,27 @@ class TarFile(object):
         self.create_parents,
         self.allow_dups_from_deps,
         default_mtime=self.default_mtime,
-        compression_level=self.compression_level)
+        compression_level=self.compression_level,
+        compression_threads=self.compression_threads,
+        zstd_long=self.zstd_long,
+        streaming=True,
+        seekable_index=self.seekable_index,
+        seekable_frame_size=self.seekable_frame_size,
+        estargz_toc=self.estargz,
+        extra_outputs=self.extra_outputs,
+        split_size=self.split_size,
+        split_dir=self.split_dir,
+        split_index=self.split_index,
+        diff_base=self.diff_base,
+        digests_file=self.digests_file,
+        digest_algorithms=self.digest_algorithms)
     return self
 
   def __exit__(self, t, v, traceback):
     self.tarfile.close()
+    if self.estargz_toc_digest:
+      with open(self.estargz_toc_digest, 'w') as f:
+        f.write(self.tarfile.toc_digest + '\n')
 
   def normalize_path(self, path: str) -> str:
     dest = normpath(path)
@@ -109,24 +197,54 @@ class TarFile(object):
     # from the file's mode attribute. Note: the mode argument is ignored.
     # Otherwise; if mode is unspecified, derive the mode from the file's mode.
     if self.preserve_mode is True:
-      mode = stat.S_IMODE(os.stat(f).st_mode)
+      mode = stat.S_IMODE(self.stat_cache.stat(f).st_mode)
     elif mode is None:
-        mode = 0o755 if os.access(f, os.X_OK) else 0o644
+        mode = 0o755 if self.stat_cache.is_executable(f) else 0o644
     if self.preserve_mtime is True:
-      mtime = os.stat(f).st_mtime
+      mtime = self.stat_cache.stat(f).st_mtime
     if ids is None:
       ids = (0, 0)
     if names is None:
       names = ('', '')
-    self.tarfile.add_file(
-        dest,
-        file_content=f,
-        mode=mode,
-        uid=ids[0],
-        gid=ids[1],
-        uname=names[0],
-        gname=names[1],
-        mtime=mtime)
+    self._add_file_content(dest, f, mode=mode, ids=ids, names=names,
+                           mtime=mtime)
+
+  def _add_file_content(self, dest, f, mode, ids, names, mtime=None):
+    """Add the file `f` as `dest`, or a hard link to an identical file.
+
+    Without deduplication this just adds `f`. Otherwise, files whose content
+    is identical to a file already in the archive are stored as a hard link
+    to it. Candidates are first selected by size, then compared by digest,
+    and the content is finally compared byte for byte so that a digest
+    collision can not corrupt the archive.
+    """
+    attrs = {
+        'mode': mode,
+        'uid': ids[0],
+        'gid': ids[1],
+        'uname': names[0],
+        'gname': names[1],
+        'mtime': mtime,
+    }
+    size = self.stat_cache.getsize(f)
+    if not self.deduplicate or not size:
+      self.tarfile.add_file(dest, file_content=f, file_size=size, **attrs)
+      return
+    # Hard links share their inode when extracted, so a file may only be
+    # linked to one which has the same metadata in the archive.
+    key = (size, mode, ids, names, mtime)
+    candidates = self.dedup_candidates[key]
+    new_candidate = _DedupCandidate(dest, f)
+    for candidate in candidates:
+      if (candidate.digest() == new_candidate.digest() and
+          filecmp.cmp(candidate.path, f, shallow=False)):
+        if self.tarfile.add_file(dest, kind=tarfile.LNKTYPE,
+                                 link=candidate.dest, **attrs):
+          self.stats['dedup_files'] += 1
+          self.stats['dedup_bytes_saved'] += size
+        return
+    if self.tarfile.add_file(dest, file_content=f, file_size=size, **attrs):
+      candidates.append(new_candidate)
 
   def add_empty_file(self,
                      destfile,
@@ -176,7 +294,7 @@ class TarFile(object):
     self.add_empty_file(
         destpath, mode=mode, ids=ids, names=names, kind=tarfile.DIRTYPE)
 
-  def add_tar(self, tar):
+  def add_tar(self, tar, fileobj=None):
     """Merge a tar file into the destination tar file.
 
     All files presents in that tar will be added to the output file
@@ -185,8 +303,10 @@ class TarFile(object):
 
     Args:
       tar: the tar file to add
+      fileobj: if set, a stream of the uncompressed content of the tar file.
     """
-    self.tarfile.add_tar(tar, numeric=True, prefix=self.directory)
+    self.tarfile.add_tar(tar, numeric=True, prefix=self.directory,
+                         fileobj=fileobj)
 
   def add_link(self, symlink, destination, mode=None, ids=None, names=None):
     """Add a symbolic link pointing to `destination`.
@@ -214,7 +334,7 @@ class TarFile(object):
         uname=names[0],
         gname=names[1])
 
-  def add_deb(self, deb):
+  def add_deb(self, deb, fileobj=None):
     """Extract a debian package in the output tar.
 
     All files presents in that debian package will be added to the
@@ -223,21 +343,63 @@ class TarFile(object):
 
     Args:
       deb: the tar file to add
+      fileobj: if set, a stream of the uncompressed content of the data
+        member of the package, see _open_deb_data.
 
     Raises:
       DebError: if the format of the deb archive is incorrect.
     """
+    if fileobj is not None:
+      self.add_tar(deb, fileobj=fileobj)
+      return
+    with self._open_deb_data(deb) as reader:
+      self.add_tar(deb, fileobj=reader)
+
+  @contextlib.contextmanager
+  def _open_deb_data(self, deb):
+    """Opens the uncompressed content of the data member of a package.
+
+    The member is decompressed as it is read from the package, without
+    loading it in memory nor extracting it to a temporary file.
+    """
     with archive.SimpleArReader(deb) as arfile:
-      current = next(arfile)
+      current = arfile.next(read_data=False)
       while current and not current.filename.startswith('data.'):
-        current = next(arfile)
+        current = arfile.next(read_data=False)
       if not current:
         raise self.DebError(deb + ' does not contains a data file!')
-      tmpfile = tempfile.mkstemp(suffix=os.path.splitext(current.filename)[-1])
-      with open(tmpfile[1], 'wb') as f:
-        f.write(current.data)
-      self.add_tar(tmpfile[1])
-      os.remove(tmpfile[1])
+      view = arfile.open_member(current)
+    with view:
+      with prefetch.decompressing_reader(view) as reader:
+        yield reader
+
+  def merge_archives(self, tars, debs, prefetch_inputs=0):
+    """Merge tar files, then debian packages, into the destination tar file.
+
+    Args:
+      tars: the tar files to add, see add_tar.
+      debs: the debian packages to add, see add_deb.
+      prefetch_inputs: how many of the compressed inputs, counting the one
+        being merged, to decompress on background threads. With 0, inputs are
+        decompressed on the thread writing the output.
+    """
+    if prefetch_inputs <= 0:
+      for tar in tars:
+        self.add_tar(tar)
+      for deb in debs:
+        self.add_deb(deb)
+      return
+    # Uncompressed tar files are better read directly, see
+    # TarFileWriter.add_tar.
+    openers = [
+        functools.partial(_open_tar_data, tar)
+        if prefetch.is_compressed(tar) else None for tar in tars
+    ] + [functools.partial(self._open_deb_data, deb) for deb in debs]
+    adders = ([functools.partial(self.add_tar, tar) for tar in tars] +
+              [functools.partial(self.add_deb, deb) for deb in debs])
+    with prefetch.Prefetcher(openers, depth=prefetch_inputs - 1) as prefetcher:
+      for add, stream in zip(adders, prefetcher):
+        add(fileobj=stream)
 
   def add_tree(self, tree_top, destpath, mode=None, ids=None, names=None):
     """Add a tree artifact to the tar file.
@@ -268,34 +430,13 @@ class TarFile(object):
     if names is None:
       names = ('', '')
 
-    to_write = {}
-    for root, dirs, files in os.walk(tree_top):
-      # While `tree_top` uses '/' as a path separator, results returned by
-      # `os.walk` and `os.path.join` on Windows may not.
-      root = normpath(root)
-
-      dirs = sorted(dirs)
-      rel_path_from_top = root[len(tree_top):].lstrip('/')
-      if rel_path_from_top:
-        dest_dir = dest + rel_path_from_top + '/'
-      else:
-        dest_dir = dest
-      for dir in dirs:
-        to_write[dest_dir + dir] = None
-      for file in sorted(files):
-        content_path = os.path.abspath(os.path.join(root, file))
-        if os.name == "nt":
-          # "To specify an extended-length path, use the `\\?\` prefix. For
-          # example, `\\?\D:\very long path`."[1]
-          #
-          # [1]: https://learn.microsoft.com/en-us/windows/win32/fileio/maximum-file-path-limitation
-          to_write[dest_dir + file] = "\\\\?\\" + content_path
-        else:
-          to_write[dest_dir + file] = content_path
-
-    for path in sorted(to_write.keys()):
-      content_path = to_write[path]
-      if not content_path:
+    # Entries come in the sorted order of their paths, while the rest of the
+    # tree is listed in the background.
+    for tree_entry in self.stat_cache.walk_tree(tree_top):
+      if not tree_entry.rel_path:
+        continue
+      path = dest + tree_entry.rel_path
+      if tree_entry.is_dir:
         # This is an intermediate directory. Bazel has no API to specify modes
         # for this, so the least surprising thing we can do is make it the
         # canonical rwxr-xr-x
@@ -305,20 +446,21 @@ class TarFile(object):
             ids=ids,
             names=names,
             kind=tarfile.DIRTYPE)
+        continue
+      content_path = os.path.abspath(tree_entry.path)
+      if os.name == "nt":
+        # "To specify an extended-length path, use the `\\?\` prefix. For
+        # example, `\\?\D:\very long path`."[1]
+        #
+        # [1]: https://learn.microsoft.com/en-us/windows/win32/fileio/maximum-file-path-limitation
+        content_path = "\\\\?\\" + content_path
+      # If mode is unspecified, derive the mode from the file's mode.
+      if mode is None:
+        f_mode = 0o755 if self.stat_cache.is_executable(content_path) else 0o644
       else:
-        # If mode is unspecified, derive the mode from the file's mode.
-        if mode is None:
-          f_mode = 0o755 if os.access(content_path, os.X_OK) else 0o644
-        else:
-          f_mode = mode
-        self.tarfile.add_file(
-            path,
-            file_content=content_path,
-            mode=f_mode,
-            uid=ids[0],
-            gid=ids[1],
-            uname=names[0],
-            gname=names[1])
+        f_mode = mode
+      self._add_file_content(path, content_path, mode=f_mode, ids=ids,
+                             names=names)
 
   def add_manifest_entry(self, entry, file_attributes):
     # Use the pkg_tar mode/owner remapping as a fallback
@@ -374,13 +516,18 @@ def main():
                       help='A tar file to add to the layer')
   parser.add_argument('--deb', action='append',
                       help='A debian package to add to the layer')
+  parser.add_argument(
+      '--prefetch_inputs', type=int, default=2,
+      help='Number of compressed --tar and --deb inputs, counting the one being'
+           ' merged, to decompress on background threads. 0 disables it.')
   parser.add_argument(
       '--directory',
       help='Directory in which to store the file inside the layer')
 
   compression = parser.add_mutually_exclusive_group()
   compression.add_argument('--compression',
-                           help='Compression (`gz` or `bz2`), default is none.')
+                           help='Compression (`gz`, `bz2`, `xz` or `zst`), default'
+                                ' is none.')
   compression.add_argument('--compressor',
                            help='Compressor program and arguments, '
                                 'e.g. `pigz -p 4`')
@@ -424,7 +571,72 @@ def main():
   parser.add_argument(
       '--compression_level', default=-1,
       help='Specify the numeric compress level in gzip mode; may be 0-9 or -1 (default to 6).')
+  parser.add_argument(
+      '--compression_threads', type=int, default=1,
+      help='Number of threads to use for gzip and zstd compression. Values'
+           ' greater than 1 compress independent blocks in parallel, like pigz.')
+  parser.add_argument(
+      '--zstd_long', action='store_true',
+      help='Enable zstd long distance matching.')
+  parser.add_argument(
+      '--deduplicate', action='store_true',
+      help='Store files whose content and metadata are identical to a file'
+           ' already in the archive as hard links to it.')
+  parser.add_argument(
+      '--seekable_index',
+      help='Compress the archive in independent frames and write the index of'
+           ' its members to this file.')
+  parser.add_argument(
+      '--seekable_frame_size', type=int,
+      help='Amount of uncompressed data in each frame of a seekable archive.')
+  parser.add_argument(
+      '--estargz', action='store_true',
+      help='Write an eStargz archive: a .tar.gz in which single files can be'
+           ' located and fetched with the table of contents at its end.')
+  parser.add_argument(
+      '--estargz_toc_digest',
+      help='With --estargz, write the digest of the table of contents to this'
+           ' file.')
+  parser.add_argument(
+      '--extra_output', action='append',
+      help='Also write the archive to another file, with another compression,'
+           ' e.g. path/to/file.tar.zst=zst. The compression may be empty.')
+  parser.add_argument(
+      '--split_size', type=int,
+      help='Split the archive in volumes of at most this many bytes of'
+           ' uncompressed tar stream, starting new volumes between members.')
+  parser.add_argument(
+      '--split_dir',
+      help='With --split_size, directory of the volumes after the first one,'
+           ' which is --output.')
+  parser.add_argument(
+      '--split_index',
+      help='With --split_size, write the list of the volumes and the volume of'
+           ' each member to this file.')
+  parser.add_argument(
+      '--diff_base',
+      help='Write the archive as an OCI layer on top of this tar file: only'
+           ' the members which are new or changed, and whiteouts for the'
+           ' members of the base which are gone.')
+  parser.add_argument(
+      '--digests_file',
+      help='Write the digests of the outputs, and of their uncompressed tar'
+           ' stream, computed while they are written, to this JSON file.')
+  parser.add_argument(
+      '--digest_algorithms', type=hashing_writer.parse_algorithms,
+      default=list(hashing_writer.DEFAULT_ALGORITHMS),
+      help='With --digests_file, comma separated list of the digests to'
+           ' compute, e.g. sha256,sha512.')
+  parser.add_argument(
+      '--stats', action='store_true',
+      help='Print statistics about the archive creation when done.')
   options = parser.parse_args()
+  if options.split_size and options.deduplicate:
+    # A hard link to a file of another volume would not resolve when its
+    # volume is extracted alone.
+    parser.error('--deduplicate can not be used with --split_size')
+  if options.split_dir:
+    os.makedirs(options.split_dir, exist_ok=True)
 
   # Parse modes arguments
   default_mode = None
@@ -471,6 +683,12 @@ def main():
   if options.compression_level:
     compression_level = int(options.compression_level)
 
+  extra_outputs = []
+  if options.extra_output:
+    for extra_output in options.extra_output:
+      extra_outputs.append(
+          helpers.SplitNameValuePairAtSeparator(extra_output, '='))
+
   # Add objects to the tar file
   with TarFile(
       options.output,
@@ -482,7 +700,21 @@ def main():
       allow_dups_from_deps=options.allow_dups_from_deps,
       compression_level = compression_level,
       preserve_mode = options.preserve_mode,
-      preserve_mtime = options.preserve_mtime) as output:
+      preserve_mtime = options.preserve_mtime,
+      compression_threads = options.compression_threads,
+      zstd_long = options.zstd_long,
+      deduplicate = options.deduplicate,
+      seekable_index = options.seekable_index,
+      seekable_frame_size = options.seekable_frame_size,
+      estargz = options.estargz,
+      estargz_toc_digest = options.estargz_toc_digest,
+      extra_outputs = extra_outputs,
+      split_size = options.split_size,
+      split_dir = options.split_dir,
+      split_index = options.split_index,
+      diff_base = options.diff_base,
+      digests_file = options.digests_file,
+      digest_algorithms = options.digest_algorithms) as output:
 
     def file_attributes(filename):
       if filename.startswith('/'):
@@ -497,10 +729,17 @@ def main():
       for entry in manifest.read_entries_from(options.manifest):
         output.add_manifest_entry(entry, file_attributes)
 
-    for tar in options.tar or []:
-      output.add_tar(tar)
-    for deb in options.deb or []:
-      output.add_deb(deb)
+    output.merge_archives(options.tar or [], options.deb or [],
+                          prefetch_inputs=options.prefetch_inputs)
+
+  if options.stats:
+    rss = tar_writer.peak_rss()
+    if rss is not None:
+      output.stats['peak_rss_bytes'] = rss
+    output.stats.update(output.stat_cache.stats)
+    output.stats.update(output.tarfile.stats)
+    for key, value in sorted(output.stats.items()):
+      print('%s: %s: %s' % (options.output, key, value))
 
 
 if __name__ == '__main__':
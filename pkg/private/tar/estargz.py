@@ -0,0 +1,153 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Table of contents of eStargz archives.
+
+eStargz is a .tar.gz layout that lets container snapshotters fetch single
+files of an image layer. The payload of each regular file, cut in chunks,
+starts a new gzip member. A tar member named stargz.index.json, in its own
+gzip member at the end of the archive, lists the entries of the archive with
+the compressed offset and the digest of each chunk. A fixed size footer,
+an empty gzip member, points to it.
+
+See https://github.com/containerd/stargz-snapshotter/blob/main/docs/estargz.md
+"""
+
+import datetime
+import json
+import posixpath
+import struct
+import tarfile
+
+TOC_TAR_NAME = 'stargz.index.json'
+
+TOC_VERSION = 1
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+FOOTER_SIZE = 51
+
+_TYPES = {
+    tarfile.REGTYPE: 'reg',
+    tarfile.AREGTYPE: 'reg',
+    tarfile.CONTTYPE: 'reg',
+    tarfile.DIRTYPE: 'dir',
+    tarfile.SYMTYPE: 'symlink',
+    tarfile.LNKTYPE: 'hardlink',
+    tarfile.CHRTYPE: 'char',
+    tarfile.BLKTYPE: 'block',
+    tarfile.FIFOTYPE: 'fifo',
+}
+
+# Fields of the TOC entries, in the order of the reference implementation.
+# Empty and zero values are omitted.
+_FIELDS = ('name', 'type', 'size', 'modtime', 'linkName', 'mode', 'uid', 'gid',
+           'userName', 'groupName', 'offset', 'devMajor', 'devMinor',
+           'numLink', 'digest', 'chunkOffset', 'chunkSize', 'chunkDigest')
+
+
+def _clean_name(name):
+  """Returns name without leading '/' or './', nor trailing '/'."""
+  return posixpath.normpath('/' + name).lstrip('/')
+
+
+def footer(toc_offset):
+  """Returns the footer pointing to the TOC gzip member at toc_offset."""
+  subfield = b'%016xSTARGZ' % toc_offset
+  extra = b'SG' + struct.pack('<H', len(subfield)) + subfield
+  # An empty gzip member with the extra field, like Go's gzip writer does it
+  # with NoCompression.
+  return (b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff' +
+          struct.pack('<H', len(extra)) + extra +
+          b'\x01\x00\x00\xff\xff' + b'\x00' * 8)
+
+
+class TOC(object):
+  """Collects the entries of the table of contents of an archive."""
+
+  def __init__(self):
+    self._entries = []
+    # Regular file entries by name, to count their hard links.
+    self._files = {}
+
+  def add(self, info):
+    """Adds the entry of a tar member, before its payload is written.
+
+    Returns:
+      The entry, None if the member is not listed.
+    """
+    name = _clean_name(info.name)
+    kind = _TYPES.get(info.type)
+    if not name or kind is None:
+      return None
+    entry = {
+        'name': name,
+        'type': kind,
+        'modtime': datetime.datetime.fromtimestamp(
+            int(info.mtime), datetime.timezone.utc).strftime(
+                '%Y-%m-%dT%H:%M:%SZ'),
+        'mode': info.mode & 0o7777,
+        'uid': info.uid,
+        'gid': info.gid,
+        'userName': info.uname,
+        'groupName': info.gname,
+    }
+    if kind == 'reg':
+      entry['size'] = info.size
+      entry['numLink'] = 1
+      self._files[name] = entry
+    elif kind == 'symlink':
+      entry['linkName'] = info.linkname
+    elif kind == 'hardlink':
+      entry['linkName'] = _clean_name(info.linkname)
+      target = self._files.get(entry['linkName'])
+      if target is not None:
+        target['numLink'] += 1
+    elif kind in ('char', 'block'):
+      entry['devMajor'] = info.devmajor
+      entry['devMinor'] = info.devminor
+    self._entries.append(entry)
+    return entry
+
+  def add_chunk(self, entry, offset, chunk_offset, chunk_size, chunk_digest,
+                partial):
+    """Records a chunk of the payload of a regular file entry.
+
+    Args:
+      entry: the entry of the file, as returned by add().
+      offset: offset in the archive of the gzip member holding the chunk.
+      chunk_offset: offset of the chunk in the file.
+      chunk_size: size of the chunk.
+      chunk_digest: sha256 hex digest of the chunk.
+      partial: whether the chunk is smaller than the chunk size. Its size is
+          then not recorded, as it extends to the end of the file.
+    """
+    if chunk_offset:
+      entry = {'name': entry['name'], 'type': 'chunk'}
+      self._entries.append(entry)
+    entry['offset'] = offset
+    entry['chunkOffset'] = chunk_offset
+    if not partial:
+      entry['chunkSize'] = chunk_size
+    entry['chunkDigest'] = 'sha256:' + chunk_digest
+
+  @staticmethod
+  def set_digest(entry, digest):
+    """Records the sha256 hex digest of the whole content of a file."""
+    entry['digest'] = 'sha256:' + digest
+
+  def to_json(self):
+    """Returns the table of contents, as bytes."""
+    entries = [{k: e[k] for k in _FIELDS if e.get(k)} for e in self._entries]
+    return json.dumps({'version': TOC_VERSION, 'entries': entries},
+                      indent='\t').encode('utf-8')
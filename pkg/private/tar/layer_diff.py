@@ -0,0 +1,178 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Differences of an archive to a base archive, as an OCI layer.
+
+An OCI image layer applied on top of a base only needs the members which are
+new or changed, and whiteouts for the members of the base which are gone: an
+empty file named `.wh.<name>` in the directory of the removed path. Members
+are compared by their metadata and the sha256 digest of their content.
+
+See https://github.com/opencontainers/image-spec/blob/main/layer.md
+"""
+
+import hashlib
+import posixpath
+import tarfile
+import tempfile
+
+WHITEOUT_PREFIX = '.wh.'
+
+# Content of the new archive up to this size is spooled in memory, when it
+# must be read to be compared but can not be read again.
+_SPOOL_SIZE = 16 * 1024 * 1024
+
+_READ_SIZE = 1024 * 1024
+
+
+def normalize(name):
+  """Returns the path of a member, as '/a/b' whatever its spelling."""
+  return posixpath.normpath('/' + name)
+
+
+def _metadata(info):
+  linkname = info.linkname
+  if info.type == tarfile.LNKTYPE:
+    linkname = normalize(linkname)
+  return (info.type, info.mode & 0o7777, info.uid, info.gid, info.uname,
+          info.gname, int(info.mtime), info.size if info.isreg() else 0,
+          linkname, info.devmajor, info.devminor)
+
+
+def _seekable(fileobj):
+  """Tells whether fileobj can be read again after it was read."""
+  try:
+    return fileobj.seekable()
+  except (AttributeError, OSError, ValueError):
+    # Members of tar files opened as streams have no seekable() of their own.
+    # io.UnsupportedOperation is both an OSError and a ValueError.
+    return False
+
+
+def _digest(fileobj, size):
+  """Returns the sha256 digest of the next `size` bytes of fileobj."""
+  digest = hashlib.sha256()
+  while size > 0:
+    data = fileobj.read(min(size, _READ_SIZE))
+    if not data:
+      raise OSError('unexpected end of data')
+    digest.update(data)
+    size -= len(data)
+  return digest.digest()
+
+
+class BaseIndex(object):
+  """The members of a base archive, to find what another archive changes.
+
+  The base is scanned once, as a stream: only the metadata and the digest of
+  each member are kept, not their content.
+  """
+
+  def __init__(self):
+    # Normalized path to (name, metadata, digest), in the order of the base.
+    self._entries = {}
+    # Normalized paths of the members of the new archive which differ from
+    # the base. Hard links to them changed as well.
+    self._changed = set()
+
+  def add(self, info, fileobj=None):
+    """Adds a member of the base archive, with its content if it is a file."""
+    digest = None
+    if info.isreg() and fileobj is not None:
+      digest = _digest(fileobj, info.size)
+    self._entries[normalize(info.name)] = (info.name, _metadata(info), digest)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def match(self, info, fileobj=None):
+    """Compares a member of the new archive to the base.
+
+    Args:
+      info: the tarfile.TarInfo of the member.
+      fileobj: the content of the member, positioned at its start.
+
+    Returns:
+      (unchanged, fileobj): whether the base has the same member, and a file
+      object to read the content of the member from instead of `fileobj`,
+      which may have been read to compute its digest.
+    """
+    key = normalize(info.name)
+    entry = self._entries.get(key)
+    unchanged = entry is not None and entry[1] == _metadata(info)
+    if unchanged and info.type == tarfile.LNKTYPE:
+      unchanged = normalize(info.linkname) not in self._changed
+    if unchanged and info.isreg() and fileobj is not None:
+      if _seekable(fileobj):
+        start = fileobj.tell()
+        digest = _digest(fileobj, info.size)
+        fileobj.seek(start)
+      else:
+        # Keep the content, in case it has to be written.
+        spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+        digest = hashlib.sha256()
+        size = info.size
+        while size > 0:
+          data = fileobj.read(min(size, _READ_SIZE))
+          if not data:
+            raise OSError('unexpected end of data')
+          digest.update(data)
+          spool.write(data)
+          size -= len(data)
+        spool.seek(0)
+        fileobj = spool
+        digest = digest.digest()
+      unchanged = digest == entry[2]
+    if not unchanged:
+      self._changed.add(key)
+    return unchanged, fileobj
+
+  def whiteouts(self, present):
+    """Returns the whiteouts of the members of the base which are gone.
+
+    A path gets a whiteout if it is not in the new archive, nor an ancestor
+    of a path there. The members under a path which got a whiteout, or which
+    the new archive replaced by something other than a directory, are
+    removed with it and get none. Directories are never made opaque.
+
+    Args:
+      present: dict of the normalized paths of the new archive to their type.
+
+    Returns:
+      The names of the whiteouts, in the order of the base.
+    """
+    ancestors = set()
+    for path in present:
+      parent = posixpath.dirname(path)
+      while parent not in ancestors and parent != '/':
+        ancestors.add(parent)
+        parent = posixpath.dirname(parent)
+    removed = set()
+    whiteouts = []
+    for key, (name, _, _) in self._entries.items():
+      if key == '/' or key in present or key in ancestors:
+        continue
+      parent = posixpath.dirname(key)
+      covered = False
+      while parent != '/':
+        if (parent in removed or
+            present.get(parent, tarfile.DIRTYPE) != tarfile.DIRTYPE):
+          covered = True
+          break
+        parent = posixpath.dirname(parent)
+      if covered:
+        continue
+      removed.add(key)
+      dir_name, base_name = posixpath.split(name.rstrip('/'))
+      whiteouts.append(posixpath.join(dir_name, WHITEOUT_PREFIX + base_name))
+    return whiteouts
@@ -0,0 +1,185 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Multi-threaded gzip writer.
+
+This is the same idea as pigz: the input is cut into fixed size blocks, each
+block is deflated independently on a thread pool (zlib releases the GIL), and
+the results are concatenated in order into a single standard gzip member.
+Each block is primed with the last 32 KiB of the previous block so the
+compression ratio stays close to that of a single stream.
+
+The block boundaries depend only on the block size, so the output is
+byte-for-byte reproducible for a given compression level, whatever the
+number of threads used.
+"""
+
+import collections
+import concurrent.futures
+import os
+import struct
+import zlib
+
+# Default amount of uncompressed data handed to a worker at once.
+DEFAULT_BLOCK_SIZE = 128 * 1024
+
+# Size of the deflate window, which is what we carry over between blocks.
+_DICT_SIZE = 32 * 1024
+
+# Same values as the gzip module, used to fill the XFL header byte.
+_COMPRESS_LEVEL_FAST = 1
+_COMPRESS_LEVEL_BEST = 9
+
+_FNAME = 0x08
+
+
+def gzip_header(filename=None, mtime=0, compresslevel=6):
+  """Returns a gzip member header, laid out exactly like gzip.GzipFile does.
+
+  Args:
+    filename: name to record in the FNAME field. A trailing '.gz' is dropped,
+        and names that can not be encoded as latin-1 are omitted.
+    mtime: modification time to record in the header.
+    compresslevel: compression level, only used to set the XFL byte.
+  """
+  fname = b''
+  if filename:
+    try:
+      fname = os.path.basename(filename)
+      if not isinstance(fname, bytes):
+        fname = fname.encode('latin-1')
+      if fname.endswith(b'.gz'):
+        fname = fname[:-3]
+    except UnicodeEncodeError:
+      fname = b''
+  if compresslevel == _COMPRESS_LEVEL_BEST:
+    xfl = 2
+  elif compresslevel == _COMPRESS_LEVEL_FAST:
+    xfl = 4
+  else:
+    xfl = 0
+  header = struct.pack('<2sBBIBB', b'\037\213', 8, _FNAME if fname else 0,
+                       int(mtime) & 0xffffffff, xfl, 255)
+  if fname:
+    header += fname + b'\000'
+  return header
+
+
+def gzip_trailer(crc, size):
+  """Returns the gzip member trailer for the given CRC32 and input size."""
+  return struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+
+
+def _deflate_block(data, level, zdict):
+  """Deflates one block, ending it on a byte boundary."""
+  if zdict:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                  zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                  zdict)
+  else:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+  """A write-only file object producing a gzip stream on several threads."""
+
+  def __init__(self, filename=None, compresslevel=6, mtime=0, threads=None,
+               fileobj=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Create the writer.
+
+    Args:
+      filename: the output file name. Also recorded in the gzip header.
+      compresslevel: zlib compression level, 0-9.
+      mtime: modification time recorded in the gzip header.
+      threads: number of compression threads, default to the number of CPUs.
+      fileobj: if set, write to this file object instead of opening
+          `filename`. The caller remains responsible for closing it.
+      block_size: amount of uncompressed data compressed by each task.
+    """
+    if fileobj is None:
+      self.fileobj = open(filename, 'wb')
+      self._close_fileobj = True
+    else:
+      self.fileobj = fileobj
+      self._close_fileobj = False
+    self.compresslevel = compresslevel
+    self.block_size = block_size
+    self.threads = threads or os.cpu_count() or 1
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=self.threads)
+    # Keep a few blocks in flight per thread so workers never starve, but
+    # bound it so memory does not grow with the size of the input.
+    self._max_pending = 2 * self.threads
+    self._pending = collections.deque()
+    self._buffer = bytearray()
+    self._dict = b''
+    self._crc = 0
+    self._size = 0
+    self.closed = False
+    self.fileobj.write(gzip_header(filename, mtime, compresslevel))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
+
+  def writable(self):
+    return True
+
+  def tell(self):
+    """Returns the uncompressed position, as gzip.GzipFile does."""
+    return self._size
+
+  def write(self, data):
+    if self.closed:
+      raise ValueError('write() on closed ParallelGzipWriter')
+    self._crc = zlib.crc32(data, self._crc)
+    self._size += len(data)
+    self._buffer += data
+    while len(self._buffer) >= self.block_size:
+      block = bytes(self._buffer[:self.block_size])
+      del self._buffer[:self.block_size]
+      self._submit(block)
+    return len(data)
+
+  def _submit(self, block):
+    self._pending.append(self._executor.submit(
+        _deflate_block, block, self.compresslevel, self._dict))
+    self._dict = block[-_DICT_SIZE:]
+    while len(self._pending) > self._max_pending:
+      self.fileobj.write(self._pending.popleft().result())
+
+  def flush(self):
+    self.fileobj.flush()
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    try:
+      if self._buffer:
+        self._submit(bytes(self._buffer))
+        self._buffer = bytearray()
+      while self._pending:
+        self.fileobj.write(self._pending.popleft().result())
+      # An empty final block terminates the deflate stream.
+      self.fileobj.write(
+          zlib.compressobj(self.compresslevel, zlib.DEFLATED,
+                           -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+      self.fileobj.write(gzip_trailer(self._crc, self._size))
+    finally:
+      self._executor.shutdown()
+      if self._close_fileobj:
+        self.fileobj.close()
@@ -0,0 +1,177 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Index of the paths added to an archive."""
+
+import sys
+
+
+class _Node(object):
+  """A path component that has children in the index."""
+
+  __slots__ = ('kind', 'children', 'complete')
+
+  def __init__(self, kind=None):
+    # Type of the archive member at this path, None if there is none.
+    self.kind = kind
+    # Child component to either a _Node, or the type of a member without
+    # children.
+    self.children = {}
+    # True once all the ancestors of this path are known to be members.
+    self.complete = False
+
+
+class PathIndex(object):
+  """Maps '/' delimited paths to the type of the archive member there.
+
+  Paths are stored as a tree of their components, so common prefixes are
+  stored once and directory names are interned. Members without children cost
+  a single dictionary entry. The directory of the last lookup is cached,
+  which makes lookups for files added directory by directory O(1). The tree
+  also answers which ancestors of a path are not members yet without building
+  the intermediate path strings.
+
+  Keys are compared component by component, so this behaves exactly like a
+  dictionary keyed by the path strings.
+  """
+
+  def __init__(self, implicit_ancestors=()):
+    """Create an empty index.
+
+    Args:
+      implicit_ancestors: ancestors, with a trailing '/', that
+          missing_ancestors() never returns.
+    """
+    self._root = _Node()
+    self._size = 0
+    self._implicit_ancestors = frozenset(implicit_ancestors)
+    self._cached_dir = None
+    self._cached_node = None
+
+  def _dir_node(self, dir_path, create=False):
+    """Returns the _Node of a directory path, or None if it is not there."""
+    if dir_path is None:
+      return self._root
+    if dir_path == self._cached_dir:
+      return self._cached_node
+    node = self._root
+    for component in dir_path.split('/'):
+      child = node.children.get(component)
+      if child is None or not isinstance(child, _Node):
+        if not create:
+          return None
+        # Either a new directory, or a member getting its first child.
+        child = _Node(child)
+        node.children[sys.intern(component)] = child
+      node = child
+    self._cached_dir = dir_path
+    self._cached_node = node
+    return node
+
+  @staticmethod
+  def _split(path):
+    dir_path, sep, name = path.rpartition('/')
+    return (dir_path if sep else None), name
+
+  def get(self, path, default=None):
+    """Returns the type of the member at path, or default."""
+    dir_path, name = self._split(path)
+    parent = self._dir_node(dir_path)
+    if parent is None:
+      return default
+    entry = parent.children.get(name)
+    if isinstance(entry, _Node):
+      entry = entry.kind
+    return default if entry is None else entry
+
+  def __contains__(self, path):
+    return self.get(path) is not None
+
+  def __setitem__(self, path, kind):
+    dir_path, name = self._split(path)
+    parent = self._dir_node(dir_path, create=True)
+    entry = parent.children.get(name)
+    if isinstance(entry, _Node):
+      if entry.kind is None:
+        self._size += 1
+      entry.kind = kind
+    else:
+      if entry is None:
+        self._size += 1
+      # File names are mostly unique, interning them would only cost memory.
+      parent.children[name] = kind
+
+  def __len__(self):
+    return self._size
+
+  def missing_ancestors(self, path):
+    """Returns the ancestors of path that are not members.
+
+    An ancestor with a trailing empty component, like 'a//', names the same
+    directory as 'a/' and is only returned if that one is missing and was not
+    returned already.
+
+    Args:
+      path: a '/' delimited path.
+
+    Returns:
+      The list of the missing ancestors, outermost first, each with a trailing
+      '/'. For example ['a/', 'a/b/'] for 'a/b/c' in an empty index.
+    """
+    dir_path, _ = self._split(path)
+    if dir_path is None:
+      return []
+    parent = self._dir_node(dir_path)
+    if parent is not None and parent.complete:
+      return []
+    components = dir_path.split('/')
+    missing = []
+    node = self._root
+    kind = None
+    # Position of the component naming the directory of the current ancestor,
+    # and of the last one returned.
+    named = reported = -1
+    for i, component in enumerate(components):
+      if isinstance(node, _Node):
+        node = node.children.get(component)
+      else:
+        node = None
+      if component or i == 0:
+        kind = node.kind if isinstance(node, _Node) else node
+        named = i
+      if kind is not None or named == reported:
+        continue
+      ancestor = '/'.join(components[:i + 1]) + '/'
+      if ancestor not in self._implicit_ancestors:
+        missing.append(ancestor)
+        reported = named
+    if not missing and parent is not None:
+      parent.complete = True
+    return missing
+
+  def keys(self):
+    """Yields the paths of all the members."""
+    stack = [(self._root, None)]
+    while stack:
+      node, path = stack.pop()
+      for component, child in node.children.items():
+        child_path = component if path is None else path + '/' + component
+        if isinstance(child, _Node):
+          if child.kind is not None:
+            yield child_path
+          stack.append((child, child_path))
+        else:
+          yield child_path
+
+  def __iter__(self):
+    return self.keys()
@@ -0,0 +1,168 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Feed a compression command from a dedicated thread.
+
+Writing the tar stream straight to the stdin of a compression command makes
+the archiver wait whenever the pipe is full, and the compressor wait whenever
+the archiver reads inputs or encodes headers. The PipeWriter queues the
+stream in a bounded buffer, written to an enlarged pipe by a thread of its
+own, so both sides work at the same time. It also measures how long each
+side waited for the other.
+"""
+
+import collections
+import queue
+import sys
+import threading
+import time
+
+try:
+  import fcntl  # pylint: disable=g-import-not-at-top
+  HAS_FCNTL = True
+except ImportError:
+  HAS_FCNTL = False
+
+# Size requested for the pipe to the compressor. Linux pipes hold 64 KiB by
+# default, and unprivileged processes may grow them up to
+# /proc/sys/fs/pipe-max-size, 1 MiB by default.
+PIPE_SIZE = 1024 * 1024
+
+# Amount of data queued at once for the writer thread.
+CHUNK_SIZE = 256 * 1024
+
+# Number of chunks buffered ahead of the compressor.
+BUFFERED_CHUNKS = 64
+
+# Value of fcntl.F_SETPIPE_SZ on Linux, which Python only defines since 3.10.
+_F_SETPIPE_SZ = 1031
+
+# Marks the end of the data in the queue.
+_EOF = object()
+
+
+def resize_pipe(fd, size=PIPE_SIZE):
+  """Grows the buffer of a pipe, where the platform allows it.
+
+  Args:
+    fd: file descriptor of either end of the pipe.
+    size: the requested size, in bytes.
+
+  Returns:
+    The new size of the pipe, or None if it could not be changed.
+  """
+  if not HAS_FCNTL or not sys.platform.startswith('linux'):
+    return None
+  try:
+    return fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', _F_SETPIPE_SZ),
+                       size)
+  except OSError:
+    # Over the limit of the system, or not a pipe.
+    return None
+
+
+class PipeWriter(object):
+  """A write-only file object writing to a pipe from a dedicated thread.
+
+  Errors of the writer thread, like a broken pipe, are raised by the next
+  call to write() or close().
+
+  Attributes:
+    stats: collections.Counter of the seconds spent by the producer waiting
+        for room in the buffer ('pipe_producer_wait_seconds'), and by the
+        writer thread waiting for data ('pipe_writer_idle_seconds') and
+        blocked writing to the pipe ('pipe_write_seconds'), once closed.
+  """
+
+  def __init__(self, pipe, chunk_size=CHUNK_SIZE,
+               buffered_chunks=BUFFERED_CHUNKS):
+    """Start the writer thread.
+
+    Args:
+      pipe: the binary file object to write to, closed by close().
+      chunk_size: amount of data queued for the writer thread at once.
+      buffered_chunks: number of chunks queued before write() blocks.
+    """
+    self._pipe = pipe
+    self._chunk_size = chunk_size
+    self._buffer = bytearray()
+    self._queue = queue.Queue(maxsize=buffered_chunks)
+    self._error = None
+    self._closed = False
+    self._producer_wait = 0.0
+    self._writer_idle = 0.0
+    self._write_time = 0.0
+    self.stats = collections.Counter()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    try:
+      while True:
+        start = time.monotonic()
+        chunk = self._queue.get()
+        received = time.monotonic()
+        self._writer_idle += received - start
+        if chunk is _EOF:
+          return
+        self._pipe.write(chunk)
+        self._write_time += time.monotonic() - received
+    except BaseException as e:  # pylint: disable=broad-except
+      self._error = e
+      # Keep consuming, so that the producer never blocks on a full queue.
+      while self._queue.get() is not _EOF:
+        pass
+
+  def _put(self, item):
+    if self._error is not None:
+      raise self._error
+    start = time.monotonic()
+    self._queue.put(item)
+    self._producer_wait += time.monotonic() - start
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    self._buffer += data
+    if len(self._buffer) >= self._chunk_size:
+      self._put(bytes(self._buffer))
+      self._buffer = bytearray()
+    return len(data)
+
+  def flush(self):
+    """Queues the buffered data, without waiting for it to be written."""
+    if self._buffer:
+      self._put(bytes(self._buffer))
+      self._buffer = bytearray()
+
+  def close(self):
+    """Writes the remaining data, then closes the pipe."""
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      self.flush()
+    finally:
+      self._queue.put(_EOF)
+      self._thread.join()
+      self.stats['pipe_producer_wait_seconds'] = round(self._producer_wait, 3)
+      self.stats['pipe_writer_idle_seconds'] = round(self._writer_idle, 3)
+      self.stats['pipe_write_seconds'] = round(self._write_time, 3)
+      try:
+        self._pipe.close()
+      except BrokenPipeError:
+        if self._error is None:
+          raise
+    if self._error is not None:
+      raise self._error
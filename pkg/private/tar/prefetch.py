@@ -0,0 +1,261 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decompress upcoming input archives in the background.
+
+When merging several compressed archives, the output writer would otherwise
+alternate between decompressing an input and compressing the output. The
+Prefetcher decompresses the next few inputs on worker threads into bounded
+buffers while the current one is consumed. gzip, bz2, lzma and zstandard all
+release the GIL while they work, so threads are enough to overlap them.
+"""
+
+import bz2
+import gzip
+import queue
+import shutil
+import subprocess
+import threading
+
+try:
+  import lzma  # pylint: disable=g-import-not-at-top
+  HAS_LZMA = True
+except ImportError:
+  HAS_LZMA = False
+
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+  HAS_ZSTD = True
+except ImportError:
+  HAS_ZSTD = False
+
+# Amount of decompressed data moved between threads at once.
+CHUNK_SIZE = 1024 * 1024
+
+# Number of chunks buffered for each input ahead of the reader.
+BUFFERED_CHUNKS = 16
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_BZ2_MAGIC = b'BZh'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Marks the end of the data in the queue of a PrefetchedStream.
+_EOF = object()
+
+
+def decompressing_reader(fileobj):
+  """Returns a reader of the decompressed content of fileobj.
+
+  The compression is recognized from the first bytes of the file. If it is not
+  compressed, fileobj is returned as is.
+
+  Args:
+    fileobj: a seekable binary file object, positioned at its start.
+
+  Returns:
+    A readable file object.
+
+  Raises:
+    ValueError: if the data is xz compressed and lzma is not available.
+  """
+  magic = fileobj.read(len(_XZ_MAGIC))
+  fileobj.seek(-len(magic), 1)
+  if magic.startswith(_GZIP_MAGIC):
+    return gzip.GzipFile(fileobj=fileobj, mode='rb')
+  if magic.startswith(_BZ2_MAGIC):
+    return bz2.BZ2File(fileobj, mode='rb')
+  if magic.startswith(_XZ_MAGIC):
+    if not HAS_LZMA:
+      raise ValueError('lzma is not available to decompress xz data')
+    return lzma.LZMAFile(fileobj, mode='rb')
+  if magic.startswith(_ZSTD_MAGIC):
+    if HAS_ZSTD:
+      return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return _ZstdProcessReader(fileobj)
+  return fileobj
+
+
+def is_compressed(path):
+  """Returns true if the file starts with a known compression magic number."""
+  with open(path, 'rb') as f:
+    magic = f.read(len(_XZ_MAGIC))
+  return any(magic.startswith(m)
+             for m in (_GZIP_MAGIC, _BZ2_MAGIC, _XZ_MAGIC, _ZSTD_MAGIC))
+
+
+class _ZstdProcessReader(object):
+  """Decompresses a file object with the zstd command line tool."""
+
+  def __init__(self, fileobj):
+    self._proc = subprocess.Popen(['zstd', '-q', '-d', '-c'],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+    self._feeder = threading.Thread(target=self._feed, args=(fileobj,),
+                                    daemon=True)
+    self._feeder.start()
+
+  def _feed(self, fileobj):
+    try:
+      shutil.copyfileobj(fileobj, self._proc.stdin, CHUNK_SIZE)
+    except BrokenPipeError:
+      pass
+    finally:
+      try:
+        self._proc.stdin.close()
+      except BrokenPipeError:
+        pass
+
+  def read(self, size=-1):
+    return self._proc.stdout.read(size)
+
+  def close(self):
+    self._proc.stdout.close()
+    self._feeder.join()
+    if self._proc.wait() != 0 and self._proc.returncode != -13:
+      raise IOError('zstd failed to decompress the input')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
+
+
+class PrefetchedStream(object):
+  """A read-only file object filled by a background thread.
+
+  The thread calls `opener` to get a file object, and copies its content into
+  a bounded queue. Errors raised by the thread are raised again by read().
+  """
+
+  def __init__(self, opener, buffered_chunks=BUFFERED_CHUNKS):
+    self._opener = opener
+    self._queue = queue.Queue(maxsize=buffered_chunks)
+    self._cancelled = threading.Event()
+    self._chunk = b''
+    self._offset = 0
+    self._eof = False
+    self.closed = False
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    try:
+      with self._opener() as source:
+        while not self._cancelled.is_set():
+          chunk = source.read(CHUNK_SIZE)
+          if not chunk:
+            break
+          self._queue.put(chunk)
+    except BaseException as e:  # pylint: disable=broad-except
+      self._queue.put(e)
+    finally:
+      self._queue.put(_EOF)
+
+  def readable(self):
+    return True
+
+  def read(self, size=-1):
+    if self.closed:
+      raise ValueError('read() on closed PrefetchedStream')
+    parts = []
+    while size != 0 and not self._eof:
+      if self._offset == len(self._chunk):
+        item = self._queue.get()
+        if item is _EOF:
+          self._eof = True
+          break
+        if isinstance(item, BaseException):
+          self._eof = True
+          raise item
+        self._chunk = item
+        self._offset = 0
+      end = len(self._chunk) if size < 0 else min(len(self._chunk),
+                                                  self._offset + size)
+      parts.append(self._chunk[self._offset:end])
+      if size > 0:
+        size -= end - self._offset
+      self._offset = end
+    return b''.join(parts)
+
+  def close(self):
+    """Stops the background thread, dropping the data not read yet."""
+    if self.closed:
+      return
+    self.closed = True
+    self._cancelled.set()
+    while self._thread.is_alive():
+      # Make room in the queue in case the thread is waiting on it.
+      try:
+        while True:
+          self._queue.get_nowait()
+      except queue.Empty:
+        pass
+      self._thread.join(0.01)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
+
+
+class Prefetcher(object):
+  """Iterates over input streams, opening the next ones in the background.
+
+  Usage:
+    with Prefetcher(openers, depth=2) as prefetcher:
+      for stream in prefetcher:
+        ...
+
+  Each opener is either None or a callable returning a readable file object.
+  The iteration yields, in order, None for the None openers and a
+  PrefetchedStream for the others. The streams of the `depth` inputs after the
+  current one are filled in the background, and each stream is closed when
+  the iteration moves to the next one.
+  """
+
+  def __init__(self, openers, depth=2, buffered_chunks=BUFFERED_CHUNKS):
+    self._openers = list(openers)
+    self._depth = depth
+    self._buffered_chunks = buffered_chunks
+    self._streams = {}
+
+  def _start(self, index):
+    if index < len(self._openers) and index not in self._streams:
+      opener = self._openers[index]
+      self._streams[index] = opener and PrefetchedStream(
+          opener, self._buffered_chunks)
+
+  def __iter__(self):
+    for index in range(len(self._openers)):
+      for ahead in range(index, index + self._depth + 1):
+        self._start(ahead)
+      stream = self._streams[index]
+      yield stream
+      del self._streams[index]
+      if stream:
+        stream.close()
+
+  def close(self):
+    for stream in self._streams.values():
+      if stream:
+        stream.close()
+    self._streams.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
@@ -0,0 +1,277 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Seekable compressed tar files.
+
+A seekable tar file is compressed as a sequence of independent frames, gzip
+members or zstd frames, each starting on a member header. Decompressors read
+it as any other compressed tar file. An index, written next to it as JSON,
+gives the compressed offset of the frame holding the header of each member,
+and the position of the header in the frame. A member is read by decompressing
+from its frame, rather than from the start of the archive.
+
+The index looks like:
+  {
+    "version": 1,
+    "compression": "gz",
+    "members": [
+      [name, type, size, frame_offset, offset_in_frame],
+      ...
+    ]
+  }
+"""
+
+import gzip
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+  HAS_ZSTD = True
+except ImportError:
+  HAS_ZSTD = False
+
+INDEX_VERSION = 1
+
+# Amount of uncompressed data after which a new frame starts. Each frame costs
+# a few bytes and loses the compression context, while reading a member costs
+# decompressing up to a frame of data before it.
+DEFAULT_FRAME_SIZE = 4 * 1024 * 1024
+
+_SKIP_BUFFER_SIZE = 64 * 1024
+
+
+def _has_fileno(fileobj):
+  try:
+    fileobj.fileno()
+    return True
+  except (AttributeError, OSError, ValueError):
+    # io.UnsupportedOperation is both an OSError and a ValueError.
+    return False
+
+
+class ProcessFrame(object):
+  """Compresses one frame with a command reading stdin and writing stdout.
+
+  The command writes straight to the output file if it has a file descriptor.
+  Otherwise, e.g. for a hashing_writer.HashingWriter, its output is copied
+  there from a pipe.
+  """
+
+  def __init__(self, cmd, fileobj):
+    self._cmd = cmd
+    self._fileobj = fileobj
+    self._copy_thread = None
+    fileobj.flush()
+    if _has_fileno(fileobj):
+      self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                    stdout=fileobj)
+    else:
+      self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+      self._copy_thread = threading.Thread(
+          target=shutil.copyfileobj, args=(self._proc.stdout, fileobj),
+          daemon=True)
+      self._copy_thread.start()
+
+  def write(self, data):
+    return self._proc.stdin.write(data)
+
+  def close(self):
+    self._proc.stdin.close()
+    if self._copy_thread:
+      self._copy_thread.join()
+      self._proc.stdout.close()
+    if self._proc.wait() != 0:
+      raise IOError('Compression command "{}" failed'.format(
+          ' '.join(self._cmd)))
+    if not self._copy_thread:
+      # The command wrote through the same file descriptor.
+      self._fileobj.seek(0, os.SEEK_END)
+
+
+class FramedWriter(object):
+  """A write-only file object compressing its input in independent frames."""
+
+  def __init__(self, filename, open_frame, fileobj=None):
+    """Create the writer.
+
+    Args:
+      filename: the output file name.
+      open_frame: callable taking the output file object and a file name to
+          record in the frame header, empty after the first frame, and
+          returning a file object compressing one frame. Closing it must
+          terminate the frame without closing the output.
+      fileobj: if set, write to this file object instead of opening
+          `filename`. It is closed with the writer.
+    """
+    self._raw = open(filename, 'wb') if fileobj is None else fileobj
+    self._open_frame = open_frame
+    self._frame = open_frame(self._raw, filename)
+    self._size = 0
+    # Offset in the output file of the current frame.
+    self.frame_offset = 0
+
+  def write(self, data):
+    self._frame.write(data)
+    self._size += len(data)
+    return len(data)
+
+  def tell(self):
+    """Returns the uncompressed position."""
+    return self._size
+
+  def new_frame(self):
+    """Terminates the current frame and starts another one."""
+    self._frame.close()
+    self.frame_offset = self._raw.tell()
+    self._frame = self._open_frame(self._raw, '')
+
+  def flush(self):
+    self._raw.flush()
+
+  def close(self):
+    try:
+      self._frame.close()
+    finally:
+      self._raw.close()
+
+
+def write_index(path, compression, members):
+  """Writes the index of a seekable tar file.
+
+  Args:
+    path: the index file name.
+    compression: compression of the archive: '', 'gz' or 'zst'.
+    members: list of (name, type, size, frame_offset, offset_in_frame).
+  """
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump({
+        'version': INDEX_VERSION,
+        'compression': compression,
+        'members': [(name, kind.decode('ascii'), size, frame_offset, offset)
+                    for name, kind, size, frame_offset, offset in members],
+    }, f, separators=(',', ':'))
+    f.write('\n')
+
+
+class SeekableTarReader(object):
+  """Reads single members of a seekable tar file, using its index.
+
+  Usage:
+    with SeekableTarReader('out.tar.gz', 'out.tar.gz.index.json') as reader:
+      data = reader.extractfile('./etc/config').read()
+  """
+
+  class Error(Exception):
+    pass
+
+  def __init__(self, archive, index):
+    """Open a seekable tar file.
+
+    Args:
+      archive: the tar file name.
+      index: the name of its index.
+    """
+    with open(index, 'r', encoding='utf-8') as f:
+      content = json.load(f)
+    if content.get('version') != INDEX_VERSION:
+      raise self.Error('Unsupported index version in ' + index)
+    self.compression = content['compression']
+    self._entries = {}
+    for name, kind, size, frame_offset, offset in content['members']:
+      # As when extracting, the last occurrence of a name wins.
+      self._entries[name.rstrip('/')] = (name, kind.encode('ascii'), size,
+                                         frame_offset, offset)
+    self._archive = open(archive, 'rb')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
+
+  def close(self):
+    self._archive.close()
+
+  def getnames(self):
+    """Returns the names of the members, in the order of the index."""
+    return [entry[0] for entry in self._entries.values()]
+
+  def _entry(self, name):
+    entry = self._entries.get(name.rstrip('/'))
+    if entry is None:
+      raise KeyError('%s not found in the index' % name)
+    return entry
+
+  def _decompressed_from(self, frame_offset):
+    """Returns a reader of the uncompressed content from a frame."""
+    self._archive.seek(frame_offset)
+    if not self.compression:
+      return self._archive, None
+    if self.compression == 'gz':
+      return gzip.GzipFile(fileobj=self._archive, mode='rb'), None
+    if self.compression == 'zst':
+      if HAS_ZSTD:
+        return zstandard.ZstdDecompressor().stream_reader(
+            self._archive, read_across_frames=True, closefd=False), None
+      proc = subprocess.Popen(['zstd', '-q', '-d', '-c'],
+                              stdin=self._archive, stdout=subprocess.PIPE)
+      return proc.stdout, proc
+    raise self.Error('Unsupported compression: ' + self.compression)
+
+  def _read_member(self, name):
+    """Returns the TarInfo of a member and its content, or None."""
+    _, _, _, frame_offset, offset = self._entry(name)
+    stream, proc = self._decompressed_from(frame_offset)
+    try:
+      if not self.compression:
+        self._archive.seek(frame_offset + offset)
+      else:
+        while offset > 0:
+          skipped = len(stream.read(min(offset, _SKIP_BUFFER_SIZE)))
+          if not skipped:
+            raise self.Error('Unexpected end of data in the archive')
+          offset -= skipped
+      with tarfile.open(fileobj=stream, mode='r|') as tar:
+        info = tar.next()
+        if info is None:
+          raise self.Error('No member at the offset of ' + name)
+        data = None
+        if info.isfile():
+          data = tar.extractfile(info).read()
+        return info, data
+    finally:
+      if stream is not self._archive:
+        stream.close()
+      if proc:
+        proc.wait()
+
+  def getmember(self, name):
+    """Returns the tarfile.TarInfo of a member."""
+    return self._read_member(name)[0]
+
+  def extractfile(self, name):
+    """Returns a file object with the content of a member, like tarfile.
+
+    Hard links are followed. For members which are not files, returns None.
+    """
+    info, data = self._read_member(name)
+    if info.islnk():
+      return self.extractfile(info.linkname)
+    return None if data is None else io.BytesIO(data)
@@ -37,6 +37,13 @@ tar_filetype = (
 SUPPORTED_TAR_COMPRESSIONS = (
     ["", "gz", "bz2", "xz"] if HAS_XZ_SUPPORT else ["", "gz", "bz2"]
 )
+
+# zstd is written with the zstandard Python module when it is available, and
+# with the zstd tool otherwise. It is kept out of SUPPORTED_TAR_COMPRESSIONS,
+# which the tests iterate over, because neither is guaranteed to be present.
+_ZSTD_TAR_FILETYPE = [".tar.zst", ".tzst"]
+_ZSTD_TAR_COMPRESSIONS = ["zst"]
+
 _DEFAULT_MTIME = -1
 
 def _remap(remap_paths, path):
@@ -46,6 +53,15 @@ def _remap(remap_paths, path):
             return replacement + path[len(prefix):]
     return path
 
+# Aliases accepted in extra_compressions, to build_tar compressions.
+_EXTRA_COMPRESSION_ALIASES = {
+    "tar": "",
+    "tgz": "gz",
+    "txz": "xz",
+    "tzst": "zst",
+    "zstd": "zst",
+}
+
 def _quote(filename, protect = "="):
     """Quote the filename, by escaping = by \\= and \\ by \\\\"""
     return filename.replace("\\", "\\\\").replace(protect, "\\" + protect)
@@ -74,9 +90,12 @@ def _pkg_tar_impl(ctx):
         package_dir_expanded = substitute_package_variables(ctx, ctx.attr.package_dir)
         args.add("--directory", package_dir_expanded or "/")
 
+    # The compression of the main output, None if it is a custom compressor.
+    main_compression = None
     if ctx.executable.compressor:
         args.add("--compressor", "%s %s" % (ctx.executable.compressor.path, ctx.attr.compressor_args))
     else:
+        main_compression = ""
         extension = ctx.attr.extension
         if extension and extension != "tar":
             compression = None
@@ -89,9 +108,12 @@ def _pkg_tar_impl(ctx):
                 compression = "gz"
             if compression == "txz":
                 compression = "xz"
+            if compression in ["tzst", "zstd"]:
+                compression = "zst"
             if compression:
-                if compression in SUPPORTED_TAR_COMPRESSIONS:
+                if compression in SUPPORTED_TAR_COMPRESSIONS + _ZSTD_TAR_COMPRESSIONS:
                     args.add("--compression", compression)
+                    main_compression = compression
                 else:
                     fail("Unsupported compression: '%s'" % compression)
 
@@ -115,6 +137,10 @@ def _pkg_tar_impl(ctx):
             )
     if ctx.attr.compression_level:
         args.add("--compression_level", str(ctx.attr.compression_level))
+    if ctx.attr.compression_threads > 1:
+        args.add("--compression_threads", str(ctx.attr.compression_threads))
+    if ctx.attr.zstd_long:
+        args.add("--zstd_long")
 
     # Now we begin processing the files.
     path_mapper = None
@@ -186,6 +212,74 @@ def _pkg_tar_impl(ctx):
     if ctx.attr.preserve_mtime:
         args.add("--preserve_mtime")
 
+    if ctx.attr.deduplicate:
+        args.add("--deduplicate")
+
+    if ctx.attr.print_stats:
+        args.add("--stats")
+
+    if ctx.file.diff_base:
+        args.add("--diff_base", ctx.file.diff_base.path)
+        files.append(ctx.file.diff_base)
+
+    action_outputs = [output_file]
+    output_groups = {"manifest": [manifest_file]}
+    if ctx.attr.seekable:
+        seekable_index = ctx.actions.declare_file(output_file.basename + ".index.json")
+        args.add("--seekable_index", seekable_index.path)
+        action_outputs.append(seekable_index)
+        output_groups["seekable_index"] = [seekable_index]
+    if ctx.attr.estargz:
+        toc_digest = ctx.actions.declare_file(output_file.basename + ".toc_digest")
+        args.add("--estargz")
+        args.add("--estargz_toc_digest", toc_digest.path)
+        action_outputs.append(toc_digest)
+        output_groups["estargz_toc_digest"] = [toc_digest]
+    if ctx.attr.extra_compressions:
+        if ctx.attr.seekable or ctx.attr.estargz:
+            fail("extra_compressions can not be used with seekable or estargz")
+        extra_outputs = []
+        for value in ctx.attr.extra_compressions:
+            compression = _EXTRA_COMPRESSION_ALIASES.get(value, value)
+            if compression and compression not in SUPPORTED_TAR_COMPRESSIONS + _ZSTD_TAR_COMPRESSIONS:
+                fail("Unsupported compression: '%s'" % value, attr = "extra_compressions")
+            if compression == main_compression:
+                fail("'%s' is the compression of the main output" % value, attr = "extra_compressions")
+            suffix = ".tar" + ("." + compression if compression else "")
+            group = suffix[1:].replace(".", "_")
+            if group in output_groups:
+                fail("Duplicate compression: '%s'" % value, attr = "extra_compressions")
+            extra_output_name = ctx.label.name + suffix
+
+            # With a custom compressor, the main output may have this name.
+            if extra_output_name == output_file.basename:
+                fail("'%s' would overwrite the main output %s" % (value, output_file.basename), attr = "extra_compressions")
+            extra_output = ctx.actions.declare_file(extra_output_name)
+            args.add("--extra_output", "%s=%s" % (_quote(extra_output.path), compression))
+            action_outputs.append(extra_output)
+            extra_outputs.append(extra_output)
+            output_groups[group] = [extra_output]
+        output_groups["extra_outputs"] = extra_outputs
+    if ctx.attr.split_size:
+        if ctx.attr.seekable or ctx.attr.estargz or ctx.attr.extra_compressions:
+            fail("split_size can not be used with seekable, estargz or extra_compressions")
+        if ctx.attr.deduplicate:
+            fail("split_size can not be used with deduplicate")
+        split_dir = ctx.actions.declare_directory(output_file.basename + ".volumes")
+        split_index = ctx.actions.declare_file(output_file.basename + ".volumes.json")
+        args.add("--split_size", str(ctx.attr.split_size))
+        args.add("--split_dir", split_dir.path)
+        args.add("--split_index", split_index.path)
+        action_outputs.extend([split_dir, split_index])
+        output_groups["volumes"] = [output_file, split_dir]
+        output_groups["volume_index"] = [split_index]
+    if ctx.attr.digest_algorithms:
+        digests_file = ctx.actions.declare_file(output_file.basename + ".digests.json")
+        args.add("--digests_file", digests_file.path)
+        args.add_joined("--digest_algorithms", ctx.attr.digest_algorithms, join_with = ",")
+        action_outputs.append(digests_file)
+        output_groups["digests"] = [digests_file]
+
     inputs = depset(
         direct = mapping_context.file_deps_direct + ctx.files.deps + files,
         transitive = mapping_context.file_deps_transitive,
@@ -198,7 +292,7 @@ def _pkg_tar_impl(ctx):
         tools = [ctx.executable.compressor] if ctx.executable.compressor else [],
         executable = ctx.executable._build_tar,
         arguments = [args],
-        outputs = [output_file],
+        outputs = action_outputs,
         env = {
             "LANG": "en_US.UTF-8",
             "LC_CTYPE": "UTF-8",
@@ -216,9 +310,7 @@ def _pkg_tar_impl(ctx):
         # The format of this file is subject to change without notice,
         # or this OutputGroup might be totally removed.
         # Depend on it at your own risk!
-        OutputGroupInfo(
-            manifest = [manifest_file],
-        ),
+        OutputGroupInfo(**output_groups),
     ]
 
 # A rule for creating a tar file, see README.md
@@ -239,7 +331,7 @@ pkg_tar_impl = rule(
         "package_dir_file": attr.label(allow_single_file = True),
         "deps": attr.label_list(
             doc = """tar files which will be unpacked and repacked into the archive.""",
-            allow_files = tar_filetype,
+            allow_files = tar_filetype + _ZSTD_TAR_FILETYPE,
         ),
         "srcs": attr.label_list(
             doc = """Inputs which will become part of the tar archive.""",
@@ -262,9 +354,10 @@ pkg_tar_impl = rule(
         "ownernames": attr.string_dict(),
         "extension": attr.string(
             default = "tar",
-            doc = """The extension of the generated file. If `"gz"`, `"bz2"`, or `"xz"`, the
+            doc = """The extension of the generated file. If `"gz"`, `"bz2"`, `"xz"` or `"zst"`, the
 tarball will also be compressed using that tool, and is mutually exclusive with `compressor`.
-Note that `xz` may not be supported based on the Python toolchain.
+Note that `xz` may not be supported based on the Python toolchain. `zst` uses the
+`zstandard` Python module if it is available and the `zstd` tool otherwise.
 """,
         ),
         "symlinks": attr.string_dict(),
@@ -286,9 +379,26 @@ Note that `xz` may not be supported based on the Python toolchain.
         "create_parents": attr.bool(default = True),
         "allow_duplicates_from_deps": attr.bool(default = False),
         "compression_level": attr.int(
-            doc = """Specify the numeric compression level in gzip mode; may be 0-9 or -1 (default to 6).""",
+            doc = """Specify the numeric compression level in gzip mode; may be 0-9 or -1 (default to 6).
+For zstd, the level may be 1-22, and -1 defaults to 3.""",
             default = -1,
         ),
+        "compression_threads": attr.int(
+            doc = """Number of threads to use for gzip and zstd compression.
+
+With a value greater than 1, the archive is cut into blocks which are
+compressed in parallel, as `pigz` does, and joined into a single gzip
+stream. The output only depends on `compression_level`, not on the
+number of threads. For zstd, this enables multithreaded frames.
+Ignored for other compressions and with `compressor`.
+""",
+            default = 1,
+        ),
+        "zstd_long": attr.bool(
+            doc = """Enable zstd long distance matching, as `zstd --long` does.
+Only used with the `zst` extension.""",
+            default = False,
+        ),
 
         # Common attributes
         "out": attr.output(mandatory = True),
@@ -313,6 +423,69 @@ builds were accidentally doing it. Never explicitly set this to true for new cod
             default = False,
             doc = """If true, will add file to archive with preserved file mtime.""",
         ),
+        "deduplicate": attr.bool(
+            default = False,
+            doc = """If true, files whose content and attributes are identical to a file
+already in the archive are stored as hard links to that file.""",
+        ),
+        "seekable": attr.bool(
+            default = False,
+            doc = """If true, compress the archive in independent frames and write an
+index of its members, `<out>.index.json`, available in the `seekable_index`
+output group. Single members can then be read without decompressing the
+whole archive. Only for gzip, zstd or uncompressed archives.""",
+        ),
+        "estargz": attr.bool(
+            default = False,
+            doc = """If true, write an eStargz archive: the content of each file starts a
+new gzip member, and a table of contents with the offset and digest of
+every file ends the archive, so that lazy-pulling snapshotters can fetch
+single files. It remains a valid `.tar.gz`. The digest of the table of
+contents, for the `containerd.io/snapshot/stargz/toc.digest` annotation,
+is written to `<out>.toc_digest`, available in the `estargz_toc_digest`
+output group. Requires gzip compression.""",
+        ),
+        "extra_compressions": attr.string_list(
+            doc = """Other compressions to write the same archive with, among `"tar"`
+(no compression), `"gz"`, `"bz2"`, `"xz"` and `"zst"`. The archive is built
+once and its stream compressed for each output in parallel, rather than
+reading every input again in another `pkg_tar`. The output for compression
+`c` is `<name>.tar.<c>`, or `<name>.tar` without compression, available in
+the `tar_<c>` (or `tar`) output group, and in the `extra_outputs` group with
+the others. Not supported with `seekable` or `estargz`.""",
+        ),
+        "split_size": attr.int(
+            doc = """If set, split the archive in volumes of at most this many bytes of
+uncompressed tar stream, for stores which limit the size of objects. A new
+volume starts between two members, and each volume is a complete archive,
+compressed like `out`, which can be extracted on its own. A member larger
+than the budget gets a volume of its own. `out` is the first volume, and
+the others are in the `<out>.volumes` directory, all of them in the
+`volumes` output group. `<out>.volumes.json`, in the `volume_index` output
+group, lists the volumes and the volume of each member. Not supported with
+`deduplicate`, `seekable`, `estargz` or `extra_compressions`.""",
+            default = 0,
+        ),
+        "diff_base": attr.label(
+            doc = """A tar file, typically another `pkg_tar`, on top of which this archive
+is an OCI image layer. Members which are identical, by metadata and content
+digest, to the member of the same path in the base are left out, and the
+members of the base which this archive does not have get whiteout entries,
+`.wh.<name>`, so that applying the layer removes them.""",
+            allow_single_file = tar_filetype + _ZSTD_TAR_FILETYPE,
+        ),
+        "digest_algorithms": attr.string_list(
+            doc = """Digests to compute while the outputs are written, e.g. `["sha256"]`.
+They are written to `<out>.digests.json`, in the `digests` output group, for
+the output, its extra compressions or volumes, and their uncompressed tar
+stream, so that they do not have to be read again to be hashed.""",
+        ),
+        "print_stats": attr.bool(
+            default = False,
+            doc = """If true, print statistics about the archive creation, such as the
+number of bytes saved by `deduplicate` and the peak memory use of the
+archiver.""",
+        ),
         "stamp": attr.int(
             doc = """Enable file time stamping.  Possible values:
 <li>stamp = 1: Use the time of the build as the modification time of each file in the archive.
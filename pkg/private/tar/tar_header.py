@@ -0,0 +1,140 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fast encoder for GNU tar headers.
+
+tarfile.TarInfo.tobuf() builds a dictionary, formats every field and computes
+the checksum by unpacking the header, all in Python. Most archives built by
+rules_pkg use a handful of owner and mtime combinations, so the encoder
+precomputes those fields, and their contribution to the checksum, once per
+combination. Each header is then a single struct.pack() of the fields that
+vary from member to member.
+
+Headers are byte-for-byte identical to what tarfile produces with
+GNU_FORMAT. Members the fast path does not handle, like long names or device
+files, are encoded by tarfile.
+"""
+
+import struct
+import tarfile
+
+# name, mode, uid, gid, size, mtime, chksum, type, linkname, magic, uname,
+# gname, then devmajor, devminor and prefix are left empty.
+_HEADER = struct.Struct('100s8s8s8s12s12s8s1s100s8s32s32s183x')
+
+# Types whose header has no device numbers nor sparse map.
+_SIMPLE_TYPES = frozenset((tarfile.REGTYPE, tarfile.AREGTYPE, tarfile.LNKTYPE,
+                           tarfile.SYMTYPE, tarfile.DIRTYPE, tarfile.FIFOTYPE,
+                           tarfile.CONTTYPE))
+
+# The checksum is computed with its own field filled with spaces.
+_CHKSUM_SPACES = 8 * ord(' ')
+
+_MAX_OCTAL_8 = 8 ** 7
+_MAX_OCTAL_12 = 8 ** 11
+
+# Number of owner and mtime combinations to remember. Archives which preserve
+# the mtime of their files could otherwise have one per member.
+_MAX_TEMPLATES = 1024
+
+
+class _Template(object):
+  """Header fields shared by the members with the same owners and mtime."""
+
+  __slots__ = ('uid', 'gid', 'mtime', 'uname', 'gname', 'checksum')
+
+  def __init__(self, uid, gid, uname, gname, mtime, encoding, errors):
+    self.uid = b'%07o\0' % uid
+    self.gid = b'%07o\0' % gid
+    self.mtime = b'%011o\0' % mtime
+    # Like tarfile, silently truncate the names which do not fit.
+    self.uname = uname.encode(encoding, errors)[:32]
+    self.gname = gname.encode(encoding, errors)[:32]
+    self.checksum = (_CHKSUM_SPACES + sum(self.uid) + sum(self.gid) +
+                     sum(self.mtime) + sum(tarfile.GNU_MAGIC) +
+                     sum(self.uname) + sum(self.gname))
+
+
+class HeaderEncoder(object):
+  """Encodes tar headers the way tarfile does with GNU_FORMAT."""
+
+  def __init__(self, encoding=tarfile.ENCODING, errors='surrogateescape'):
+    """Create the encoder.
+
+    Args:
+      encoding: encoding of the member names, as in tarfile.TarFile.
+      errors: how encoding errors are handled, as in tarfile.TarFile.
+    """
+    self.encoding = encoding
+    self.errors = errors
+    self._templates = {}
+    self._modes = {}
+
+  def _template(self, uid, gid, uname, gname, mtime):
+    key = (uid, gid, uname, gname, mtime)
+    template = self._templates.get(key)
+    if template is None:
+      if len(self._templates) >= _MAX_TEMPLATES:
+        self._templates.clear()
+      template = _Template(uid, gid, uname, gname, mtime, self.encoding,
+                           self.errors)
+      self._templates[key] = template
+    return template
+
+  def _mode(self, mode):
+    mode &= 0o7777
+    field = self._modes.get(mode)
+    if field is None:
+      field = b'%07o\0' % mode
+      self._modes[mode] = field
+    return field
+
+  def header(self, name, kind, size, mode, mtime, uid, gid, uname, gname,
+             linkname=''):
+    """Returns the header of a member, or None if it needs tarfile.
+
+    The arguments are the attributes of the same name of tarfile.TarInfo, with
+    `kind` for `type`. As in TarInfo.tobuf(), a '/' is appended to the name of
+    directories which do not end with one.
+    """
+    if kind not in _SIMPLE_TYPES or None in (mode, uname, gname, linkname):
+      return None
+    if kind == tarfile.DIRTYPE and not name.endswith('/'):
+      name += '/'
+    mtime = int(mtime)
+    if not (0 <= uid < _MAX_OCTAL_8 and 0 <= gid < _MAX_OCTAL_8 and
+            0 <= size < _MAX_OCTAL_12 and 0 <= mtime < _MAX_OCTAL_12):
+      return None
+    name_bytes = name.encode(self.encoding, self.errors)
+    link_bytes = linkname.encode(self.encoding, self.errors)
+    if len(name_bytes) > tarfile.LENGTH_NAME or (
+        len(link_bytes) > tarfile.LENGTH_LINK):
+      return None
+    template = self._template(uid, gid, uname, gname, mtime)
+    mode_field = self._mode(mode)
+    size_field = b'%011o\0' % size
+    checksum = (template.checksum + sum(name_bytes) + sum(link_bytes) +
+                sum(mode_field) + sum(size_field) + kind[0])
+    return _HEADER.pack(name_bytes, mode_field, template.uid, template.gid,
+                        size_field, template.mtime, b'%06o\0 ' % checksum,
+                        kind, link_bytes, tarfile.GNU_MAGIC, template.uname,
+                        template.gname)
+
+  def encode(self, info):
+    """Returns the header blocks of a tarfile.TarInfo, like info.tobuf()."""
+    buf = self.header(info.name, info.type, info.size, info.mode, info.mtime,
+                      info.uid, info.gid, info.uname, info.gname,
+                      info.linkname)
+    if buf is None:
+      buf = info.tobuf(tarfile.GNU_FORMAT, self.encoding, self.errors)
+    return buf
@@ -13,18 +13,50 @@
 # limitations under the License.
 """Tar writing helper."""
 
+import bz2
+import collections
+import contextlib
+import copy
+import errno
 import gzip
+import hashlib
 import io
 import os
+import posixpath
+import shutil
 import subprocess
+import sys
 import tarfile
+import threading
+
+from pkg.private import hashing_writer
+from pkg.private.tar import estargz
+from pkg.private.tar import layer_diff
+from pkg.private.tar import parallel_gzip
+from pkg.private.tar import path_index
+from pkg.private.tar import pipe_writer
+from pkg.private.tar import seekable
+from pkg.private.tar import tar_header
+from pkg.private.tar import volumes
 
 try:
-  import lzma  # pylint: disable=g-import-not-at-top, unused-import
+  import lzma  # pylint: disable=g-import-not-at-top
   HAS_LZMA = True
 except ImportError:
   HAS_LZMA = False
 
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+  HAS_ZSTD = True
+except ImportError:
+  HAS_ZSTD = False
+
+try:
+  import resource  # pylint: disable=g-import-not-at-top
+  HAS_RESOURCE = True
+except ImportError:
+  HAS_RESOURCE = False
+
 # This is slightly a lie. We do support xz fallback through the xz tool, but
 # that is fragile. Users should stick to the expectations provided here.
 COMPRESSIONS = ('', 'gz', 'bz2', 'xz') if HAS_LZMA else ('', 'gz', 'bz2')
@@ -33,8 +65,32 @@ COMPRESSIONS = ('', 'gz', 'bz2', 'xz') if HAS_LZMA else ('', 'gz', 'bz2')
 # See: https://github.com/bazelbuild/bazel/issues/1299
 PORTABLE_MTIME = 946684800  # 2000-01-01 00:00:00.000 UTC
 
+# Frame magic number, used to recognize zstd compressed input tar files.
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Window size used by zstd long distance matching. This is what `zstd --long`
+# uses, and the largest window decoders accept without extra flags.
+_ZSTD_LONG_WINDOW_LOG = 27
+
+# Errors from os.copy_file_range() and os.sendfile() meaning that the call is
+# not supported for this pair of files, rather than an I/O error.
+_FD_COPY_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSOCK,
+                        errno.EOPNOTSUPP, errno.EBADF)
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Members up to that size are read in memory and written along with other
+# members, rather than copied on their own.
+_SMALL_MEMBER_SIZE = 64 * 1024
+
+# Size of the writes made to the output, when members are small.
+_WRITE_BATCH_SIZE = 1024 * 1024
+
 _DEBUG_VERBOSITY = 0
 
+# Directories never added to the archive, and considered already there.
+_IMPLICIT_DIRECTORIES = ('/', './')
+
 TARFILE_MEMBER_TYPE_TO_STR = {
     b"0": "REGTYPE",
     b"\0": "AREGTYPE",
@@ -48,6 +104,129 @@ TARFILE_MEMBER_TYPE_TO_STR = {
 }
 
 
+def peak_rss():
+  """Returns the peak resident set size of this process in bytes, or None."""
+  if not HAS_RESOURCE:
+    return None
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes.
+  return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class _DiscardedMembers(list):
+  """Stands for TarFile.members when the members are not kept."""
+
+  def append(self, tarinfo):
+    pass
+
+
+def _source_fd(fileobj):
+  """Returns the file descriptor behind fileobj, if we can copy from it."""
+  try:
+    if not fileobj.seekable():
+      return None
+    return fileobj.fileno()
+  except (AttributeError, OSError, ValueError):
+    # io.UnsupportedOperation is both an OSError and a ValueError.
+    return None
+
+
+def _copy_fd_range(src_fd, src_offset, dst_fd, count):
+  """Copies count bytes at src_offset from src_fd to the position of dst_fd.
+
+  The data goes directly from one file descriptor to the other, without going
+  through Python buffers, when the platform allows it.
+  """
+  if hasattr(os, 'copy_file_range'):
+    while count > 0:
+      try:
+        copied = os.copy_file_range(src_fd, dst_fd, count, src_offset)
+      except OSError as e:
+        if e.errno not in _FD_COPY_UNSUPPORTED:
+          raise
+        break
+      if copied == 0:
+        raise OSError('unexpected end of data')
+      src_offset += copied
+      count -= copied
+  if count > 0 and hasattr(os, 'sendfile'):
+    while count > 0:
+      try:
+        copied = os.sendfile(dst_fd, src_fd, src_offset, count)
+      except OSError as e:
+        if e.errno not in _FD_COPY_UNSUPPORTED:
+          raise
+        break
+      if copied == 0:
+        raise OSError('unexpected end of data')
+      src_offset += copied
+      count -= copied
+  while count > 0:
+    data = os.pread(src_fd, min(count, _COPY_BUFFER_SIZE), src_offset)
+    if not data:
+      raise OSError('unexpected end of data')
+    os.write(dst_fd, data)
+    src_offset += len(data)
+    count -= len(data)
+
+
+def _zstd_compressor(compression_level, compression_threads, zstd_long):
+  """Returns the zstandard.ZstdCompressor for the zstd options."""
+  zstd_args = {
+      'threads': compression_threads if compression_threads > 1 else 0,
+      'write_checksum': True,
+      # The size of the tar stream is not known when the frame header is
+      # written. Never record it, so that the output does not depend on
+      # how the data was fed to the compressor.
+      'write_content_size': False,
+  }
+  if zstd_long:
+    zstd_args['enable_ldm'] = True
+    zstd_args['window_log'] = _ZSTD_LONG_WINDOW_LOG
+  params = zstandard.ZstdCompressionParameters.from_level(
+      compression_level, **zstd_args)
+  return zstandard.ZstdCompressor(compression_params=params)
+
+
+def _zstd_command(compression_level, compression_threads, zstd_long):
+  """Returns the zstd command line compressing stdin for the zstd options."""
+  zstd_cmd = ['zstd', '-q', '-c', '-%d' % compression_level]
+  if compression_level > 19:
+    zstd_cmd.append('--ultra')
+  if compression_threads > 1:
+    zstd_cmd.append('-T%d' % compression_threads)
+  if zstd_long:
+    zstd_cmd.append('--long=%d' % _ZSTD_LONG_WINDOW_LOG)
+  zstd_cmd.append('-')
+  return zstd_cmd
+
+
+class _TeeWriter(object):
+  """Writes the tar stream both to the main output and to extra outputs.
+
+  Only the main output is closed with the writer, the extra outputs are
+  closed by TarFileWriter.close().
+  """
+
+  def __init__(self, fileobj, extra_fileobjs):
+    self._fileobj = fileobj
+    self._extra_fileobjs = extra_fileobjs
+
+  def write(self, data):
+    for extra in self._extra_fileobjs:
+      extra.write(data)
+    return self._fileobj.write(data)
+
+  def tell(self):
+    return self._fileobj.tell()
+
+  def flush(self):
+    self._fileobj.flush()
+
+  def close(self):
+    self._fileobj.close()
+
+
 class TarFileWriter(object):
   """A wrapper to write tar files."""
 
@@ -62,17 +241,73 @@ class TarFileWriter(object):
                allow_dups_from_deps=True,
                default_mtime=None,
                preserve_tar_mtimes=True,
-               compression_level=-1):
+               compression_level=-1,
+               compression_threads=1,
+               zstd_long=False,
+               streaming=False,
+               seekable_index=None,
+               seekable_frame_size=None,
+               estargz_toc=False,
+               estargz_chunk_size=None,
+               extra_outputs=None,
+               split_size=None,
+               split_dir=None,
+               split_index=None,
+               diff_base=None,
+               digests_file=None,
+               digest_algorithms=hashing_writer.DEFAULT_ALGORITHMS):
     """TarFileWriter wraps tarfile.open().
 
     Args:
       name: the tar file name.
-      compression: compression type: bzip2, bz2, gz, tgz, xz, lzma.
+      compression: compression type: bzip2, bz2, gz, tgz, xz, lzma, zst, zstd.
       compressor: custom command to do the compression.
       default_mtime: default mtime to use for elements in the archive.
           May be an integer or the value 'portable' to use the date
           2000-01-01, which is compatible with non *nix OSes'.
       preserve_tar_mtimes: if true, keep file mtimes from input tar file.
+      compression_level: compression level, 0-9 or -1 for the default.
+      compression_threads: number of threads to use for gzip and zstd
+          compression. With more than one thread, the archive is compressed in
+          independent blocks, like pigz does.
+      zstd_long: enable zstd long distance matching.
+      streaming: do not keep a TarInfo for each member, of the output nor of
+          merged tar files. Memory use then only grows with the index of
+          member paths, but the members can not be listed from self.tar.
+      seekable_index: if set, compress the archive in independent frames, and
+          write to this file the index of the members, see seekable.py.
+          Only for gzip, zstd or uncompressed archives.
+      seekable_frame_size: amount of uncompressed data in each frame of a
+          seekable archive, default to seekable.DEFAULT_FRAME_SIZE.
+      estargz_toc: write an eStargz archive, see estargz.py: the content of
+          each regular file starts a gzip member, and a table of contents of
+          the members, with their offsets and digests, ends the archive. Only
+          for gzip.
+      estargz_chunk_size: files larger than this are split in chunks of this
+          size, each in its own gzip member. Default to
+          estargz.DEFAULT_CHUNK_SIZE.
+      extra_outputs: list of (name, compression) of other files to write the
+          same archive to, with another compression. The tar stream is
+          produced once, and compressed for each output by a thread of its
+          own. Not for seekable nor eStargz archives.
+      split_size: split the archive in volumes, see volumes.py: a member
+          which would make the current volume larger than this, in bytes of
+          uncompressed tar stream, goes to a new volume. Larger members get
+          a volume of their own. The first volume is `name`, the others are
+          named by volumes.volume_name(). Not for seekable nor eStargz
+          archives, nor with extra outputs.
+      split_dir: directory of the volumes after the first one, default to
+          the directory of `name`.
+      split_index: with split_size, write the list of the volumes and the
+          volume of each member to this file.
+      diff_base: a tar file to write the archive as an OCI layer on top of,
+          see layer_diff.py: members identical to the member of the same
+          path in it are left out, and its members which are not in the
+          archive get whiteouts.
+      digests_file: if set, hash the outputs and the uncompressed tar stream
+          while they are written, and write their digests to this file, see
+          hashing_writer.py.
+      digest_algorithms: names of the hashlib algorithms of the digests.
     """
     self.preserve_mtime = preserve_tar_mtimes
     if default_mtime is None:
@@ -82,6 +317,95 @@ class TarFileWriter(object):
     else:
       self.default_mtime = int(default_mtime)
 
+    self.compressor_cmd = (compressor or '').strip()
+    if seekable_index and (self.compressor_cmd or compression not in [
+        '', None, 'tgz', 'gz', 'zst', 'zstd', 'tzst']):
+      raise self.Error('Seekable archives must be compressed with gzip or '
+                       'zstd, or not compressed')
+    if estargz_toc and (self.compressor_cmd or seekable_index or
+                        compression not in ['tgz', 'gz']):
+      raise self.Error('eStargz archives must be compressed with gzip, and '
+                       'can not be seekable archives')
+    if extra_outputs and (seekable_index or estargz_toc):
+      raise self.Error('Seekable and eStargz archives can not have extra '
+                       'outputs')
+    if split_size and (seekable_index or estargz_toc or extra_outputs):
+      raise self.Error('Split archives can not be seekable nor eStargz '
+                       'archives, nor have extra outputs')
+    self.streaming = streaming
+    self._digests_file = digests_file
+    self._digest_algorithms = list(digest_algorithms)
+    # [name, HashingWriter, raw file, uncompressed digests] of the files
+    # written, when hashing them. See _create_output_file().
+    self._hashed_outputs = []
+    # Threads copying the output of compression commands to hashed files.
+    self._copy_threads = []
+    # Hashes the uncompressed tar stream.
+    self._tar_hash = None
+    self._output_options = (compressor, compression, compression_level,
+                            compression_threads, zstd_long, seekable_index,
+                            estargz_toc)
+    self.name = name
+    self._open_output(name, *self._output_options)
+    # Each extra output gets its own (fileobj, proc, cmd), see
+    # _open_extra_output().
+    self._extra_outputs = [
+        self._open_extra_output(extra_name, extra_compression,
+                                compression_level, compression_threads,
+                                zstd_long)
+        for extra_name, extra_compression in extra_outputs or []
+    ]
+    if self._extra_outputs:
+      self.tar.fileobj = _TeeWriter(
+          self.tar.fileobj, [extra[0] for extra in self._extra_outputs])
+      # Data copied between file descriptors would bypass the tee.
+      self._can_copy_fds = False
+    self.existing_members = path_index.PathIndex(
+        implicit_ancestors=_IMPLICIT_DIRECTORIES)
+    self.create_parents = create_parents
+    self.allow_dups_from_deps = allow_dups_from_deps
+    self._header_encoder = tar_header.HeaderEncoder(self.tar.encoding,
+                                                    self.tar.errors)
+    self._write_buffer = bytearray()
+    self._seekable_index = seekable_index
+    self._seekable_compression = {
+        'tgz': 'gz', 'zstd': 'zst', 'tzst': 'zst'}.get(compression,
+                                                       compression or '')
+    self._frame_size = seekable_frame_size or seekable.DEFAULT_FRAME_SIZE
+    # Uncompressed offset of the current frame.
+    self._frame_start = 0
+    self._index_entries = []
+    self._toc = estargz.TOC() if estargz_toc else None
+    self._chunk_size = estargz_chunk_size or estargz.DEFAULT_CHUNK_SIZE
+    # Offset in the output of the gzip member holding the table of contents,
+    # and its digest, once written.
+    self._toc_offset = None
+    self.toc_digest = None
+    self._split_size = split_size
+    self._split_dir = split_dir
+    self._split_index = split_index
+    self._volumes = [name]
+    # Number of members in the current volume.
+    self._volume_members = 0
+    # (name, volume) of the members of a split archive, for its index.
+    self._volume_entries = []
+    # Volume of the regular files of a split archive, to check hard links.
+    self._file_volumes = {}
+    # Counters about the archive creation, filled when closing.
+    self.stats = collections.Counter()
+    self._diff_base = None
+    if diff_base:
+      self._diff_base = layer_diff.BaseIndex()
+      with self._open_input_tar(diff_base) as (intar, _):
+        intar.members = _DiscardedMembers()
+        for info in intar:
+          self._diff_base.add(
+              info, intar.extractfile(info) if info.isreg() else None)
+
+  def _open_output(self, name, compressor, compression, compression_level,
+                   compression_threads, zstd_long, seekable_index,
+                   estargz_toc):
+    """Opens the output tar file, or the next volume of a split archive."""
     self.fileobj = None
     self.compressor_cmd = (compressor or '').strip()
     extra_tar_args = {}
@@ -97,30 +421,168 @@ class TarFileWriter(object):
         extra_tar_args['preset'] = compression_level
       else:
         self.compressor_cmd = 'xz -F {} -{} -'.format(compression, compression_level)
+    elif compression in ['zst', 'zstd', 'tzst']:
+      mode = 'w:'
+      compression_level = min(compression_level, 22) if compression_level > 0 else 3
+      if HAS_ZSTD:
+        compressor = _zstd_compressor(compression_level, compression_threads,
+                                      zstd_long)
+        if seekable_index:
+          self.fileobj = seekable.FramedWriter(
+              name, lambda out, _: compressor.stream_writer(out, closefd=False),
+              fileobj=self._create_output_file(name))
+        else:
+          self.fileobj = compressor.stream_writer(
+              self._create_output_file(name) or open(name, 'wb'), closefd=True)
+      else:
+        zstd_cmd = _zstd_command(compression_level, compression_threads,
+                                 zstd_long)
+        if seekable_index:
+          self.fileobj = seekable.FramedWriter(
+              name, lambda out, _: seekable.ProcessFrame(zstd_cmd, out),
+              fileobj=self._create_output_file(name))
+        else:
+          self.compressor_cmd = ' '.join(zstd_cmd)
     elif compression in ['bzip2', 'bz2']:
       mode = 'w:bz2'
     else:
       mode = 'w:'
       if compression in ['tgz', 'gz']:
         compression_level = min(compression_level, 9) if compression_level >= 0 else 6
-        # The Tarfile class doesn't allow us to specify gzip's mtime attribute.
-        # Instead, we manually reimplement gzopen from tarfile.py and set mtime.
-        self.fileobj = gzip.GzipFile(
-            filename=name, mode='w', compresslevel=compression_level, mtime=self.default_mtime)
+        open_gzip = self._gzip_opener(compression_level, compression_threads)
+        if seekable_index or estargz_toc:
+          self.fileobj = seekable.FramedWriter(
+              name, open_gzip, fileobj=self._create_output_file(name))
+        else:
+          self.fileobj = open_gzip(self._create_output_file(name), name)
     self.compressor_proc = None
     if self.compressor_cmd:
       mode = 'w|'
-      self.compressor_proc = subprocess.Popen(self.compressor_cmd.split(),
-                                              stdin=subprocess.PIPE,
-                                              stdout=open(name, 'wb'))
-      self.fileobj = self.compressor_proc.stdin
-    self.name = name
+      self.compressor_proc = self._start_compressor(
+          self.compressor_cmd.split(), name)
+      # Feed the compressor from another thread, so that it works while this
+      # one reads the inputs.
+      self.fileobj = pipe_writer.PipeWriter(self.compressor_proc.stdin)
 
-    self.tar = tarfile.open(name=name, mode=mode, fileobj=self.fileobj,
+    fileobj = self.fileobj
+    if fileobj is None:
+      # tarfile opens the file, unless it must be hashed.
+      fileobj = self._create_output_file(name)
+    self.tar = tarfile.open(name=name, mode=mode, fileobj=fileobj,
                             format=tarfile.GNU_FORMAT, **extra_tar_args)
-    self.existing_members = {}
-    self.create_parents = create_parents
-    self.allow_dups_from_deps = allow_dups_from_deps
+    # When the output is not compressed, tarfile writes straight to the file
+    # it opened, and file content can be copied between file descriptors.
+    self._can_copy_fds = (mode == 'w:' and fileobj is None and
+                          hasattr(os, 'pread'))
+    if self._digests_file:
+      self._tar_hash = hashing_writer.HashingWriter(self.tar.fileobj,
+                                                    self._digest_algorithms)
+      self.tar.fileobj = self._tar_hash
+    if self.streaming:
+      self.tar.members = _DiscardedMembers()
+
+  def _gzip_opener(self, compression_level, compression_threads):
+    """Returns a function opening a gzip writer: f(fileobj, filename)."""
+    if compression_threads > 1:
+      def open_gzip(fileobj, filename):
+        return parallel_gzip.ParallelGzipWriter(
+            filename=filename,
+            compresslevel=compression_level,
+            mtime=self.default_mtime,
+            threads=compression_threads,
+            fileobj=fileobj)
+    else:
+      # The Tarfile class doesn't allow us to specify gzip's mtime
+      # attribute. Instead, we manually reimplement gzopen from tarfile.py
+      # and set mtime.
+      def open_gzip(fileobj, filename):
+        return gzip.GzipFile(
+            filename=filename, mode='w', compresslevel=compression_level,
+            mtime=self.default_mtime, fileobj=fileobj)
+    return open_gzip
+
+  def _open_extra_output(self, name, compression, compression_level,
+                         compression_threads, zstd_long):
+    """Opens an extra output of the archive, compressed as requested.
+
+    The output is the same file that a TarFileWriter with this compression
+    would write. It is fed by a pipe_writer.PipeWriter, so that it is
+    compressed in parallel with the other outputs.
+
+    Returns:
+      (fileobj, proc, cmd): the file object to write the tar stream to, and
+      the compression command and its process, if one is used.
+    """
+    cmd = None
+    if compression in ['', None]:
+      fileobj = self._create_output_file(name) or open(name, 'wb')
+    elif compression in ['tgz', 'gz']:
+      compression_level = min(compression_level, 9) if compression_level >= 0 else 6
+      fileobj = self._gzip_opener(compression_level, compression_threads)(
+          self._create_output_file(name), name)
+    elif compression in ['bzip2', 'bz2']:
+      # The default level of tarfile.
+      fileobj = bz2.BZ2File(self._create_output_file(name) or name, 'w',
+                            compresslevel=9)
+    elif compression in ['xz', 'lzma']:
+      compression_level = min(compression_level, 9) if compression_level >= 0 else 6
+      if HAS_LZMA:
+        fileobj = lzma.LZMAFile(self._create_output_file(name) or name, 'w',
+                                preset=compression_level)
+      else:
+        cmd = ['xz', '-F', compression, '-%d' % compression_level, '-']
+    elif compression in ['zst', 'zstd', 'tzst']:
+      compression_level = min(compression_level, 22) if compression_level > 0 else 3
+      if HAS_ZSTD:
+        fileobj = _zstd_compressor(
+            compression_level, compression_threads, zstd_long).stream_writer(
+                self._create_output_file(name) or open(name, 'wb'),
+                closefd=True)
+      else:
+        cmd = _zstd_command(compression_level, compression_threads, zstd_long)
+    else:
+      raise self.Error('Unsupported compression "{}" for {}'.format(
+          compression, name))
+    proc = None
+    if cmd:
+      proc = self._start_compressor(cmd, name)
+      fileobj = proc.stdin
+    return pipe_writer.PipeWriter(fileobj), proc, cmd
+
+  def _create_output_file(self, name):
+    """Creates an output file to hash, if digests are requested.
+
+    Returns:
+      A hashing_writer.HashingWriter on the new file, which closing leaves
+      the file open for close() to collect the digests, or None if the
+      outputs are not hashed.
+    """
+    if not self._digests_file:
+      return None
+    raw = open(name, 'wb')
+    fileobj = hashing_writer.HashingWriter(raw, self._digest_algorithms,
+                                           closefd=False)
+    self._hashed_outputs.append([name, fileobj, raw, None])
+    return fileobj
+
+  def _start_compressor(self, cmd, name):
+    """Starts a compression command writing `name` from its standard input.
+
+    Its input is resized for pipe_writer.PipeWriter.
+    """
+    out = self._create_output_file(name)
+    if out is None:
+      with open(name, 'wb') as stdout:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout)
+    else:
+      proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+      thread = threading.Thread(target=shutil.copyfileobj,
+                                args=(proc.stdout, out), daemon=True)
+      thread.start()
+      self._copy_threads.append(thread)
+    pipe_writer.resize_pipe(proc.stdin.fileno())
+    return proc
 
   def __enter__(self):
     return self
@@ -134,14 +596,18 @@ class TarFileWriter(object):
     # Things we should not add.
     # If we some day need to allow '.' or '/' as an explicit member of the archive,
     # we can adjust that here based on the setting of root_directory.
-    if path == '/' or path == './':
+    if path in _IMPLICIT_DIRECTORIES:
       return tarfile.DIRTYPE
 
     normalized_path = path.rstrip("/")
     return self.existing_members.get(normalized_path, None)
 
   def _addfile(self, info, fileobj=None):
-    """Add a file in the tar file if there is no conflict."""
+    """Add a file in the tar file if there is no conflict.
+
+    Returns:
+      True if the file was added, False if it was dropped as a duplicate.
+    """
     if info.type == tarfile.DIRTYPE:
       # Enforce the ending / for directories.
       if not info.name.endswith('/'):
@@ -159,12 +625,173 @@ class TarFileWriter(object):
               'picking first occurrence' % (TARFILE_MEMBER_TYPE_TO_STR.get(
                   existing_member_type, "UNKNOWN"), info.name))
 
-      return
+      return False
 
-    self.tar.addfile(info, fileobj)
+    if self._diff_base is not None:
+      unchanged, fileobj = self._diff_base.match(info, fileobj)
+      if unchanged:
+        # The base has it already, but it is part of the archive.
+        self.stats['diff_unchanged_members'] += 1
+        self.existing_members[info.name.rstrip("/")] = info.type
+        return True
+    self._write_member(info, fileobj)
     # Strip the trailing slash from the path so that we can detect when, for example, we are
     # trying to overwrite a symbolic link with a directory.
     self.existing_members[info.name.rstrip("/")] = info.type
+    return True
+
+  def _write_member(self, info, fileobj=None):
+    """Write a member to the tar file, like tarfile.addfile().
+
+    Headers come from a tar_header.HeaderEncoder, and small members are
+    gathered into large writes. For uncompressed output, the content of
+    larger files is copied without going through Python, with
+    os.copy_file_range() or os.sendfile(). The archive is identical to what
+    tarfile.addfile() produces.
+    """
+    if not self.streaming:
+      info = copy.copy(info)
+    if self._seekable_index:
+      self._index_member(info)
+    buf = self._header_encoder.encode(info)
+    if self._split_size:
+      self._assign_volume(info, len(buf), fileobj is not None)
+    self.tar.members.append(info)
+    toc_entry = self._toc.add(info) if self._toc is not None else None
+    if fileobj is None:
+      self._write(buf)
+      self.tar.offset += len(buf)
+      return
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+      padding = tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+      blocks += 1
+    else:
+      padding = b''
+    self.tar.offset += len(buf) + blocks * tarfile.BLOCKSIZE
+    if toc_entry is not None and toc_entry['type'] == 'reg' and info.size:
+      self._write(buf)
+      self._write_chunks(toc_entry, fileobj, info.size)
+      self._write(padding)
+      return
+    if info.size <= _SMALL_MEMBER_SIZE:
+      data = fileobj.read(info.size)
+      if len(data) < info.size:
+        raise OSError('unexpected end of data')
+      self._write(buf)
+      self._write(data)
+      self._write(padding)
+      return
+    self._flush_writes()
+    out = self.tar.fileobj
+    out.write(buf)
+    src_fd = _source_fd(fileobj) if self._can_copy_fds else None
+    if src_fd is None:
+      tarfile.copyfileobj(fileobj, out, info.size,
+                          bufsize=self.tar.copybufsize)
+    else:
+      out.flush()
+      src_offset = fileobj.tell()
+      _copy_fd_range(src_fd, src_offset, out.fileno(), info.size)
+      fileobj.seek(src_offset + info.size)
+    out.write(padding)
+
+  def _write_chunks(self, toc_entry, fileobj, size):
+    """Writes the content of a file for eStargz, each chunk in a gzip member.
+
+    The digests of the file and its chunks are computed as the content goes
+    through, and recorded in the table of contents.
+    """
+    digest = hashlib.sha256()
+    written = 0
+    while written < size:
+      self._flush_writes()
+      self.fileobj.new_frame()
+      chunk_size = min(self._chunk_size, size - written)
+      chunk_digest = hashlib.sha256()
+      remaining = chunk_size
+      while remaining > 0:
+        data = fileobj.read(min(remaining, _COPY_BUFFER_SIZE))
+        if not data:
+          raise OSError('unexpected end of data')
+        digest.update(data)
+        chunk_digest.update(data)
+        self.fileobj.write(data)
+        remaining -= len(data)
+      self._toc.add_chunk(toc_entry, self.fileobj.frame_offset, written,
+                          chunk_size, chunk_digest.hexdigest(),
+                          partial=chunk_size < self._chunk_size)
+      written += chunk_size
+    self._toc.set_digest(toc_entry, digest.hexdigest())
+
+  def _write_toc(self):
+    """Writes the eStargz table of contents, as the last member."""
+    toc = self._toc.to_json()
+    # The table of contents does not list itself.
+    self._toc = None
+    self.toc_digest = 'sha256:' + hashlib.sha256(toc).hexdigest()
+    self._flush_writes()
+    self.fileobj.new_frame()
+    self._toc_offset = self.fileobj.frame_offset
+    info = tarfile.TarInfo(estargz.TOC_TAR_NAME)
+    info.size = len(toc)
+    info.mode = 0o644
+    info.mtime = self.default_mtime
+    self._write_member(info, io.BytesIO(toc))
+    # The end of archive blocks go in the same gzip member.
+    self._flush_writes()
+
+  def _assign_volume(self, info, header_size, has_data):
+    """Starts a new volume if a member does not fit in the current one."""
+    size = header_size
+    if has_data:
+      size += -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    # A volume ends with two empty blocks, padded to a full record.
+    end = self.tar.offset + size + 2 * tarfile.BLOCKSIZE
+    end = -(-end // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+    if self._volume_members and end > self._split_size:
+      self._flush_writes()
+      self._close_output()
+      name = volumes.volume_name(self.name, len(self._volumes),
+                                 self._split_dir)
+      self._volumes.append(name)
+      self._open_output(name, *self._output_options)
+      self._volume_members = 0
+    volume = len(self._volumes) - 1
+    if info.type == tarfile.LNKTYPE:
+      target_volume = self._file_volumes.get(
+          posixpath.normpath('/' + info.linkname))
+      if target_volume is not None and target_volume != volume:
+        raise self.Error(
+            'Hard link {} to {} would cross volumes {} and {} of {}'.format(
+                info.name, info.linkname, target_volume, volume, self.name))
+    elif info.isreg():
+      self._file_volumes[posixpath.normpath('/' + info.name)] = volume
+    self._volume_members += 1
+    self._volume_entries.append((info.name, volume))
+
+  def _index_member(self, info):
+    """Records where a member starts, starting a new frame if it is time."""
+    frame_offset = 0
+    if isinstance(self.fileobj, seekable.FramedWriter):
+      if self.tar.offset - self._frame_start >= self._frame_size:
+        self._flush_writes()
+        self.fileobj.new_frame()
+        self._frame_start = self.tar.offset
+      frame_offset = self.fileobj.frame_offset
+    self._index_entries.append((info.name, info.type, info.size, frame_offset,
+                                self.tar.offset - self._frame_start))
+
+  def _write(self, data):
+    """Write data to the tar file, in batches."""
+    self._write_buffer += data
+    if len(self._write_buffer) >= _WRITE_BATCH_SIZE:
+      self._flush_writes()
+
+  def _flush_writes(self):
+    if self._write_buffer:
+      self.tar.fileobj.write(self._write_buffer)
+      self._write_buffer = bytearray()
 
   def add_directory_path(self,
                          path,
@@ -201,21 +828,17 @@ class TarFileWriter(object):
     self._addfile(tarinfo)
 
   def conditionally_add_parents(self, path, uid=0, gid=0, uname='', gname='', mtime=0, mode=0o755):
-    dirs = path.split('/')
-    parent_path = ''
-    for next_level in dirs[0:-1]:
-      parent_path = parent_path + next_level + '/'
-
-      if self.create_parents and self._existing_member_type(
-          parent_path) is None:
-        self.add_directory_path(
-          parent_path,
-          uid=uid,
-          gid=gid,
-          uname=uname,
-          gname=gname,
-          mtime=mtime,
-          mode=0o755)
+    if not self.create_parents:
+      return
+    for parent_path in self.existing_members.missing_ancestors(path):
+      self.add_directory_path(
+        parent_path,
+        uid=uid,
+        gid=gid,
+        uname=uname,
+        gname=gname,
+        mtime=mtime,
+        mode=0o755)
 
   def add_file(self,
                name,
@@ -228,7 +851,8 @@ class TarFileWriter(object):
                uname='',
                gname='',
                mtime=None,
-               mode=None):
+               mode=None,
+               file_size=None):
     """Add a file to the current tar.
 
     Args:
@@ -244,14 +868,18 @@ class TarFileWriter(object):
       gname: owner group names.
       mtime: modification time to put in the archive.
       mode: unix permission mode of the file, default 0644 (0755).
+      file_size: the size of `file_content`, if already known.
+
+    Returns:
+      True if the file was added to the archive.
     """
     if not name:
-      return
+      return False
     if name == '.':
-      return
+      return False
     if not self.allow_dups_from_deps and self._existing_member_type(
         name) is not None:
-      return
+      return False
 
     if mtime is None:
       mtime = self.default_mtime
@@ -275,13 +903,15 @@ class TarFileWriter(object):
     if content:
       content_bytes = content.encode('utf-8')
       tarinfo.size = len(content_bytes)
-      self._addfile(tarinfo, io.BytesIO(content_bytes))
+      return self._addfile(tarinfo, io.BytesIO(content_bytes))
     elif file_content:
       with open(file_content, 'rb') as f:
-        tarinfo.size = os.fstat(f.fileno()).st_size
-        self._addfile(tarinfo, f)
+        if file_size is None:
+          file_size = os.fstat(f.fileno()).st_size
+        tarinfo.size = file_size
+        return self._addfile(tarinfo, f)
     else:
-      self._addfile(tarinfo)
+      return self._addfile(tarinfo)
 
   def add_tar(self,
               tar,
@@ -289,7 +919,8 @@ class TarFileWriter(object):
               rootgid=None,
               numeric=False,
               name_filter=None,
-              prefix=None):
+              prefix=None,
+              fileobj=None):
     """Merge a tar content into the current tar, stripping timestamp.
 
     Args:
@@ -302,6 +933,8 @@ class TarFileWriter(object):
           called for each file to add, given the name and should return true if
           the file is to be added to the final tar and false otherwise.
       prefix: prefix to add to all file paths.
+      fileobj: if set, a stream of the uncompressed content of `tar`, to read
+          instead of the file.
 
     Raises:
       TarFileWriter.Error: if an error happens when uncompressing the tar file.
@@ -310,7 +943,62 @@ class TarFileWriter(object):
       prefix = prefix.strip('/') + '/'
     if _DEBUG_VERBOSITY > 1:
       print('==========================  prefix is', prefix)
-    intar = tarfile.open(name=tar, mode='r:*')
+    with self._open_input_tar(tar, fileobj) as (intar, raw):
+      if self.streaming:
+        intar.members = _DiscardedMembers()
+      self._merge_tar(intar, raw, rootuid, rootgid, numeric, name_filter,
+                      prefix)
+
+  @contextlib.contextmanager
+  def _open_input_tar(self, tar, fileobj=None):
+    """Opens a tar file for reading, whatever its compression.
+
+    Yields:
+      (intar, raw): the open tarfile.TarFile, and if the tar file is not
+      compressed, a separate file object on it to read member data from.
+    """
+    if fileobj is not None:
+      with tarfile.open(mode='r|', fileobj=fileobj) as intar:
+        yield intar, None
+      return
+    with open(tar, 'rb') as f:
+      is_zstd = f.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+    if not is_zstd:
+      intar = tarfile.open(name=tar, mode='r:*')
+      try:
+        if type(intar.fileobj) is io.BufferedReader:
+          # tarfile read the file directly: there is no compression.
+          with open(tar, 'rb') as raw:
+            yield intar, raw
+        else:
+          yield intar, None
+      finally:
+        intar.close()
+    elif HAS_ZSTD:
+      # tarfile can not read zstd itself. Read the archive as a stream instead.
+      with open(tar, 'rb') as raw:
+        with zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+          with tarfile.open(mode='r|', fileobj=reader) as intar:
+            yield intar, None
+    else:
+      proc = subprocess.Popen(['zstd', '-q', '-d', '-c', tar],
+                              stdout=subprocess.PIPE)
+      try:
+        with tarfile.open(mode='r|', fileobj=proc.stdout) as intar:
+          yield intar, None
+      finally:
+        proc.stdout.close()
+        if proc.wait() != 0:
+          raise self.Error('Failed to decompress {} with zstd'.format(tar))
+
+  def _merge_tar(self, intar, raw, rootuid, rootgid, numeric, name_filter,
+                 prefix):
+    """Copies the members of an open tar file, see add_tar.
+
+    If `raw` is given, it is a file object on the uncompressed input tar file.
+    The data blocks of members are then copied verbatim from their offset in
+    it, and only the headers are re-encoded.
+    """
     for tarinfo in intar:
       if name_filter is None or name_filter(tarinfo.name):
         if not self.preserve_mtime:
@@ -350,13 +1038,15 @@ class TarFileWriter(object):
         if 'path' in tarinfo.pax_headers:
           del tarinfo.pax_headers['path']
 
-        if tarinfo.isfile():
+        if tarinfo.isfile() and raw is not None and not tarinfo.issparse():
+          raw.seek(tarinfo.offset_data)
+          self._addfile(tarinfo, raw)
+        elif tarinfo.isfile():
           # use extractfile(tarinfo) instead of tarinfo.name to preserve
           # seek position in intar
           self._addfile(tarinfo, intar.extractfile(tarinfo))
         else:
           self._addfile(tarinfo)
-    intar.close()
 
   def close(self):
     """Close the output tar file.
@@ -366,10 +1056,80 @@ class TarFileWriter(object):
     Raises:
       TarFileWriter.Error: if an error happens when compressing the output file.
     """
+    if self._diff_base is not None:
+      self._write_whiteouts()
+    if self._toc is not None:
+      self._write_toc()
+    self._flush_writes()
+    self._close_output()
+    if self._toc_offset is not None:
+      if self._hashed_outputs:
+        self._hashed_outputs[0][1].write(estargz.footer(self._toc_offset))
+      else:
+        with open(self.name, 'ab') as f:
+          f.write(estargz.footer(self._toc_offset))
+    for fileobj, proc, cmd in self._extra_outputs:
+      fileobj.close()
+      self.stats.update(fileobj.stats)
+      if proc and proc.wait() != 0:
+        raise self.Error('Compression command "{}" failed'.format(
+            ' '.join(cmd)))
+    if self._seekable_index:
+      seekable.write_index(self._seekable_index, self._seekable_compression,
+                           self._index_entries)
+    if self._split_size:
+      self.stats['volumes'] = len(self._volumes)
+      if self._split_index:
+        volumes.write_index(self._split_index, self._volumes,
+                            self._volume_entries)
+    if self._digests_file:
+      self._write_digests()
+
+  def _write_digests(self):
+    """Closes the hashed outputs and writes their digests."""
+    for thread in self._copy_threads:
+      thread.join()
+    outputs = []
+    for name, fileobj, raw, uncompressed in self._hashed_outputs:
+      raw.close()
+      digests = fileobj.digests()
+      if digests is None:
+        self.stats['digests_rehashed_files'] += 1
+        digests = hashing_writer.hash_file(name, self._digest_algorithms)
+      outputs.append((name, digests, uncompressed))
+    hashing_writer.write_digests(self._digests_file, outputs)
+
+  def _write_whiteouts(self):
+    """Adds whiteouts for the members of the diff base which are gone."""
+    present = {
+        layer_diff.normalize(path): self.existing_members.get(path)
+        for path in self.existing_members
+    }
+    diff_base = self._diff_base
+    # The whiteouts are not compared to the base.
+    self._diff_base = None
+    for name in diff_base.whiteouts(present):
+      info = tarfile.TarInfo(name)
+      info.mode = 0o644
+      info.mtime = self.default_mtime
+      if self._addfile(info, io.BytesIO()):
+        self.stats['diff_whiteouts'] += 1
+
+  def _close_output(self):
+    """Closes the output tar file, or the current volume of a split archive."""
     self.tar.close()
+    if self._tar_hash is not None:
+      # The outputs without digests of their tar stream yet are this one,
+      # and its extra outputs.
+      uncompressed = self._tar_hash.digests()
+      for output in self._hashed_outputs:
+        if output[3] is None:
+          output[3] = uncompressed
     # Close the file object if necessary.
     if self.fileobj:
       self.fileobj.close()
+      if isinstance(self.fileobj, pipe_writer.PipeWriter):
+        self.stats.update(self.fileobj.stats)
     if self.compressor_proc and self.compressor_proc.wait() != 0:
       raise self.Error('Custom compression command '
                        '"{}" failed'.format(self.compressor_cmd))
@@ -0,0 +1,71 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Archives split in volumes of bounded size.
+
+A split archive is a sequence of tar files, the volumes, each of them a
+complete archive which can be extracted on its own. A new volume starts at a
+member boundary, once the current one would grow past the size budget. The
+index of a split archive is a JSON file:
+
+  {
+    "version": 1,
+    "volumes": ["out.tar", "out.tar.volumes/out.tar.001", ...],
+    "members": [["./etc/config", 0], ["./usr/bin/app", 1], ...]
+  }
+
+Volume paths are relative to the directory of the index. Members are listed
+in the order of the archive, with the position of their volume in `volumes`.
+"""
+
+import json
+import os
+
+INDEX_VERSION = 1
+
+
+def volume_name(name, volume, directory=None):
+  """Returns the file name of a volume of the split archive `name`.
+
+  Args:
+    name: the file name of the archive, which is also its first volume.
+    volume: the number of the volume, starting at 0.
+    directory: directory of the volumes after the first one, default to the
+        directory of `name`.
+  """
+  if volume == 0:
+    return name
+  if directory is None:
+    directory = os.path.dirname(name)
+  return os.path.join(directory, '%s.%03d' % (os.path.basename(name), volume))
+
+
+def write_index(path, volumes, members):
+  """Writes the index of a split archive.
+
+  Args:
+    path: the index file name.
+    volumes: the file names of the volumes, in order.
+    members: list of (name, volume) of the members of the archive.
+  """
+  base = os.path.dirname(os.path.abspath(path))
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump({
+        'version': INDEX_VERSION,
+        'volumes': [
+            os.path.relpath(os.path.abspath(v), base).replace(os.path.sep, '/')
+            for v in volumes
+        ],
+        'members': members,
+    }, f, separators=(',', ':'))
+    f.write('\n')
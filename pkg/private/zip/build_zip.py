@@ -14,14 +14,23 @@
 """This tool builds zip files from a list of inputs."""
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import functools
 import logging
 import os
+import shutil
+import struct
 import sys
 import zipfile
 
 from pkg.private import build_info
+from pkg.private import hashing_writer
 from pkg.private import manifest
+from pkg.private import stat_cache
+from pkg.private.zip import compression_policy
+from pkg.private.zip import entry_cache
 
 ZIP_EPOCH = 315532800
 
@@ -31,6 +40,33 @@ UNIX_SYMLINK_BIT = 0o120000
 UNIX_DIR_BIT  =    0o040000
 MSDOS_DIR_BIT = 0x10
 
+# Amount of file content read ahead of the writes with compression threads.
+MAX_PENDING_SIZE = 64 * 1024 * 1024
+
+# Files larger than this are compressed as they are read, in chunks of
+# _CHUNK_SIZE, instead of being read at once.
+STREAMING_SIZE = 64 * 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024
+
+# General purpose flag of entries followed by a data descriptor with their
+# CRC and sizes.
+_DATA_DESCRIPTOR_FLAG = 0x08
+# ID of the ZIP64 extra field, which zipfile adds when needed, and size of
+# the one it adds to local headers.
+_ZIP64_EXTRA_ID = 0x0001
+_ZIP64_EXTRA_SIZE = 20
+# Extra field padding local headers so that the data of entries is aligned,
+# as written by Android's zipalign: ID, size, alignment, then zeros.
+_ALIGNMENT_EXTRA = struct.Struct('<HHH')
+_ALIGNMENT_EXTRA_ID = 0xd935
+# Indexes of the name and extra field lengths in zipfile.structFileHeader.
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+
+# A member of an input zip, copied to dest. See _load_manifest().
+ZipMember = collections.namedtuple(
+    'ZipMember', ['dest', 'origin', 'zip_path', 'info'])
+
 def _create_argument_parser():
   """Creates the command line arg parser."""
   parser = argparse.ArgumentParser(description='create a zip file',
@@ -55,9 +91,56 @@ def _create_argument_parser():
   parser.add_argument(
       '-l', '--compression_level',
       help='The compression level to use')
+  parser.add_argument(
+      '--compression_threads', type=int, default=1,
+      help='Number of threads compressing file entries ahead of their write.')
+  parser.add_argument(
+      '--compression_policy', action='append', default=[],
+      help='Compression of the files matching a glob pattern, as'
+           ' pattern=compression[:level], e.g. *.jpg=stored. Patterns without'
+           ' / match the base name. The first matching pattern applies.')
+  parser.add_argument(
+      '--detect_incompressible', action='store_true',
+      help='Store the files which are already compressed, detected from'
+           ' their magic bytes or from the compression of samples.')
+  parser.add_argument(
+      '--alignment', type=compression_policy.parse_alignment, default=0,
+      help='Align the data of stored files on multiples of this many bytes,'
+           ' e.g. 4096 to mmap them, by padding their local headers.')
+  parser.add_argument(
+      '--alignment_policy', action='append', default=[],
+      help='Alignment of the data of the stored files matching a glob'
+           ' pattern, as pattern=alignment, e.g. *.so=4096. Patterns are'
+           ' matched like those of --compression_policy.')
+  parser.add_argument(
+      '--entry_cache',
+      help='Directory of a cache of deflated entries, shared between'
+           ' builds, from which unchanged files are copied instead of being'
+           ' compressed again.')
+  parser.add_argument(
+      '--entry_cache_size', type=int, default=entry_cache.DEFAULT_MAX_SIZE,
+      help='With --entry_cache, size over which the least recently used'
+           ' entries of the cache are deleted.')
+  parser.add_argument(
+      '--stats', action='store_true',
+      help='Print statistics about the compression of each class of files'
+           ' when done.')
   parser.add_argument('--manifest',
                       help='manifest of contents to add to the layer.',
                       required=True)
+  parser.add_argument(
+      '--zip', action='append', default=[],
+      help='A zip file whose members are added to the zip, under --directory,'
+           ' without decompressing them. May be repeated.')
+  parser.add_argument(
+      '--digests_file',
+      help='Write the digests of the zip file, computed while it is written,'
+           ' to this JSON file.')
+  parser.add_argument(
+      '--digest_algorithms', type=hashing_writer.parse_algorithms,
+      default=list(hashing_writer.DEFAULT_ALGORITHMS),
+      help='With --digests_file, comma separated list of the digests to'
+           ' compute, e.g. sha256,sha512.')
   parser.add_argument(
       'files', type=str, nargs='*',
       help='Files to be added to the zip, in the form of {srcpath}={dstpath}.')
@@ -78,9 +161,75 @@ def parse_date(ts):
   return (ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second)
 
 
+def _strip_zip64_extra(extra):
+  """Returns an extra field without its ZIP64 record."""
+  result = b''
+  i = 0
+  while i + 4 <= len(extra):
+    header_id, size = struct.unpack('<HH', extra[i:i + 4])
+    if header_id != _ZIP64_EXTRA_ID:
+      result += extra[i:i + 4 + size]
+    i += 4 + size
+  return result
+
+
+def _read_and_compress(path, size, compress_type, compresslevel, policy,
+                       cache=None):
+  """Returns the content of a file and its compressed data in a zip entry.
+
+  The compressor is the one zipfile would use, and is fed the same way as by
+  ZipFile.writestr(), so that the data is the same.
+
+  Returns:
+    (content, compressed data, None, cache hit), or
+    (content, None, detection, None) if the policy detected that the content
+    is incompressible. The cache hit is None if the cache was not used.
+  """
+  with open(path, 'rb') as f:
+    detection = policy.detect(f, size, compress_type, compresslevel)
+    data = f.read()
+  if detection:
+    return data, None, detection, None
+  if cache is None:
+    compressor = zipfile._get_compressor(compress_type, compresslevel)  # pylint: disable=protected-access
+    return data, compressor.compress(data) + compressor.flush(), None, None
+  key = cache.key(data, compress_type, compresslevel)
+  compressed = cache.get(key, data)
+  if compressed is not None:
+    return data, compressed, None, True
+  compressor = zipfile._get_compressor(compress_type, compresslevel)  # pylint: disable=protected-access
+  compressed = compressor.compress(data) + compressor.flush()
+  cache.put(key, data, compressed)
+  return data, compressed, None, False
+
+
+class _Precompressed(object):
+  """Stands for the compressor of a zip entry, returning data compressed before."""
+
+  def __init__(self, compressed):
+    self._compressed = compressed
+
+  def compress(self, data):
+    del data  # Unused, the compressed data is known.
+    compressed = self._compressed
+    self._compressed = b''
+    return compressed
+
+  def flush(self):
+    return self._compressed
+
+
 class ZipWriter(object):
 
-  def __init__(self, output_path: str, time_stamp: int, default_mode: int, compression_type: str, compression_level: int):
+  def __init__(self, output_path: str, time_stamp: int, default_mode: int, compression_type: str, compression_level: int,
+               digests_file: str = None,
+               digest_algorithms=hashing_writer.DEFAULT_ALGORITHMS,
+               compression_threads: int = 1,
+               compression_policies=(),
+               detect_incompressible: bool = False,
+               cache: entry_cache.EntryCache = None,
+               alignment: int = 0,
+               alignment_policies=()):
     """Create a writer.
 
     You must close() after use or use in a 'with' statement.
@@ -89,19 +238,68 @@ class ZipWriter(object):
       output_path: path to write to
       time_stamp: time stamp to add to files
       default_mode: file mode to use if not specified in the entry.
+      digests_file: if set, hash the zip file while it is written, and write
+          its digests to this file, see hashing_writer.py.
+      digest_algorithms: names of the hashlib algorithms of the digests.
+      compression_threads: number of threads compressing file entries. The
+          entries are still written in order, and the zip file is the same
+          as with a single thread.
+      compression_policies: list of (glob pattern, compression) of the files
+          compressed differently, where compression is a value of
+          compression_policy.parse_compression(). See
+          compression_policy.CompressionPolicy.
+      detect_incompressible: store the files whose content is detected as
+          already compressed.
+      cache: an entry_cache.EntryCache to take the compressed data of files
+          from, and to add it to. Files streamed because of their size, or
+          with a compression the cache does not keep, do not use it.
+      alignment: align the data of stored files on multiples of this many
+          bytes, 0 for none.
+      alignment_policies: list of (glob pattern, alignment) of the files
+          aligned differently.
     """
     self.output_path = output_path
     self.time_stamp = time_stamp
     self.default_mode = default_mode
-    compressions = {
-      "deflated": zipfile.ZIP_DEFLATED,
-      "lzma": zipfile.ZIP_LZMA,
-      "bzip2": zipfile.ZIP_BZIP2,
-      "stored": zipfile.ZIP_STORED
-    }
-    self.compression_type = compressions[compression_type]
+    self.compression_type = compression_policy.COMPRESSION_TYPES[compression_type]
     self.compression_level = compression_level
-    self.zip_file = zipfile.ZipFile(self.output_path, mode='w', compression=self.compression_type)
+    self.policy = compression_policy.CompressionPolicy(
+        self.compression_type, compression_level,
+        patterns=compression_policies,
+        detect_incompressible=detect_incompressible,
+        alignment=alignment,
+        alignment_patterns=alignment_policies)
+    self.cache = cache
+    # Counters about the compression of each class of files, see
+    # _record_file(), and about the cache.
+    self.stats = collections.Counter()
+    self.digests_file = digests_file
+    self.digest_algorithms = digest_algorithms
+    self._raw_output = None
+    self._hashing_output = None
+    output = self.output_path
+    if digests_file:
+      # zipfile seeks back to complete the local headers, which the
+      # HashingWriter keeps until they are final.
+      self._raw_output = open(self.output_path, 'wb')
+      self._hashing_output = hashing_writer.HashingWriter(
+          self._raw_output, digest_algorithms, closefd=False)
+      output = self._hashing_output
+    self.zip_file = zipfile.ZipFile(output, mode='w', compression=self.compression_type)
+    self.stat_cache = stat_cache.StatCache()
+    self._executor = None
+    # Python 3.6 and lower don't support compresslevel, nor its compressors.
+    if (compression_threads > 1 and sys.version_info >= (3, 7) and
+        hasattr(zipfile, '_get_compressor') and
+        (self.compression_type != zipfile.ZIP_STORED or compression_policies)):
+      self._executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=compression_threads)
+    # (future or None, write, size) of the entries not written yet, in order.
+    # See _enqueue().
+    self._pending = collections.deque()
+    self._pending_size = 0
+    # Input zips, by path, see add_zip_member().
+    self._input_zips = {}
 
   def __enter__(self):
     return self
@@ -110,10 +308,38 @@ class ZipWriter(object):
     self.close()
 
   def close(self):
+    self._write_pending()
+    if self._executor:
+      self._executor.shutdown()
+    for key, value in list(self.stats.items()):
+      if key.startswith('input_bytes[') and value:
+        entry_class = key[len('input_bytes'):]
+        self.stats['ratio' + entry_class] = round(
+            self.stats['output_bytes' + entry_class] / value, 3)
+      elif key.startswith('compression_seconds_saved['):
+        self.stats[key] = round(value, 3)
     self.zip_file.close()
     self.zip_file = None
+    for input_zip in self._input_zips.values():
+      input_zip.close()
+    self._input_zips.clear()
+    if self.cache is not None:
+      if self.stats['entry_cache_misses']:
+        self.cache.trim()
+      self.stats.update(self.cache.stats)
+    if self._raw_output:
+      self._raw_output.close()
+      digests = self._hashing_output.digests()
+      if digests is None:
+        digests = hashing_writer.hash_file(self.output_path,
+                                           self.digest_algorithms)
+      hashing_writer.write_digests(self.digests_file,
+                                   [(self.output_path, digests, None)])
 
   def writestr(self, entry_info, content: str, compresslevel: int):
+    # As in ZipFile.writestr(), the size tells whether the entry needs ZIP64.
+    extra = self._align(entry_info,
+                        len(content) * 1.05 > zipfile.ZIP64_LIMIT)
     if sys.version_info >= (3, 7):
       self.zip_file.writestr(entry_info, content, compresslevel=compresslevel)
     else:
@@ -121,6 +347,210 @@ class ZipWriter(object):
       self.zip_file.writestr(entry_info, content)
       if compresslevel != 6:
         logging.warn("Custom compresslevel is not supported with python < 3.7")
+    entry_info.extra = extra
+
+  def _align(self, entry_info, zip64):
+    """Pads the local header of a stored file so that its data is aligned.
+
+    Must be called right before the entry is written, the padding depends on
+    its offset.
+
+    Args:
+      entry_info: the ZipInfo of the entry.
+      zip64: whether the local header gets a ZIP64 extra field.
+
+    Returns:
+      The extra field of the entry without padding, to restore once the local
+      header is written, for the central directory.
+    """
+    extra = entry_info.extra
+    if entry_info.compress_type != zipfile.ZIP_STORED:
+      return extra
+    alignment = self.policy.alignment(entry_info.filename)
+    if not alignment:
+      return extra
+    # zipfile writes the local header at start_dir.
+    offset = (self.zip_file.start_dir + zipfile.sizeFileHeader +
+              len(entry_info.filename.encode('utf-8')) + len(extra) +
+              _ALIGNMENT_EXTRA.size + (_ZIP64_EXTRA_SIZE if zip64 else 0))
+    padding = -offset % alignment
+    entry_info.extra = extra + _ALIGNMENT_EXTRA.pack(
+        _ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + bytes(padding)
+    self.stats['alignment_padding_bytes'] += _ALIGNMENT_EXTRA.size + padding
+    return extra
+
+  def _enqueue(self, write, job=None, size=0):
+    """Writes an entry once the entries before it are written.
+
+    Args:
+      write: function writing the entry, called with the result of `job`.
+      job: function run by the compression threads, if any, before write.
+      size: amount of memory used by the result of job until it is written.
+    """
+    if self._executor is None:
+      write(job() if job else None)
+      return
+    self._write_pending(MAX_PENDING_SIZE - size)
+    future = self._executor.submit(job) if job else None
+    self._pending.append((future, write, size))
+    self._pending_size += size
+
+  def _write_pending(self, max_size=None):
+    """Writes pending entries, in order.
+
+    Args:
+      max_size: write the entries which are ready, then more until at most
+          max_size bytes are pending. Write them all if None.
+    """
+    while self._pending and (
+        max_size is None or self._pending_size > max_size or
+        self._pending[0][0] is None or self._pending[0][0].done()):
+      future, write, size = self._pending.popleft()
+      write(future.result() if future else None)
+      self._pending_size -= size
+
+  def _record_file(self, entry_info, detection):
+    """Counts a file entry in the statistics of its class."""
+    entry_class = '[%s]' % compression_policy.entry_class(entry_info.filename)
+    self.stats['entries' + entry_class] += 1
+    self.stats['input_bytes' + entry_class] += entry_info.file_size
+    self.stats['output_bytes' + entry_class] += entry_info.compress_size
+    if detection:
+      self.stats['incompressible_entries' + entry_class] += 1
+      self.stats['compression_seconds_saved' + entry_class] += (
+          detection.seconds_saved)
+
+  def _write_precompressed(self, entry_info, compresslevel, result):
+    """Writes a file entry, from the result of _read_and_compress()."""
+    data, compressed, detection, cache_hit = result
+    if cache_hit is not None:
+      self.stats['entry_cache_hits' if cache_hit else 'entry_cache_misses'] += 1
+    if detection:
+      entry_info.compress_type = zipfile.ZIP_STORED
+      self.writestr(entry_info, data, compresslevel=compresslevel)
+    else:
+      # As in ZipFile.writestr().
+      entry_info.file_size = len(data)
+      entry_info._compresslevel = compresslevel  # pylint: disable=protected-access
+      with self.zip_file.open(entry_info, mode='w') as dest:
+        dest._compressor = _Precompressed(compressed)  # pylint: disable=protected-access
+        dest.write(data)
+    self._record_file(entry_info, detection)
+
+  def _writestr(self, entry_info, data):
+    """Calls ZipFile.writestr() once the pending entries are written."""
+    self._enqueue(lambda _: self.zip_file.writestr(entry_info, data))
+
+  def _stream_file(self, entry_info, path, size, compresslevel):
+    """Writes a file entry, compressing the file as it is read."""
+    # As in ZipFile.writestr(), the size tells whether the entry needs ZIP64.
+    entry_info.file_size = size
+    if sys.version_info >= (3, 7):
+      entry_info._compresslevel = compresslevel  # pylint: disable=protected-access
+    with open(path, 'rb') as src:
+      detection = self.policy.detect(src, size, entry_info.compress_type,
+                                     compresslevel)
+      if detection:
+        entry_info.compress_type = zipfile.ZIP_STORED
+      # As in ZipFile.open(), the size tells whether the entry needs ZIP64.
+      extra = self._align(entry_info, size * 1.05 > zipfile.ZIP64_LIMIT)
+      with self.zip_file.open(entry_info, mode='w') as dest:
+        shutil.copyfileobj(src, dest, _CHUNK_SIZE)
+      entry_info.extra = extra
+    self._record_file(entry_info, detection)
+
+  def write_file(self, entry_info, path):
+    """Adds a file entry with the content of the file at path.
+
+    Its compression is the one the policy selects for it.
+    """
+    size = self.stat_cache.getsize(os.fsdecode(path))
+    entry_info.compress_type, compresslevel = self.policy.select(
+        entry_info.filename)
+    if size > STREAMING_SIZE:
+      self._enqueue(
+          lambda _: self._stream_file(entry_info, path, size, compresslevel))
+      return
+    cache = self.cache
+    if not entry_cache.EntryCache.caches(entry_info.compress_type):
+      cache = None
+    if ((self._executor is None and cache is None) or
+        entry_info.compress_type == zipfile.ZIP_STORED):
+      def write(_):
+        with open(path, 'rb') as src:
+          detection = self.policy.detect(src, size, entry_info.compress_type,
+                                         compresslevel)
+          if detection:
+            entry_info.compress_type = zipfile.ZIP_STORED
+          self.writestr(entry_info, src.read(), compresslevel=compresslevel)
+        self._record_file(entry_info, detection)
+      self._enqueue(write, size=0)
+      return
+    self._enqueue(
+        functools.partial(self._write_precompressed, entry_info,
+                          compresslevel),
+        job=functools.partial(_read_and_compress, path, size,
+                              entry_info.compress_type, compresslevel,
+                              self.policy, cache),
+        size=size)
+
+  def add_zip_member(self, member):
+    """Adds a member of another zip, copying its compressed data as is.
+
+    Only the name of the member changes: its compression, CRC, sizes,
+    timestamp, attributes and extra fields are kept.
+
+    Args:
+      member: a ZipMember.
+    """
+    info = member.info
+    dest = member.dest
+    if info.is_dir():
+      dest += '/'
+    entry_info = zipfile.ZipInfo(filename=dest, date_time=info.date_time)
+    for attr in ('compress_type', 'comment', 'create_system', 'create_version',
+                 'extract_version', 'volume', 'internal_attr', 'external_attr',
+                 'CRC', 'compress_size', 'file_size'):
+      setattr(entry_info, attr, getattr(info, attr))
+    # The local header is written with the CRC and sizes, the data descriptor
+    # after the data of the original entry is not copied.
+    entry_info.flag_bits = (info.flag_bits & ~_DATA_DESCRIPTOR_FLAG) | 0x800
+    entry_info.extra = _strip_zip64_extra(info.extra)
+    self._enqueue(
+        lambda _: self._copy_member(entry_info, member.zip_path, info))
+
+  def _copy_member(self, entry_info, zip_path, info):
+    src = self._input_zips.get(zip_path)
+    if src is None:
+      src = self._input_zips[zip_path] = open(zip_path, 'rb')
+    src.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           src.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+      raise zipfile.BadZipFile(
+          'Bad local header of %s in %s' % (info.filename, zip_path))
+    src.seek(header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH],
+             os.SEEK_CUR)
+    # As in ZipFile.write(), without the compression.
+    out = self.zip_file.fp
+    extra = self._align(
+        entry_info, max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT)
+    entry_info.header_offset = out.tell()
+    out.write(entry_info.FileHeader())
+    entry_info.extra = extra
+    remaining = info.compress_size
+    while remaining > 0:
+      data = src.read(min(remaining, _CHUNK_SIZE))
+      if not data:
+        raise zipfile.BadZipFile(
+            'Truncated data of %s in %s' % (info.filename, zip_path))
+      out.write(data)
+      remaining -= len(data)
+    self.zip_file.start_dir = out.tell()
+    self.zip_file.filelist.append(entry_info)
+    self.zip_file.NameToInfo[entry_info.filename] = entry_info
+    self.stats['zip_members_copied'] += 1
+    self.stats['zip_bytes_copied'] += info.compress_size
 
   def make_zipinfo(self, path: str, mode: str):
     """Create a Zipinfo.
@@ -170,28 +600,27 @@ class ZipWriter(object):
       entry_info.compress_type = self.compression_type
       # Using utf-8 for the file names is for python <3.7 compatibility.
       entry_info.external_attr |= UNIX_FILE_BIT << 16
-      with open(src.encode('utf-8'), 'rb') as src_content:
-        self.writestr(entry_info, src_content.read(), compresslevel=self.compression_level)
+      self.write_file(entry_info, src.encode('utf-8'))
     elif entry_type == manifest.ENTRY_IS_DIR:
       entry_info.compress_type = zipfile.ZIP_STORED
       # Set directory bits
       entry_info.external_attr |= (UNIX_DIR_BIT << 16) | MSDOS_DIR_BIT
-      self.zip_file.writestr(entry_info, '')
+      self._writestr(entry_info, '')
     elif entry_type == manifest.ENTRY_IS_LINK:
       entry_info.compress_type = zipfile.ZIP_STORED
       # Set directory bits
       entry_info.external_attr |= (UNIX_SYMLINK_BIT << 16)
-      self.zip_file.writestr(entry_info, src.encode('utf-8'))
+      self._writestr(entry_info, src.encode('utf-8'))
     elif entry_type == manifest.ENTRY_IS_RAW_LINK:
       entry_info.compress_type = zipfile.ZIP_STORED
       # Set directory bits
       entry_info.external_attr |= (UNIX_SYMLINK_BIT << 16)
-      self.zip_file.writestr(entry_info, os.readlink(src).encode('utf-8'))
+      self._writestr(entry_info, os.readlink(src).encode('utf-8'))
     elif entry_type == manifest.ENTRY_IS_TREE:
       self.add_tree(src, dst_path, mode)
     elif entry_type == manifest.ENTRY_IS_EMPTY_FILE:
       entry_info.compress_type = zipfile.ZIP_STORED
-      self.zip_file.writestr(entry_info, '')
+      self._writestr(entry_info, '')
     else:
       raise Exception('Unknown type for manifest entry:', entry)
 
@@ -213,55 +642,63 @@ class ZipWriter(object):
     # paths should not have a leading ./
     dest = '' if dest == '.' else dest + '/'
 
-    to_write = {}
-    for root, dirs, files in os.walk(tree_top):
-      # While `tree_top` uses '/' as a path separator, results returned by
-      # `os.walk` and `os.path.join` on Windows may not.
-      root = os.path.normpath(root).replace(os.path.sep, '/')
-
-      rel_path_from_top = root[len(tree_top):].lstrip('/')
-      if rel_path_from_top:
-        dest_dir = dest + rel_path_from_top + '/'
-      else:
-        dest_dir = dest
-      to_write[dest_dir] = None
-      for file in files:
-        content_path = os.path.abspath(os.path.join(root, file))
-        if os.name == "nt":
-          # "To specify an extended-length path, use the `\\?\` prefix. For
-          # example, `\\?\D:\very long path`."[1]
-          #
-          # [1]: https://learn.microsoft.com/en-us/windows/win32/fileio/maximum-file-path-limitation
-          to_write[dest_dir + file] = "\\\\?\\" + content_path
-        else:
-          to_write[dest_dir + file] = content_path
-
-    for path in sorted(to_write.keys()):
-      content_path = to_write[path]
-      if content_path:
-        # If mode is unspecified, derive the mode from the file's mode.
-        if mode is None:
-          f_mode = "0o755" if os.access(content_path, os.X_OK) else self.default_mode
-        else:
-          f_mode = mode
-        entry_info = self.make_zipinfo(path=path, mode=f_mode)
-        entry_info.compress_type = self.compression_type
-        with open(content_path, 'rb') as src:
-          self.writestr(entry_info, src.read(), compresslevel=self.compression_level)
-      else:
+    # Entries come in the sorted order of their paths, while the rest of the
+    # tree is listed in the background.
+    for tree_entry in self.stat_cache.walk_tree(tree_top, dir_suffix='/'):
+      if tree_entry.is_dir:
+        if tree_entry.is_link:
+          continue
         # Implicitly created directory
-        dir_path = path
+        if tree_entry.rel_path:
+          dir_path = dest + tree_entry.rel_path + '/'
+        else:
+          dir_path = dest
         if not dir_path.endswith('/'):
           dir_path += '/'
         entry_info = self.make_zipinfo(path=dir_path, mode="0o755")
         entry_info.compress_type = zipfile.ZIP_STORED
         # Set directory bits
         entry_info.external_attr |= (UNIX_DIR_BIT << 16) | MSDOS_DIR_BIT
-        self.zip_file.writestr(entry_info, '')
-
-def _load_manifest(prefix, manifest_path):
+        self._writestr(entry_info, '')
+        continue
+      content_path = os.path.abspath(tree_entry.path)
+      if os.name == "nt":
+        # "To specify an extended-length path, use the `\\?\` prefix. For
+        # example, `\\?\D:\very long path`."[1]
+        #
+        # [1]: https://learn.microsoft.com/en-us/windows/win32/fileio/maximum-file-path-limitation
+        content_path = "\\\\?\\" + content_path
+      # If mode is unspecified, derive the mode from the file's mode.
+      if mode is None:
+        f_mode = "0o755" if self.stat_cache.is_executable(content_path) else self.default_mode
+      else:
+        f_mode = mode
+      entry_info = self.make_zipinfo(path=dest + tree_entry.rel_path, mode=f_mode)
+      entry_info.compress_type = self.compression_type
+      self.write_file(entry_info, content_path)
+
+def _load_manifest(prefix, manifest_path, zip_paths=()):
+  """Returns the entries of the zip, sorted by path.
+
+  Args:
+    prefix: directory of all the entries in the zip.
+    manifest_path: path of the manifest of the entries.
+    zip_paths: paths of zips whose members are added as ZipMember entries.
+        As for the entries of the manifest, the last entry for a path wins:
+        a later zip overrides the members of an earlier one, and the entries
+        of the manifest override those of the zips.
+  """
   manifest_map = {}
 
+  for zip_path in zip_paths:
+    with zipfile.ZipFile(zip_path) as input_zip:
+      for info in input_zip.infolist():
+        dest = _combine_paths(prefix, info.filename).rstrip('/')
+        if dest:
+          manifest_map[dest] = ZipMember(
+              dest=dest, origin='member of {}'.format(zip_path),
+              zip_path=zip_path, info=info)
+
   for entry in manifest.read_entries_from(manifest_path):
     entry.dest = _combine_paths(prefix, entry.dest)
     manifest_map[entry.dest] = entry
@@ -300,11 +737,41 @@ def main(args):
     default_mode = int(args.mode, 8)
   compression_level = int(args.compression_level)
 
-  manifest = _load_manifest(args.directory, args.manifest)
+  compression_policies = []
+  for policy in args.compression_policy:
+    pattern, _, compression = policy.rpartition('=')
+    compression_policies.append(
+        (pattern, compression_policy.parse_compression(compression)))
+
+  alignment_policies = []
+  for policy in args.alignment_policy:
+    pattern, _, alignment = policy.rpartition('=')
+    alignment_policies.append(
+        (pattern, compression_policy.parse_alignment(alignment)))
+
+  cache = None
+  if args.entry_cache:
+    cache = entry_cache.EntryCache(args.entry_cache, args.entry_cache_size)
+
+  manifest = _load_manifest(args.directory, args.manifest, args.zip)
   with ZipWriter(
-      args.output, time_stamp=ts, default_mode=default_mode, compression_type=args.compression_type, compression_level=compression_level) as zip_out:
+      args.output, time_stamp=ts, default_mode=default_mode, compression_type=args.compression_type, compression_level=compression_level,
+      digests_file=args.digests_file,
+      digest_algorithms=args.digest_algorithms,
+      compression_threads=args.compression_threads,
+      compression_policies=compression_policies,
+      detect_incompressible=args.detect_incompressible,
+      cache=cache,
+      alignment=args.alignment,
+      alignment_policies=alignment_policies) as zip_out:
     for entry in manifest:
-      zip_out.add_manifest_entry(entry)
+      if isinstance(entry, ZipMember):
+        zip_out.add_zip_member(entry)
+      else:
+        zip_out.add_manifest_entry(entry)
+  if args.stats:
+    for key, value in sorted(zip_out.stats.items()):
+      print('%s: %s: %s' % (args.output, key, value))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Choice of the compression of each zip entry.
+
+Files which are already compressed, like images, archives or wheels, do not
+get smaller when compressed again, it only costs CPU time. A
+CompressionPolicy picks the compression of an entry:
+- from glob patterns of its path, the first matching pattern wins;
+- optionally, by detecting that its content is incompressible, from the
+  magic bytes at the start of the file, or from the compression of a few
+  samples of it.
+
+It also picks the alignment of the data of stored entries, globally or from
+glob patterns, so that loaders can mmap them out of the zip.
+"""
+
+import collections
+import fnmatch
+import posixpath
+import time
+import zipfile
+
+COMPRESSION_TYPES = {
+    'deflated': zipfile.ZIP_DEFLATED,
+    'lzma': zipfile.ZIP_LZMA,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'stored': zipfile.ZIP_STORED,
+}
+
+# Magic bytes of compressed formats, by offset in the file.
+_MAGIC = (
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (8, b'WEBP', 'webp'),
+    (4, b'ftyp', 'mp4'),
+    (0, b'OggS', 'ogg'),
+    (0, b'fLaC', 'flac'),
+    (0, b'ID3', 'mp3'),
+    (0, b'wOF2', 'woff2'),
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'\x1f\x8b\x08', 'gzip'),
+    (0, b'BZh', 'bzip2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'\x28\xb5\x2f\xfd', 'zstd'),
+    (0, b'\x04\x22\x4d\x18', 'lz4'),
+    (0, b'7z\xbc\xaf\x27\x1c', '7z'),
+)
+
+# Files smaller than this are always compressed.
+MIN_DETECTION_SIZE = 4096
+
+# Size and number of the samples compressed to detect incompressible content,
+# taken evenly from the start to the end of the file.
+SAMPLE_SIZE = 32 * 1024
+SAMPLES = 3
+
+# Content compressing to more than this fraction of its size is stored.
+MAX_RATIO = 0.95
+
+# Alignments are stored in 16 bits in the extra field padding local headers.
+MAX_ALIGNMENT = 32768
+
+# Result of CompressionPolicy.detect() for incompressible content: the way it
+# was detected, 'trial' or the format from the magic bytes, and an estimate
+# of the CPU time that compressing all of it would have taken.
+Detection = collections.namedtuple('Detection', ['kind', 'seconds_saved'])
+
+
+def parse_compression(value):
+  """Returns (compression type, level or None) of 'deflated', 'deflated:9'..."""
+  name, _, level = value.partition(':')
+  if name not in COMPRESSION_TYPES:
+    raise ValueError('Unknown compression: %r' % name)
+  return COMPRESSION_TYPES[name], int(level) if level else None
+
+
+def parse_alignment(value):
+  """Returns the alignment of '4096'..., 0 for none."""
+  alignment = int(value)
+  if alignment and (alignment < 0 or alignment > MAX_ALIGNMENT or
+                    alignment & (alignment - 1)):
+    raise ValueError(
+        'Alignment must be a power of 2 up to %d: %r' % (MAX_ALIGNMENT, value))
+  return alignment
+
+
+def entry_class(path):
+  """Returns the class of an entry in the statistics: its lowercase extension."""
+  return posixpath.splitext(path)[1].lower() or '(none)'
+
+
+def _matches(pattern, path):
+  # Patterns without a directory apply to the base name, like in .gitignore.
+  if '/' not in pattern:
+    path = posixpath.basename(path)
+  return fnmatch.fnmatchcase(path, pattern)
+
+
+class CompressionPolicy(object):
+  """Picks the compression of zip entries."""
+
+  def __init__(self, compression_type, compression_level, patterns=(),
+               detect_incompressible=False, alignment=0,
+               alignment_patterns=()):
+    """Create the policy.
+
+    Args:
+      compression_type: the zipfile compression of the entries matching no
+          pattern.
+      compression_level: the compression level, unless a pattern sets one.
+      patterns: list of (glob pattern, (compression type, level or None)), in
+          order of precedence. Patterns without '/' match the base name of
+          entries, other patterns their whole path.
+      detect_incompressible: whether to store entries whose content is
+          detected as incompressible.
+      alignment: the alignment of the data of the stored entries matching no
+          alignment pattern, 0 for none.
+      alignment_patterns: list of (glob pattern, alignment), in order of
+          precedence, matched like patterns.
+    """
+    self.compression_type = compression_type
+    self.compression_level = compression_level
+    self.patterns = list(patterns)
+    self.detect_incompressible = detect_incompressible
+    self.default_alignment = alignment
+    self.alignment_patterns = list(alignment_patterns)
+
+  def select(self, path):
+    """Returns (compression type, level) of the entry at path."""
+    for pattern, (compression_type, level) in self.patterns:
+      if _matches(pattern, path):
+        if level is None:
+          level = self.compression_level
+        return compression_type, level
+    return self.compression_type, self.compression_level
+
+  def alignment(self, path):
+    """Returns the alignment of the data of the entry at path if stored."""
+    for pattern, alignment in self.alignment_patterns:
+      if _matches(pattern, path):
+        return alignment
+    return self.default_alignment
+
+  def detect(self, fileobj, size, compression_type, level):
+    """Tells whether the content of a file is incompressible.
+
+    Args:
+      fileobj: the file, at its start, where it is left.
+      size: the size of the file.
+      compression_type: the compression the entry would have.
+      level: the level of that compression.
+
+    Returns:
+      A Detection if the content should be stored, None otherwise.
+    """
+    if (not self.detect_incompressible or size < MIN_DETECTION_SIZE or
+        compression_type == zipfile.ZIP_STORED):
+      return None
+    head = fileobj.read(SAMPLE_SIZE)
+    kind = None
+    for offset, magic, name in _MAGIC:
+      if head[offset:offset + len(magic)] == magic:
+        kind = name
+        break
+    samples = [head]
+    step = (size - SAMPLE_SIZE) // (SAMPLES - 1)
+    if kind is None and step > SAMPLE_SIZE:
+      for i in range(1, SAMPLES):
+        fileobj.seek(i * step)
+        samples.append(fileobj.read(SAMPLE_SIZE))
+    fileobj.seek(0)
+    sampled = sum(len(sample) for sample in samples)
+    # Compress the samples the way the entry would be, to check their ratio,
+    # and to estimate the time compressing all the content would take. The
+    # magic bytes are enough to recognize compressed formats, only the start
+    # of those files is compressed, for the estimate.
+    start = time.perf_counter()
+    compressed = 0
+    for sample in samples:
+      compressor = zipfile._get_compressor(compression_type, level)  # pylint: disable=protected-access
+      compressed += len(compressor.compress(sample) + compressor.flush())
+    elapsed = time.perf_counter() - start
+    if kind is None:
+      if compressed <= sampled * MAX_RATIO:
+        return None
+      kind = 'trial'
+    return Detection(kind, elapsed * (size - sampled) / sampled)
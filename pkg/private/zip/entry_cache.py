@@ -0,0 +1,194 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A persistent cache of compressed zip entries.
+
+Most files of a large zip do not change from one build to the next, and
+compressing them again yields the same data. The cache keeps the compressed
+data of deflated entries on disk, keyed by the digest of their content, their
+compression level, and the version of zlib. An entry found in the cache is
+copied into the zip instead of being compressed again. Entries compressed
+with lzma or bzip2 are not cached: the versions of those libraries are not
+known, and an upgrade could change their output.
+
+Each cache entry is a file `<directory>/<key[:2]>/<key>`, with a header
+holding the CRC and sizes of the content, followed by the compressed data.
+Entries are written to temporary files renamed in place, so that concurrent
+builds sharing the cache only ever see complete entries. The cache is kept
+under a size budget by deleting the least recently used entries, by
+modification time, which a cache hit updates.
+"""
+
+import collections
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+try:
+  import fcntl  # pylint: disable=g-import-not-at-top
+  HAS_FCNTL = True
+except ImportError:
+  HAS_FCNTL = False
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Magic, CRC of the content, size of the content and of the compressed data.
+_HEADER = struct.Struct('<4sIQQ')
+_MAGIC = b'PZC1'
+
+# Version of the compressor, which may change its output.
+_COMPRESSOR_VERSION = '%s-%d.%d' % (zlib.ZLIB_RUNTIME_VERSION,
+                                    sys.version_info[0], sys.version_info[1])
+
+# Temporary files older than this were left by interrupted builds.
+_STALE_TEMPORARY_SECONDS = 3600
+
+_LOCK_FILE = '.lock'
+
+
+class EntryCache(object):
+  """A directory of compressed zip entries, shared by concurrent builds.
+
+  get() and put() may be called from several threads.
+
+  Attributes:
+    stats: collections.Counter of the 'entry_cache_evicted_bytes' by trim().
+  """
+
+  def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+    """Create the cache.
+
+    Args:
+      directory: the cache directory, created if needed.
+      max_size: the size over which trim() deletes the least recently used
+          entries.
+    """
+    self.directory = directory
+    self.max_size = max_size
+    self.stats = collections.Counter()
+    os.makedirs(directory, exist_ok=True)
+
+  @staticmethod
+  def caches(compress_type):
+    """Tells whether entries with this compression are cached."""
+    return compress_type == zipfile.ZIP_DEFLATED
+
+  @staticmethod
+  def key(content, compress_type, compresslevel):
+    """Returns the key of the compressed data of content."""
+    digest = hashlib.sha256(content).hexdigest()
+    return '%s-%d-%d-%s' % (digest, compress_type, compresslevel,
+                            _COMPRESSOR_VERSION)
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key, content):
+    """Returns the compressed data of content, or None if it is not cached."""
+    path = self._path(key)
+    try:
+      with open(path, 'rb') as f:
+        header = f.read(_HEADER.size)
+        compressed = f.read()
+      # Mark the entry as recently used.
+      os.utime(path)
+    except OSError:
+      # Not cached, or evicted since.
+      return None
+    if len(header) == _HEADER.size:
+      magic, crc, size, compressed_size = _HEADER.unpack(header)
+      if (magic == _MAGIC and size == len(content) and
+          compressed_size == len(compressed) and crc == zlib.crc32(content)):
+        return compressed
+    return None
+
+  def put(self, key, content, compressed):
+    """Stores the compressed data of content.
+
+    The cache is only an optimization: failures to store, like a full disk,
+    are ignored.
+    """
+    directory = os.path.dirname(self._path(key))
+    try:
+      os.makedirs(directory, exist_ok=True)
+      fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    except OSError:
+      return
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, zlib.crc32(content), len(content),
+                             len(compressed)))
+        f.write(compressed)
+      os.replace(temporary, self._path(key))
+    except OSError:
+      try:
+        os.remove(temporary)
+      except OSError:
+        pass
+
+  def trim(self):
+    """Deletes the least recently used entries, down to max_size."""
+    lock = None
+    if HAS_FCNTL:
+      # Only one build trims at once, others would delete the same entries.
+      lock = open(os.path.join(self.directory, _LOCK_FILE), 'a')
+      try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        lock.close()
+        return
+    try:
+      self._trim()
+    finally:
+      if lock:
+        lock.close()
+
+  def _trim(self):
+    entries = []
+    total = 0
+    now = time.time()
+    for top in os.scandir(self.directory):
+      if not top.is_dir(follow_symlinks=False):
+        continue
+      for entry in os.scandir(top.path):
+        try:
+          st = entry.stat(follow_symlinks=False)
+        except OSError:
+          continue
+        if entry.name.startswith('.'):
+          if st.st_mtime < now - _STALE_TEMPORARY_SECONDS:
+            self._remove(entry.path, st.st_size)
+          continue
+        entries.append((st.st_mtime, entry.path, st.st_size))
+        total += st.st_size
+    if total <= self.max_size:
+      return
+    entries.sort()
+    for _, path, size in entries:
+      self._remove(path, size)
+      total -= size
+      if total <= self.max_size:
+        break
+
+  def _remove(self, path, size):
+    try:
+      os.remove(path)
+      self.stats['entry_cache_evicted_bytes'] += size
+    except OSError:
+      # Removed by another build.
+      pass
@@ -40,6 +40,21 @@ def _pkg_zip_impl(ctx):
     args.add("-m", ctx.attr.mode)
     args.add("-c", str(ctx.attr.compression_type))
     args.add("-l", ctx.attr.compression_level)
+    if ctx.attr.compression_threads > 1:
+        args.add("--compression_threads", str(ctx.attr.compression_threads))
+    for pattern, compression in ctx.attr.compression_policies.items():
+        args.add("--compression_policy", "%s=%s" % (pattern, compression))
+    if ctx.attr.detect_incompressible:
+        args.add("--detect_incompressible")
+    if ctx.attr.alignment:
+        args.add("--alignment", str(ctx.attr.alignment))
+    for pattern, alignment in ctx.attr.alignment_policies.items():
+        args.add("--alignment_policy", "%s=%s" % (pattern, alignment))
+    if ctx.attr.entry_cache_dir:
+        args.add("--entry_cache", ctx.attr.entry_cache_dir)
+        args.add("--entry_cache_size", str(ctx.attr.entry_cache_size))
+    if ctx.attr.print_stats:
+        args.add("--stats")
     inputs = []
     if ctx.attr.stamp == 1 or (ctx.attr.stamp == -1 and
                                ctx.attr.private_stamp_detect):
@@ -54,11 +69,23 @@ def _pkg_zip_impl(ctx):
         default_mode = ctx.attr.mode,
     )
     add_label_list(mapping_context, srcs = ctx.attr.srcs)
+    for f in ctx.files.deps:
+        args.add("--zip", f.path)
+    inputs.extend(ctx.files.deps)
 
     manifest_file = ctx.actions.declare_file(ctx.label.name + ".manifest")
     inputs.append(manifest_file)
     write_manifest(ctx, manifest_file, mapping_context.content_map)
     args.add("--manifest", manifest_file.path)
+
+    action_outputs = [output_file]
+    output_groups = {}
+    if ctx.attr.digest_algorithms:
+        digests_file = ctx.actions.declare_file(output_file.basename + ".digests.json")
+        args.add("--digests_file", digests_file.path)
+        args.add_joined("--digest_algorithms", ctx.attr.digest_algorithms, join_with = ",")
+        action_outputs.append(digests_file)
+        output_groups["digests"] = [digests_file]
     args.set_param_file_format("multiline")
     args.use_param_file("@%s")
 
@@ -72,7 +99,7 @@ def _pkg_zip_impl(ctx):
         inputs = all_inputs,
         executable = ctx.executable._build_zip,
         arguments = [args],
-        outputs = [output_file],
+        outputs = action_outputs,
         env = {
             "LANG": "en_US.UTF-8",
             "LC_CTYPE": "UTF-8",
@@ -86,6 +113,7 @@ def _pkg_zip_impl(ctx):
             files = depset([output_file]),
             runfiles = ctx.runfiles(files = outputs),
         ),
+        OutputGroupInfo(**output_groups),
     ]
 
 pkg_zip_impl = rule(
@@ -96,6 +124,15 @@ pkg_zip_impl = rule(
             doc = """List of files that should be included in the archive.""",
             allow_files = True,
         ),
+        "deps": attr.label_list(
+            doc = """zip files whose members are copied into the archive, under `package_dir`.
+
+The compressed data of the members is copied as is, without decompressing and
+compressing it again. Only their names change. When several entries have the
+same path, the last one wins: a later zip overrides the members of an earlier
+one, and `srcs` override the members of all of them.""",
+            allow_files = [".zip", ".jar", ".whl"],
+        ),
         "mode": attr.string(
             doc = """The default mode for all files in the archive.""",
             default = "0555",
@@ -129,6 +166,60 @@ limited to a granularity of 2 seconds.""",
 The list of compressions is the same as Python's ZipFile: https://docs.python.org/3/library/zipfile.html#zipfile.ZIP_STORED""",
             values = ["deflated", "lzma", "bzip2", "stored"],
         ),
+        "compression_threads": attr.int(
+            default = 1,
+            doc = """Number of threads compressing the files. With a value greater than 1,
+files are read and compressed ahead of time, and written in the same order and with
+the same data as with a single thread.""",
+        ),
+        "compression_policies": attr.string_dict(
+            doc = """Compression of the files matching glob patterns, overriding
+`compression_type` and `compression_level`, e.g.
+`{"*.jpg": "stored", "assets/*.json": "deflated:9"}`. Values are a
+`compression_type`, optionally followed by `:level`. Patterns without `/` match the
+base name of the files, others their whole path in the archive. The first matching
+pattern applies.""",
+        ),
+        "detect_incompressible": attr.bool(
+            default = False,
+            doc = """Store the files which are already compressed, like images or
+archives, instead of compressing them again. They are recognized from their magic
+bytes, or by compressing a few samples of them.""",
+        ),
+        "alignment": attr.int(
+            default = 0,
+            doc = """Align the data of the stored (uncompressed) files on multiples of
+this many bytes, a power of 2 up to 32768, e.g. 4096 for loaders which mmap them
+straight out of the archive. The local headers of the files are padded with an
+extra field, as done by Android's `zipalign`. 0 does not align.""",
+        ),
+        "alignment_policies": attr.string_dict(
+            doc = """Alignment of the stored files matching glob patterns, overriding
+`alignment`, e.g. `{"*.so": "16384", "*.txt": "0"}`. Patterns are matched as in
+`compression_policies`, the first matching pattern applies.""",
+        ),
+        "entry_cache_dir": attr.string(
+            doc = """Absolute path of a directory caching the compressed data of files,
+shared by builds and by concurrent actions. Deflated files found there, by the digest
+of their content and their compression level, are copied instead of being compressed
+again. Files compressed with lzma or bzip2 are not cached. The
+output does not depend on the cache. The directory must be writable by the action,
+e.g. with `--sandbox_writable_path`.""",
+        ),
+        "entry_cache_size": attr.int(
+            default = 1024 * 1024 * 1024,
+            doc = """Size over which the least recently used entries of
+`entry_cache_dir` are deleted.""",
+        ),
+        "print_stats": attr.bool(
+            default = False,
+            doc = """If true, print statistics about the compression of each class of
+files, by extension: their ratio, and the CPU time saved by `detect_incompressible`.""",
+        ),
+        "digest_algorithms": attr.string_list(
+            doc = """Digests of the zip file to compute while it is written, e.g. `["sha256"]`.
+They are written to `<out>.digests.json`, in the `digests` output group.""",
+        ),
 
         # Common attributes
         "out": attr.output(
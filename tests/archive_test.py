@@ -93,6 +93,24 @@ class SimpleArReaderTest(unittest.TestCase):
   def testA_B_ABFile(self):
     self.assertSimpleFileContent(["a", "b", "ab"])
 
+  def testOpenMember(self):
+    datafile = self.data_files.Rlocation("rules_pkg/tests/testdata/a_b_ab.ar")
+    with archive.SimpleArReader(datafile) as f:
+      entries = []
+      current = f.next(read_data=False)
+      while current:
+        self.assertIsNone(current.data)
+        entries.append(current)
+        current = f.next(read_data=False)
+      self.assertEqual(["a", "b", "ab"], [e.filename for e in entries])
+      with f.open_member(entries[2]) as view:
+        self.assertEqual(b"ab", view.read())
+        self.assertEqual(b"", view.read(10))
+        view.seek(1)
+        self.assertEqual(b"b", view.read(10))
+        view.seek(-2, 2)
+        self.assertEqual(b"a", view.read(1))
+
 
 if __name__ == "__main__":
   unittest.main()
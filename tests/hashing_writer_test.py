@@ -0,0 +1,66 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import unittest
+import zipfile
+
+from pkg.private import hashing_writer
+
+
+class HashingWriterTest(unittest.TestCase):
+
+  def testSequentialWrites(self):
+    out = io.BytesIO()
+    with hashing_writer.HashingWriter(out, ['sha256', 'sha1'],
+                                      closefd=False) as writer:
+      for i in range(100):
+        writer.write(bytes([i]) * i)
+    data = out.getvalue()
+    self.assertEqual({
+        'size': len(data),
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'sha1': hashlib.sha1(data).hexdigest(),
+    }, writer.digests())
+
+  def testZipFileRewritingHeaders(self):
+    out = io.BytesIO()
+    writer = hashing_writer.HashingWriter(out, closefd=False)
+    with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+      for i in range(10):
+        z.writestr('f%d' % i, os.urandom(1000) * i)
+    data = out.getvalue()
+    self.assertEqual(hashlib.sha256(data).hexdigest(),
+                     writer.digests()['sha256'])
+
+  def testRewriteAfterHashing(self):
+    out = io.BytesIO()
+    writer = hashing_writer.HashingWriter(out, max_pending_size=10)
+    writer.seek(0)
+    writer.write(b'x' * 100)
+    writer.seek(0)
+    writer.write(b'y')
+    self.assertIsNone(writer.digests())
+
+  def testParseAlgorithms(self):
+    self.assertEqual(['sha256', 'md5'],
+                     hashing_writer.parse_algorithms('SHA256, md5'))
+    with self.assertRaises(ValueError):
+      hashing_writer.parse_algorithms('sha256,nope')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from pkg.private import stat_cache
+
+
+class StatCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.top = self.tmpdir.name
+    for path in ('a/b/c.txt', 'a/d.sh', 'e.txt'):
+      full_path = os.path.join(self.top, path)
+      os.makedirs(os.path.dirname(full_path), exist_ok=True)
+      with open(full_path, 'w') as f:
+        f.write(path)
+    os.chmod(os.path.join(self.top, 'a/d.sh'), 0o755)
+    os.chmod(os.path.join(self.top, 'e.txt'), 0o644)
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+    super().tearDown()
+
+  def testWalkTreeInSortedOrder(self):
+    os.makedirs(os.path.join(self.top, 'a', 'b', 'empty'))
+    with open(os.path.join(self.top, 'a.txt'), 'w') as f:
+      f.write('a.txt')
+    if hasattr(os, 'symlink'):
+      os.symlink('a', os.path.join(self.top, 'link'))
+    expected_files = []
+    expected_dirs = ['']
+    for root, dirs, files in os.walk(self.top):
+      rel_dir = os.path.relpath(root, self.top).replace(os.path.sep, '/')
+      prefix = '' if rel_dir == '.' else rel_dir + '/'
+      expected_dirs.extend(prefix + name for name in dirs)
+      expected_files.extend(prefix + name for name in files)
+    for threads in (1, 4):
+      for dir_suffix in ('', '/'):
+        cache = stat_cache.StatCache()
+        entries = list(cache.walk_tree(self.top, dir_suffix=dir_suffix,
+                                       threads=threads))
+        self.assertEqual(
+            sorted([name + dir_suffix for name in expected_dirs] +
+                   expected_files),
+            [e.rel_path + dir_suffix if e.is_dir else e.rel_path
+             for e in entries])
+        self.assertEqual(
+            ['link'] if hasattr(os, 'symlink') else [],
+            [e.rel_path for e in entries if e.is_link])
+        for entry in entries:
+          self.assertEqual(
+              os.path.normpath(os.path.join(self.top, entry.rel_path)),
+              os.path.normpath(entry.path))
+
+  def testLookupsAfterWalk(self):
+    cache = stat_cache.StatCache()
+    list(cache.walk_tree(self.top))
+    calls = cache.stats['stat_calls']
+    self.assertEqual(3, calls)
+    path = os.path.join(self.top, 'a', 'd.sh')
+    self.assertEqual(os.stat(path), cache.stat(path))
+    self.assertEqual(len('a/d.sh'), cache.getsize(path))
+    # The same file, spelled differently.
+    self.assertEqual(len('e.txt'), cache.getsize(
+        os.path.join(self.top, 'a', '..', 'e.txt')))
+    for path in ('a/d.sh', 'e.txt', 'a/b/c.txt'):
+      full_path = os.path.join(self.top, path)
+      self.assertEqual(os.access(full_path, os.X_OK),
+                       cache.is_executable(full_path))
+    self.assertEqual(calls, cache.stats['stat_calls'])
+    self.assertEqual(9, cache.stats['stat_calls_avoided'])
+
+  def testStatMissingFile(self):
+    cache = stat_cache.StatCache()
+    with self.assertRaises(OSError):
+      cache.stat(os.path.join(self.top, 'missing'))
+    self.assertFalse(cache.is_executable(os.path.join(self.top, 'missing')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -310,6 +310,33 @@ class PkgTarTest(unittest.TestCase):
       file_size = os.stat(file_path).st_size
       self.assertEqual(file_size, expected_size, 'size error for ' + file_name)
 
+  def test_compression_threads(self):
+    contents = []
+    for file_name in ['test-tar-compression_threads-2.tgz',
+                      'test-tar-compression_threads-4.tgz']:
+      self.assertTarFileContent(file_name, [
+          {'name': './a', 'data': b'a'},
+          {'name': './b', 'data': b'b'},
+          {'name': './ab', 'data': b'ab'},
+      ])
+      file_path = runfiles.Create().Rlocation('rules_pkg/tests/tar/' + file_name)
+      with open(file_path, 'rb') as f:
+        data = f.read()
+      # The gzip header records the (different) output file names. Everything
+      # after it must be identical.
+      contents.append(data[data.index(b'\0', 10) + 1:])
+    self.assertEqual(contents[0], contents[1])
+
+  def test_deduplicate(self):
+    self.assertTarFileContent('test-tar-deduplicate.tar', [
+        {'name': 'a', 'isdir': True},
+        {'name': 'a/loremipsum.txt', 'type': tarfile.REGTYPE},
+        {'name': 'b', 'isdir': True},
+        {'name': 'b/loremipsum.txt', 'type': tarfile.LNKTYPE,
+         'linkname': 'a/loremipsum.txt', 'size': 0},
+        {'name': 'hello.txt', 'type': tarfile.REGTYPE},
+    ])
+
   def test_preserve_mode(self):
     if os.name == 'nt':
       expected_mode = [
@@ -0,0 +1,85 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares tar_header.HeaderEncoder and TarFileWriter against tarfile.
+
+Usage: bazel run //tests/tar:tar_header_benchmark -- [--members N]
+"""
+
+import argparse
+import io
+import os
+import tarfile
+import tempfile
+import timeit
+
+from pkg.private.tar import tar_header
+from pkg.private.tar import tar_writer
+
+
+def _infos(count):
+  infos = []
+  for i in range(count):
+    info = tarfile.TarInfo('usr/share/doc/package%d/file%d.txt' % (i // 100, i))
+    info.size = i % 4096
+    info.mode = 0o644
+    info.mtime = tar_writer.PORTABLE_MTIME
+    infos.append(info)
+  return infos
+
+
+def _bench(name, func, count):
+  seconds = min(timeit.repeat(func, number=1, repeat=3))
+  print('%-32s %8.3fs %10.0f members/s' % (name, seconds, count / seconds))
+  return seconds
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--members', type=int, default=100000,
+                      help='Number of members to write.')
+  members = parser.parse_args().members
+  infos = _infos(members)
+  encoder = tar_header.HeaderEncoder()
+
+  print('Header encoding:')
+  reference = _bench(
+      'TarInfo.tobuf()',
+      lambda: [i.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'surrogateescape')
+               for i in infos], members)
+  encoded = _bench('HeaderEncoder.encode()',
+                   lambda: [encoder.encode(i) for i in infos], members)
+  print('speedup: %.1fx' % (reference / encoded))
+
+  print('Archive of small files:')
+  with tempfile.TemporaryDirectory() as tmpdir:
+    output = os.path.join(tmpdir, 'out.tar')
+    content = b'x' * 4096
+
+    def with_tarfile():
+      with tarfile.open(output, 'w', format=tarfile.GNU_FORMAT) as tar:
+        for info in infos:
+          tar.addfile(info, io.BytesIO(content))
+
+    def with_tar_writer():
+      with tar_writer.TarFileWriter(output, streaming=True) as writer:
+        for info in infos:
+          writer._addfile(info, io.BytesIO(content))  # pylint: disable=protected-access
+
+    reference = _bench('tarfile.TarFile.addfile()', with_tarfile, members)
+    written = _bench('TarFileWriter', with_tar_writer, members)
+    print('speedup: %.1fx' % (reference / written))
+
+
+if __name__ == '__main__':
+  main()
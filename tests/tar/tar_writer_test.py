@@ -13,12 +13,28 @@
 # limitations under the License.
 """Testing for tar_writer."""
 
+import bz2
+import contextlib
+import gzip
+import hashlib
+import io
+import json
 import os
+import shutil
+import subprocess
 import tarfile
 import unittest
 
 from python.runfiles import runfiles
+from pkg.private.tar import estargz
+from pkg.private.tar import layer_diff
+from pkg.private.tar import path_index
+from pkg.private.tar import pipe_writer
+from pkg.private.tar import prefetch
+from pkg.private.tar import seekable
+from pkg.private.tar import tar_header
 from pkg.private.tar import tar_writer
+from pkg.private.tar import volumes
 from tests.tar import compressor
 
 
@@ -326,6 +342,483 @@ class TarFileWriterTest(unittest.TestCase):
     ]
     self.assertTarFileContent(self.tempfile, content)
 
+  def testParallelGzip(self):
+    # Enough content to span several compression blocks.
+    content = "".join("line %d\n" % i for i in range(60000))
+    outputs = []
+    for threads in (2, 4):
+      with tar_writer.TarFileWriter(self.tempfile, compression="gz",
+                                    compression_threads=threads) as f:
+        f.add_file("./a", content=content)
+        f.add_file("./b", content="b")
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+      self.assertTarFileContent(self.tempfile, [
+          {"name": "./a", "data": content.encode("utf-8")},
+          {"name": "./b", "data": b"b"},
+      ])
+    self.assertEqual(outputs[0], outputs[1])
+
+  def testZstdRoundTrip(self):
+    zstd_file = os.path.join(os.environ["TEST_TMPDIR"], "test.tar.zst")
+    content = [
+        {"name": "./a", "data": b"a"},
+        {"name": "./ab", "data": b"ab"},
+    ]
+    try:
+      with tar_writer.TarFileWriter(zstd_file, compression="zst",
+                                    compression_level=19) as f:
+        f.add_file("./a", content="a")
+        f.add_file("./ab", content="ab")
+      with open(zstd_file, "rb") as f:
+        self.assertEqual(f.read(4), tar_writer.ZSTD_MAGIC)
+      # tarfile can not read zstd, so merge it back into a plain tar.
+      with tar_writer.TarFileWriter(self.tempfile) as f:
+        f.add_tar(zstd_file)
+      self.assertTarFileContent(self.tempfile, content)
+    finally:
+      os.remove(zstd_file)
+
+  def testMergeZstdTar(self):
+    content = [
+        {"name": "./a", "data": b"a"},
+        {"name": "./ab", "data": b"ab"},
+    ]
+    with tar_writer.TarFileWriter(self.tempfile) as f:
+      datafile = self.data_files.Rlocation(
+          "rules_pkg/tests/testdata/tar_test.tar.zst")
+      f.add_tar(datafile, name_filter=lambda n: n != "./b")
+    self.assertTarFileContent(self.tempfile, content)
+
+  def testFileCopyIsIdenticalToTarfile(self):
+    sizes = [0, 1, 511, 512, 513, 3 * 1024 * 1024 + 17]
+    sources = []
+    for size in sizes:
+      path = os.path.join(os.environ["TEST_TMPDIR"], "src_%d" % size)
+      with open(path, "wb") as f:
+        f.write(bytes(i % 251 for i in range(size)))
+      sources.append(path)
+    outputs = []
+    for copy_fds in (True, False):
+      with tar_writer.TarFileWriter(self.tempfile) as f:
+        # Force the tarfile.addfile() path for the reference archive.
+        f._can_copy_fds = f._can_copy_fds and copy_fds
+        for path in sources:
+          f.add_file(os.path.basename(path), file_content=path)
+        f.add_file("after", content="after")
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+    self.assertEqual(outputs[0], outputs[1])
+    for path in sources:
+      os.remove(path)
+
+  def testMergeUncompressedTarCopiesRawData(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    plain = os.path.join(tmpdir, "merge_input.tar")
+    with tarfile.open(plain, "w:") as t:
+      for size in (0, 1, 512, 70000):
+        info = tarfile.TarInfo("f%d" % size)
+        info.size = size
+        t.addfile(info, io.BytesIO(bytes(i % 253 for i in range(size))))
+    compressed = plain + ".gz"
+    with open(plain, "rb") as src, gzip.open(compressed, "wb") as dst:
+      dst.write(src.read())
+    # The uncompressed input is copied verbatim, the compressed one through
+    # tarfile. Both must give the same archive, compressed or not.
+    for compression in ("", "gz"):
+      outputs = []
+      for intar in (plain, compressed):
+        with tar_writer.TarFileWriter(
+            self.tempfile, compression=compression) as f:
+          f.add_tar(intar, name_filter=lambda n: n != "f1", prefix="p")
+          f.add_file("after", content="after")
+        with tarfile.open(self.tempfile, "r:*") as t:
+          outputs.append([(m.name, t.extractfile(m).read())
+                          for m in t.getmembers() if m.isfile()])
+      self.assertEqual(outputs[0], outputs[1])
+      self.assertEqual(["p/f0", "p/f512", "p/f70000", "after"],
+                       [name for name, _ in outputs[0]])
+      self.assertEqual(bytes(i % 253 for i in range(70000)), outputs[0][2][1])
+    os.remove(plain)
+    os.remove(compressed)
+
+  def testPrefetchedStreams(self):
+    base = self.data_files.Rlocation("rules_pkg/tests/testdata/tar_test.tar")
+    with open(base, "rb") as f:
+      expected = f.read()
+    inputs = [base + ext for ext in ("", ".gz", ".bz2", ".xz", ".zst")]
+
+    def opener(path):
+      @contextlib.contextmanager
+      def open_data():
+        with open(path, "rb") as f:
+          with prefetch.decompressing_reader(f) as reader:
+            yield reader
+      return open_data
+
+    openers = [opener(path) for path in inputs] + [None]
+    # Small buffers make the threads wait on the reader.
+    with prefetch.Prefetcher(openers, depth=2, buffered_chunks=1) as streams:
+      got = [stream and stream.read() for stream in streams]
+    self.assertEqual([expected] * len(inputs) + [None], got)
+
+  def testMergePrefetchedTar(self):
+    content = [
+        {"name": "./a", "data": b"a"},
+        {"name": "./ab", "data": b"ab"},
+    ]
+    datafile = self.data_files.Rlocation(
+        "rules_pkg/tests/testdata/tar_test.tar.bz2")
+    with tar_writer.TarFileWriter(self.tempfile) as f:
+      with prefetch.PrefetchedStream(lambda: bz2.BZ2File(datafile)) as stream:
+        f.add_tar(datafile, name_filter=lambda n: n != "./b", fileobj=stream)
+    self.assertTarFileContent(self.tempfile, content)
+
+  def testPathIndex(self):
+    index = path_index.PathIndex(implicit_ancestors=("./",))
+    self.assertEqual(["./a/", "./a/b/"], index.missing_ancestors("./a/b/c"))
+    index["./a"] = tarfile.DIRTYPE
+    index["./a/b/c"] = tarfile.REGTYPE
+    self.assertEqual(["./a/b/"], index.missing_ancestors("./a/b/c"))
+    index["./a/b"] = tarfile.SYMTYPE
+    self.assertEqual([], index.missing_ancestors("./a/b/c"))
+    self.assertEqual([], index.missing_ancestors("./a/b//d"))
+    self.assertEqual(["./a/c/", "./a/c//d/"], index.missing_ancestors(
+        "./a/c//d/e"))
+    self.assertEqual(tarfile.SYMTYPE, index.get("./a/b"))
+    self.assertEqual(tarfile.REGTYPE, index.get("./a/b/c"))
+    self.assertIsNone(index.get("./a/b/c/d"))
+    self.assertIsNone(index.get("./a/"))
+    self.assertNotIn("./", index)
+    self.assertEqual(3, len(index))
+    self.assertEqual(["./a", "./a/b", "./a/b/c"], sorted(index.keys()))
+
+  def testStreamingKeepsNoMembers(self):
+    datafile = self.data_files.Rlocation(
+        "rules_pkg/tests/testdata/tar_test.tar")
+    outputs = []
+    for streaming in (False, True):
+      with tar_writer.TarFileWriter(
+          self.tempfile, create_parents=True, streaming=streaming) as f:
+        f.add_file("d/e/f", content="f")
+        f.add_file("d/e/f", content="duplicate")
+        f.add_tar(datafile, prefix="t")
+        if streaming:
+          self.assertEqual([], f.tar.members)
+        else:
+          self.assertNotEqual([], f.tar.members)
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+    self.assertEqual(outputs[0], outputs[1])
+    if tar_writer.HAS_RESOURCE:
+      self.assertGreater(tar_writer.peak_rss(), 0)
+
+  def testHeaderEncoderMatchesTarfile(self):
+    encoder = tar_header.HeaderEncoder("utf-8", "surrogateescape")
+    for name in ("a", "d/", "x" * 100, "x" * 101, "\u00e9" * 50, "b\udce9"):
+      for kind in (tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.SYMTYPE,
+                   tarfile.CHRTYPE):
+        for mtime in (0, 1.5e9, 8 ** 11):
+          info = tarfile.TarInfo(name)
+          info.type = kind
+          info.size = 1234
+          info.mode = 0o100755
+          info.mtime = mtime
+          info.uid = 1000
+          info.uname = "user"
+          info.linkname = "target" if kind == tarfile.SYMTYPE else ""
+          self.assertEqual(
+              info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"),
+              encoder.encode(info))
+
+  def testSeekableArchive(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    contents = {"d/f%d" % i: bytes([i]) * (i * 1000) for i in range(1, 20)}
+    for compression in ("", "gz", "zst"):
+      if compression == "zst" and not tar_writer.HAS_ZSTD:
+        continue
+      index = os.path.join(tmpdir, "seekable.index.json")
+      with tar_writer.TarFileWriter(
+          self.tempfile, compression=compression, create_parents=True,
+          seekable_index=index, seekable_frame_size=4096) as f:
+        for name, content in contents.items():
+          f.add_file(name, content=content.decode("ascii"))
+        f.add_file("link", kind=tarfile.LNKTYPE, link="d/f3")
+      with seekable.SeekableTarReader(self.tempfile, index) as reader:
+        self.assertEqual(["d/"] + list(contents) + ["link"],
+                         reader.getnames())
+        for name, content in contents.items():
+          self.assertEqual(content, reader.extractfile(name).read())
+        self.assertEqual(contents["d/f3"], reader.extractfile("link").read())
+        self.assertTrue(reader.getmember("d").isdir())
+        self.assertIsNone(reader.extractfile("d/"))
+      if compression != "zst":
+        # The archive is still a regular tar file.
+        with tarfile.open(self.tempfile, "r:*") as t:
+          self.assertEqual(contents["d/f7"], t.extractfile("d/f7").read())
+
+  def testSeekableArchiveNeedsFrames(self):
+    with self.assertRaises(tar_writer.TarFileWriter.Error):
+      tar_writer.TarFileWriter(self.tempfile, compression="bz2",
+                               seekable_index=self.tempfile + ".index")
+
+  def testEstargzArchive(self):
+    content = b"0123456789abcdef" * 640
+    with tar_writer.TarFileWriter(
+        self.tempfile, compression="gz", create_parents=True,
+        estargz_toc=True, estargz_chunk_size=4096) as f:
+      f.add_file("d/small", content="hello")
+      f.add_file("d/big", content=content.decode("ascii"))
+      f.add_file("d/link", kind=tarfile.SYMTYPE, link="big")
+    # The archive is still a regular tar file, with the table of contents as
+    # its last member.
+    with tarfile.open(self.tempfile, "r:gz") as t:
+      self.assertEqual(["d", "d/small", "d/big", "d/link",
+                        estargz.TOC_TAR_NAME], t.getnames())
+      toc_data = t.extractfile(estargz.TOC_TAR_NAME).read()
+    self.assertEqual("sha256:" + hashlib.sha256(toc_data).hexdigest(),
+                     f.toc_digest)
+    with open(self.tempfile, "rb") as archive:
+      data = archive.read()
+    footer = data[-estargz.FOOTER_SIZE:]
+    self.assertEqual(b"", gzip.decompress(footer))
+    self.assertEqual(estargz.footer(int(footer[16:32], 16)), footer)
+    entries = json.loads(toc_data)["entries"]
+    self.assertEqual(
+        ["dir", "reg", "reg", "chunk", "chunk", "symlink"],
+        [e["type"] for e in entries])
+    self.assertEqual("sha256:" + hashlib.sha256(content).hexdigest(),
+                     entries[2]["digest"])
+    # Each chunk is at the start of its gzip member.
+    for entry, chunk_offset, chunk in (
+        (entries[1], 0, b"hello"),
+        (entries[2], 0, content[:4096]),
+        (entries[3], 4096, content[4096:8192]),
+        (entries[4], 8192, content[8192:])):
+      self.assertEqual(chunk_offset, entry.get("chunkOffset", 0))
+      member = gzip.GzipFile(fileobj=io.BytesIO(data[entry["offset"]:]))
+      self.assertEqual(chunk, member.read(len(chunk)))
+      self.assertEqual("sha256:" + hashlib.sha256(chunk).hexdigest(),
+                       entry["chunkDigest"])
+    self.assertNotIn("chunkSize", entries[4])
+
+  def testEstargzArchiveNeedsGzip(self):
+    with self.assertRaises(tar_writer.TarFileWriter.Error):
+      tar_writer.TarFileWriter(self.tempfile, compression="zst",
+                               estargz_toc=True)
+
+  def testExtraOutputs(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    content = "".join("line %d\n" % i for i in range(20000))
+
+    def write(name, compression, extra_outputs=None):
+      with tar_writer.TarFileWriter(name, compression=compression,
+                                    extra_outputs=extra_outputs) as f:
+        f.add_file("./a", content=content)
+        f.add_file("./b", content="b")
+      with open(name, "rb") as f:
+        return f.read()
+
+    compressions = ("", "bz2", "xz")
+    names = [os.path.join(tmpdir, "extra_%d.tar" % i)
+             for i in range(len(compressions))]
+    write(self.tempfile, "gz", list(zip(names, compressions)))
+    # Each output is the archive that its compression alone would give.
+    for name, compression in zip(names, compressions):
+      with open(name, "rb") as f:
+        data = f.read()
+      self.assertEqual(write(name, compression), data)
+
+  def testExtraOutputsNeedPlainArchives(self):
+    with self.assertRaises(tar_writer.TarFileWriter.Error):
+      tar_writer.TarFileWriter(
+          self.tempfile, compression="gz", estargz_toc=True,
+          extra_outputs=[(self.tempfile + ".tar", "")])
+
+  def testSplitArchive(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    index = os.path.join(tmpdir, "split.json")
+    contents = [("./%d" % i, "%d" % i * 12000) for i in range(8)]
+    with tar_writer.TarFileWriter(self.tempfile, compression="gz",
+                                  split_size=4 * tarfile.RECORDSIZE,
+                                  split_index=index) as f:
+      for name, data in contents:
+        f.add_file(name, content=data)
+      f.add_file("./link", tarfile.LNKTYPE, link="./7")
+    with open(index, "r", encoding="utf-8") as f:
+      content = json.load(f)
+    self.assertEqual(volumes.INDEX_VERSION, content["version"])
+    names = [os.path.join(tmpdir, v) for v in content["volumes"]]
+    self.assertEqual(self.tempfile, names[0])
+    self.assertGreater(len(names), 2)
+    # Each volume is an archive of its own, within the budget.
+    found = []
+    for i, name in enumerate(names):
+      self.assertEqual(volumes.volume_name(self.tempfile, i), name)
+      with gzip.open(name, "rb") as f:
+        self.assertLessEqual(len(f.read()), 4 * tarfile.RECORDSIZE)
+      with tarfile.open(name, "r:gz") as tar:
+        for info in tar:
+          found.append([info.name, i])
+          if info.isfile():
+            self.assertEqual(dict(contents)[info.name].encode("utf-8"),
+                             tar.extractfile(info).read())
+    self.assertEqual(found, content["members"])
+    self.assertEqual([name for name, _ in contents] + ["./link"],
+                     [name for name, _ in found])
+
+  def testSplitArchiveRejectsHardLinksAcrossVolumes(self):
+    with tar_writer.TarFileWriter(self.tempfile,
+                                  split_size=tarfile.RECORDSIZE) as f:
+      f.add_file("./a", content="a" * tarfile.RECORDSIZE)
+      with self.assertRaises(tar_writer.TarFileWriter.Error):
+        f.add_file("./b", content="b")
+        f.add_file("./link", tarfile.LNKTYPE, link="./a")
+
+  def testDiffBase(self):
+    base = os.path.join(os.environ["TEST_TMPDIR"], "base.tar")
+    with tar_writer.TarFileWriter(base) as f:
+      f.add_file("./etc/", tarfile.DIRTYPE)
+      f.add_file("./etc/kept", content="kept")
+      f.add_file("./etc/changed", content="old")
+      f.add_file("./etc/chmod", content="chmod", mode=0o644)
+      f.add_file("./etc/removed", content="removed")
+      f.add_file("./link", tarfile.LNKTYPE, link="./etc/changed")
+      f.add_file("./var/", tarfile.DIRTYPE)
+      f.add_file("./var/lib/", tarfile.DIRTYPE)
+      f.add_file("./var/lib/db", content="db")
+    with tar_writer.TarFileWriter(self.tempfile, diff_base=base) as f:
+      f.add_file("./etc/", tarfile.DIRTYPE)
+      f.add_file("./etc/kept", content="kept")
+      f.add_file("./etc/changed", content="new")
+      f.add_file("./etc/chmod", content="chmod", mode=0o755)
+      f.add_file("./etc/added", content="added")
+      f.add_file("./link", tarfile.LNKTYPE, link="./etc/changed")
+    self.assertEqual(2, f.stats["diff_unchanged_members"])
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "./etc/changed", "data": b"new"},
+        {"name": "./etc/chmod", "mode": 0o755},
+        {"name": "./etc/added", "data": b"added"},
+        # The target of the link changed, so must the link.
+        {"name": "./link", "type": tarfile.LNKTYPE},
+        {"name": "./etc/" + layer_diff.WHITEOUT_PREFIX + "removed", "size": 0},
+        # Removed with their directory.
+        {"name": "./" + layer_diff.WHITEOUT_PREFIX + "var", "size": 0},
+    ])
+
+  def testDiffBaseWithPrefetchedTar(self):
+    base = os.path.join(os.environ["TEST_TMPDIR"], "base.tar")
+    with tar_writer.TarFileWriter(base) as f:
+      f.add_file("./a", content="a")
+      f.add_file("./b", content="old")
+    dep = os.path.join(os.environ["TEST_TMPDIR"], "dep.tar.gz")
+    with tar_writer.TarFileWriter(dep, compression="gz") as f:
+      f.add_file("./a", content="a")
+      f.add_file("./b", content="new")
+
+    @contextlib.contextmanager
+    def open_data():
+      with open(dep, "rb") as f:
+        with prefetch.decompressing_reader(f) as reader:
+          yield reader
+
+    # Members of the prefetched stream can not be read again.
+    with tar_writer.TarFileWriter(self.tempfile, diff_base=base) as f:
+      with prefetch.Prefetcher([open_data]) as streams:
+        for stream in streams:
+          f.add_tar(dep, fileobj=stream)
+    self.assertEqual(1, f.stats["diff_unchanged_members"])
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "./b", "data": b"new"},
+    ])
+
+  def testDigestsFile(self):
+    digests_file = os.path.join(os.environ["TEST_TMPDIR"], "digests.json")
+    extra = os.path.join(os.environ["TEST_TMPDIR"], "extra.tar")
+    with tar_writer.TarFileWriter(self.tempfile, compression="gz",
+                                  extra_outputs=[(extra, "")],
+                                  digests_file=digests_file,
+                                  digest_algorithms=["sha256", "md5"]) as f:
+      f.add_file("./a", content="a" * 10000)
+      f.add_file("./b", content="b")
+    with open(digests_file) as f:
+      outputs = json.load(f)["outputs"]
+    with open(self.tempfile, "rb") as f:
+      compressed = f.read()
+    with open(extra, "rb") as f:
+      uncompressed = f.read()
+    self.assertEqual(gzip.decompress(compressed), uncompressed)
+    expected_uncompressed = {
+        "size": len(uncompressed),
+        "sha256": hashlib.sha256(uncompressed).hexdigest(),
+        "md5": hashlib.md5(uncompressed).hexdigest(),
+    }
+    self.assertEqual({
+        os.path.basename(self.tempfile): {
+            "size": len(compressed),
+            "sha256": hashlib.sha256(compressed).hexdigest(),
+            "md5": hashlib.md5(compressed).hexdigest(),
+            "uncompressed": expected_uncompressed,
+        },
+        "extra.tar": dict(expected_uncompressed,
+                          uncompressed=expected_uncompressed),
+    }, outputs)
+
+  @unittest.skipUnless(shutil.which("zstd"), "needs the zstd command")
+  def testDigestsFileSeekableZstdCommand(self):
+    digests_file = os.path.join(os.environ["TEST_TMPDIR"], "digests.json")
+    has_zstd = tar_writer.HAS_ZSTD
+    # Compress the frames with the zstd command, as without the module.
+    tar_writer.HAS_ZSTD = False
+    try:
+      with tar_writer.TarFileWriter(
+          self.tempfile, compression="zst",
+          seekable_index=self.tempfile + ".index.json",
+          seekable_frame_size=4096, digests_file=digests_file) as f:
+        for i in range(10):
+          f.add_file("./f%d" % i, content=str(i) * 3000)
+    finally:
+      tar_writer.HAS_ZSTD = has_zstd
+    with open(digests_file) as f:
+      digests = json.load(f)["outputs"][os.path.basename(self.tempfile)]
+    with open(self.tempfile, "rb") as f:
+      compressed = f.read()
+    uncompressed = subprocess.run(["zstd", "-q", "-d", "-c", self.tempfile],
+                                  check=True, stdout=subprocess.PIPE).stdout
+    self.assertEqual({
+        "size": len(compressed),
+        "sha256": hashlib.sha256(compressed).hexdigest(),
+        "uncompressed": {
+            "size": len(uncompressed),
+            "sha256": hashlib.sha256(uncompressed).hexdigest(),
+        },
+    }, digests)
+
+  def testPipeWriter(self):
+    data = bytes(range(256)) * 4096
+    with open(self.tempfile, "wb") as out:
+      proc = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=out)
+    pipe_writer.resize_pipe(proc.stdin.fileno())
+    writer = pipe_writer.PipeWriter(proc.stdin, chunk_size=1000,
+                                    buffered_chunks=2)
+    for i in range(0, len(data), 777):
+      writer.write(data[i:i + 777])
+    writer.close()
+    self.assertEqual(0, proc.wait())
+    with open(self.tempfile, "rb") as f:
+      self.assertEqual(data, f.read())
+    self.assertIn("pipe_producer_wait_seconds", writer.stats)
+    self.assertIn("pipe_writer_idle_seconds", writer.stats)
+
+  def testPipeWriterReportsErrors(self):
+    proc = subprocess.Popen(["true"], stdin=subprocess.PIPE)
+    proc.wait()
+    writer = pipe_writer.PipeWriter(proc.stdin, chunk_size=1000)
+    with self.assertRaises(BrokenPipeError):
+      for _ in range(1000):
+        writer.write(b"x" * 1000)
+      writer.close()
+
 
 if __name__ == "__main__":
   unittest.main()
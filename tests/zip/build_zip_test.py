@@ -0,0 +1,264 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing for ZipWriter."""
+
+import gzip
+import io
+import json
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from pkg.private import manifest
+from pkg.private.zip import build_zip
+from pkg.private.zip import compression_policy
+from pkg.private.zip import entry_cache
+
+
+class _Unseekable(io.RawIOBase):
+  """A file which can only be written sequentially."""
+
+  def __init__(self, fileobj):
+    super().__init__()
+    self._fileobj = fileobj
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    return self._fileobj.write(data)
+
+
+class ZipWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.files = []
+    for i, size in enumerate((0, 100, 50000, 300000)):
+      path = os.path.join(self.tmpdir.name, 'file%d' % i)
+      with open(path, 'wb') as f:
+        f.write((os.urandom(size // 4) + b'abcd' * size)[:size])
+      self.files.append(path)
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+    super().tearDown()
+
+  def writeZip(self, name, compression_type, **kwargs):
+    output = os.path.join(self.tmpdir.name, name)
+    with build_zip.ZipWriter(output, (1980, 1, 1, 0, 0, 0), 0o644,
+                             compression_type, 6, **kwargs) as writer:
+      writer.add_manifest_entry(manifest.ManifestEntry(
+          type=manifest.ENTRY_IS_DIR, dest='dir', src='',
+          mode=None, user=None, group=None))
+      for i, path in enumerate(self.files):
+        entry_info = writer.make_zipinfo('dir/file%d' % i, None)
+        entry_info.compress_type = writer.compression_type
+        writer.write_file(entry_info, path)
+    self.last_stats = writer.stats
+    with open(output, 'rb') as f:
+      return f.read()
+
+  def testCompressionThreads(self):
+    for compression_type in ('deflated', 'bzip2', 'lzma', 'stored'):
+      self.assertEqual(
+          self.writeZip('serial.zip', compression_type),
+          self.writeZip('parallel.zip', compression_type,
+                        compression_threads=3),
+          compression_type)
+
+  def testCompressionPolicies(self):
+    jpeg = os.path.join(self.tmpdir.name, 'image.jpg')
+    with open(jpeg, 'wb') as f:
+      f.write(b'\xff\xd8\xff\xe0' + b'abcd' * 10000)
+    output = os.path.join(self.tmpdir.name, 'policies.zip')
+    with build_zip.ZipWriter(
+        output, (1980, 1, 1, 0, 0, 0), 0o644, 'deflated', 6,
+        compression_policies=[
+            ('*.txt', compression_policy.parse_compression('stored')),
+            ('dir/*', compression_policy.parse_compression('bzip2:9')),
+        ],
+        detect_incompressible=True) as writer:
+      for name, path in (('a.txt', self.files[2]), ('dir/b', self.files[2]),
+                         ('random', self.files[3]), ('image.jpg', jpeg),
+                         ('c', self.files[1])):
+        entry_info = writer.make_zipinfo(name, None)
+        writer.write_file(entry_info, path)
+    with zipfile.ZipFile(output) as z:
+      self.assertEqual({
+          'a.txt': zipfile.ZIP_STORED,
+          'dir/b': zipfile.ZIP_BZIP2,
+          # A quarter of it is random, it still compresses.
+          'random': zipfile.ZIP_DEFLATED,
+          # Detected from its magic bytes.
+          'image.jpg': zipfile.ZIP_STORED,
+          # Too small to be checked.
+          'c': zipfile.ZIP_DEFLATED,
+      }, {info.filename: info.compress_type for info in z.infolist()})
+      self.assertIsNone(z.testzip())
+    self.assertEqual(1, writer.stats['incompressible_entries[.jpg]'])
+    self.assertEqual(1.0, writer.stats['ratio[.jpg]'])
+    self.assertEqual(3, writer.stats['entries[(none)]'])
+
+  def testDetectIncompressible(self):
+    policy = compression_policy.CompressionPolicy(
+        zipfile.ZIP_DEFLATED, 6, detect_incompressible=True)
+    with open(self.files[3], 'rb') as f:
+      self.assertIsNone(policy.detect(f, 300000, zipfile.ZIP_DEFLATED, 6))
+      self.assertEqual(0, f.tell())
+    random = io.BytesIO(os.urandom(200000))
+    self.assertEqual(
+        'trial', policy.detect(random, 200000, zipfile.ZIP_DEFLATED, 6).kind)
+    self.assertEqual(0, random.tell())
+    data = gzip.compress(os.urandom(10000))
+    self.assertEqual('gzip', policy.detect(io.BytesIO(data), len(data),
+                                           zipfile.ZIP_DEFLATED, 6).kind)
+    # Not gzip, despite the first two bytes.
+    text = io.BytesIO(b'\x1f\x8b' + b'abcd' * 5000)
+    self.assertIsNone(policy.detect(text, 20002, zipfile.ZIP_DEFLATED, 6))
+
+  def testEntryCache(self):
+    expected = self.writeZip('uncached.zip', 'deflated')
+    cache_dir = os.path.join(self.tmpdir.name, 'cache')
+    for hits, misses in ((0, 4), (4, 0)):
+      cache = entry_cache.EntryCache(cache_dir)
+      self.assertEqual(expected, self.writeZip('cached.zip', 'deflated',
+                                               cache=cache,
+                                               compression_threads=2))
+      self.assertEqual(hits, self.last_stats['entry_cache_hits'])
+      self.assertEqual(misses, self.last_stats['entry_cache_misses'])
+    # The version of liblzma is not known, its output is not cached.
+    self.writeZip('lzma.zip', 'lzma', cache=cache, compression_threads=2)
+    self.assertEqual(0, self.last_stats['entry_cache_hits'])
+    self.assertEqual(0, self.last_stats['entry_cache_misses'])
+
+  def testEntryCacheEvictsLeastRecentlyUsed(self):
+    cache = entry_cache.EntryCache(os.path.join(self.tmpdir.name, 'cache'),
+                                   max_size=250)
+    for i, content in enumerate((b'a', b'b', b'c')):
+      key = cache.key(content, zipfile.ZIP_DEFLATED, 6)
+      cache.put(key, content, b'x' * 100)
+      os.utime(cache._path(key), (i, i))
+    cache.get(cache.key(b'a', zipfile.ZIP_DEFLATED, 6), b'a')
+    cache.trim()
+    self.assertEqual(b'x' * 100, cache.get(
+        cache.key(b'a', zipfile.ZIP_DEFLATED, 6), b'a'))
+    self.assertIsNone(cache.get(
+        cache.key(b'b', zipfile.ZIP_DEFLATED, 6), b'b'))
+    self.assertEqual(b'x' * 100, cache.get(
+        cache.key(b'c', zipfile.ZIP_DEFLATED, 6), b'c'))
+
+  def testStreamingLargeFiles(self):
+    expected = self.writeZip('whole.zip', 'deflated')
+    streaming_size = build_zip.STREAMING_SIZE
+    build_zip.STREAMING_SIZE = 1000
+    try:
+      self.assertEqual(expected, self.writeZip('streamed.zip', 'deflated'))
+      self.assertEqual(expected, self.writeZip('streamed_parallel.zip',
+                                               'deflated',
+                                               compression_threads=3))
+    finally:
+      build_zip.STREAMING_SIZE = streaming_size
+    with zipfile.ZipFile(os.path.join(self.tmpdir.name, 'streamed.zip')) as z:
+      self.assertIsNone(z.testzip())
+
+  def testZipInputs(self):
+    dep = os.path.join(self.tmpdir.name, 'dep.zip')
+    with open(dep, 'wb') as f:
+      # Written to a non seekable file, with data descriptors.
+      with zipfile.ZipFile(_Unseekable(f), 'w') as z:
+        z.writestr('lib/', '')
+        z.write(self.files[2], 'lib/deflated', zipfile.ZIP_DEFLATED)
+        z.write(self.files[3], 'lib/bzip2', zipfile.ZIP_BZIP2)
+        z.writestr('lib/stored', b'stored', zipfile.ZIP_STORED)
+        z.writestr('lib/overridden', b'from dep')
+        with z.open('lib/streamed', 'w') as f:
+          f.write(b'streamed' * 1000)
+    other = os.path.join(self.tmpdir.name, 'other.zip')
+    with zipfile.ZipFile(other, 'w') as z:
+      z.writestr('lib/stored', b'from other')
+    manifest_path = os.path.join(self.tmpdir.name, 'manifest.json')
+    with open(manifest_path, 'w') as f:
+      json.dump([{
+          'type': manifest.ENTRY_IS_FILE, 'dest': 'lib/overridden',
+          'src': self.files[1], 'mode': None, 'user': None, 'group': None,
+          'uid': None, 'gid': None, 'origin': 'test',
+      }], f)
+    entries = build_zip._load_manifest('/prefix', manifest_path, [dep, other])
+    self.assertEqual(
+        ['prefix', 'prefix/lib', 'prefix/lib/bzip2', 'prefix/lib/deflated',
+         'prefix/lib/overridden', 'prefix/lib/stored', 'prefix/lib/streamed'],
+        [entry.dest for entry in entries])
+    output = os.path.join(self.tmpdir.name, 'merged.zip')
+    with build_zip.ZipWriter(output, (1980, 1, 1, 0, 0, 0), 0o644,
+                             'deflated', 6) as writer:
+      for entry in entries:
+        if isinstance(entry, build_zip.ZipMember):
+          writer.add_zip_member(entry)
+        else:
+          writer.add_manifest_entry(entry)
+    self.assertEqual(5, writer.stats['zip_members_copied'])
+
+    with zipfile.ZipFile(dep) as d, zipfile.ZipFile(output) as z:
+      self.assertIsNone(z.testzip())
+      with open(self.files[1], 'rb') as f:
+        self.assertEqual(f.read(), z.read('prefix/lib/overridden'))
+      self.assertEqual(b'from other', z.read('prefix/lib/stored'))
+      for name in ('lib/', 'lib/deflated', 'lib/bzip2', 'lib/streamed'):
+        original = d.getinfo(name)
+        self.assertTrue(original.flag_bits & 0x08)
+        info = z.getinfo('prefix/' + name)
+        self.assertEqual(d.read(name), z.read(info))
+        for attr in ('compress_type', 'CRC', 'compress_size', 'file_size',
+                     'date_time', 'external_attr'):
+          self.assertEqual(getattr(original, attr), getattr(info, attr))
+
+  def testAlignment(self):
+    output = os.path.join(self.tmpdir.name, 'aligned.zip')
+    with build_zip.ZipWriter(
+        output, (1980, 1, 1, 0, 0, 0), 0o644, 'stored', 6, alignment=4096,
+        alignment_policies=[('*.so', 16384), ('*.txt', 0)]) as writer:
+      for name, path in (('a', self.files[1]), ('lib/b.so', self.files[2]),
+                         ('c.txt', self.files[1]), ('dir/d', self.files[3])):
+        entry_info = writer.make_zipinfo(name, None)
+        writer.write_file(entry_info, path)
+    with zipfile.ZipFile(output) as z, open(output, 'rb') as f:
+      self.assertIsNone(z.testzip())
+      offsets = {}
+      for info in z.infolist():
+        # The padding is only in the local headers.
+        self.assertEqual(b'', info.extra)
+        f.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+                               f.read(zipfile.sizeFileHeader))
+        offsets[info.filename] = (info.header_offset + zipfile.sizeFileHeader +
+                                  header[10] + header[11])
+    self.assertEqual(0, offsets['a'] % 4096)
+    self.assertEqual(0, offsets['lib/b.so'] % 16384)
+    self.assertNotEqual(0, offsets['c.txt'] % 4096)
+    self.assertEqual(0, offsets['dir/d'] % 4096)
+
+  def testParseAlignment(self):
+    self.assertEqual(0, compression_policy.parse_alignment('0'))
+    self.assertEqual(4096, compression_policy.parse_alignment('4096'))
+    for value in ('3', '-4', '65536'):
+      with self.assertRaises(ValueError):
+        compression_policy.parse_alignment(value)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -36,6 +36,12 @@ class ZipEquivalency(zip_test_lib.ZipTest):
         "test_zip_basic.zip",
     )
 
+  def test_compression_threads(self):
+    self.assertFilesEqual(
+        "test_zip_basic_compression_threads.zip",
+        "test_zip_basic.zip",
+    )
+
   def test_extension(self):
     self.assertFilesEqual(
         "test_zip_basic_renamed.foo",
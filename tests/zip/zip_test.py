@@ -77,6 +77,17 @@ class ZipContentsTests(zip_test_lib.ZipContentsTestBase):
         {"filename": "abc/def/mylink", "attr": 0o777},
     ])
 
+  def test_deps(self):
+    self.assertZipFileContent("test_zip_deps.zip", [
+        {"filename": "outer/", "isdir": True, "attr": 0o755},
+        {"filename": "outer/abc/", "isdir": True, "attr": 0o755},
+        {"filename": "outer/abc/def/", "isdir": True, "attr": 0o755},
+        {"filename": "outer/abc/def/hello.txt", "crc": HELLO_CRC},
+        {"filename": "outer/abc/def/loremipsum.txt", "crc": LOREM_CRC},
+        {"filename": "outer/abc/def/mylink", "attr": 0o777},
+        {"filename": "outer/hello.txt", "crc": HELLO_CRC},
+    ])
+
   def test_package_dir_substitution(self):
     self.assertZipFileContent("test_zip_package_dir_substitution.zip", [
         {"filename": "level1/", "isdir": True, "attr": 0o755},